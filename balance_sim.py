@@ -0,0 +1,369 @@
+"""
+Monte Carlo balance simulator for Soul Meter bot
+Plays duels between every character and level in char.CHARACTERS, each
+game with random legal skill loadouts for both sides, and reports a
+win-rate matrix, average turn counts and the best and worst loadouts.
+
+Games follow duel_engine rules (energy cost and restore capped at
+MAX_ENERGY, damage with attack buffs and apply_defense, heals, defense
+debuffs, level-scaled stats and damage) but run as NumPy arrays, a whole
+batch of games one turn at a time. --verify plays some games again through
+DuelEngine and checks they end the same way, run it after rule changes.
+
+Loadouts are sets of distinct abilities within MAX_ABILITY_WEIGHT with at
+least one 0-energy ability, so a side can always act. Each turn a side
+plays a random ability it can afford, and who moves first is random.
+
+Needs numpy, which the bot itself doesn't (pip install numpy).
+
+    python balance_sim.py
+    python balance_sim.py --games 50000 --levels 1 3 --out balance.json
+    python balance_sim.py --verify 2000
+"""
+import argparse
+import itertools
+import json
+import sys
+import time
+from typing import Dict, Any, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # Only needed for this script
+    np = None
+
+from char import (
+    CHARACTERS, RARITY_MAX_LEVEL, MAX_ABILITY_WEIGHT, MAX_ABILITY_SLOTS,
+    calculate_stats_for_level, get_ability_damage,
+    EFFECT_DAMAGE, EFFECT_HEAL, EFFECT_DEFENSE_BUFF, EFFECT_ATTACK_BUFF
+)
+from duel_engine import MAX_ENERGY, engine
+
+# Games still running after this many turns count as draws
+MAX_TURNS = 1000
+
+EFFECT_CODES = {EFFECT_DAMAGE: 1, EFFECT_HEAL: 2, EFFECT_DEFENSE_BUFF: 3, EFFECT_ATTACK_BUFF: 4}
+
+
+def loadouts(char_id: str) -> List[Tuple[int, ...]]:
+    """Every legal set of ability indices of a character"""
+    abilities = CHARACTERS[char_id]['abilities']
+    result = []
+    for size in range(1, min(len(abilities), MAX_ABILITY_SLOTS) + 1):
+        for combo in itertools.combinations(range(len(abilities)), size):
+            if sum(abilities[i]['weight'] for i in combo) > MAX_ABILITY_WEIGHT:
+                continue
+            if any(abilities[i]['energy_cost'] == 0 for i in combo):
+                result.append(combo)
+    return result
+
+
+class Simulator:
+    """Character, level and loadout tables flattened into NumPy arrays
+    groups are (char_id, level) pairs, entries are (group, loadout) and
+    ability rows are (group, ability index) with level-scaled values.
+    """
+
+    def __init__(self, levels: Optional[List[int]] = None, chars: Optional[List[str]] = None):
+        self.groups: List[Tuple[str, int]] = []
+        self.entries: List[Tuple[int, Tuple[int, ...]]] = []
+        group_entries = []
+        hp, defense = [], []
+        rows = []  # (cost, restore, effect, value, percent, ability index)
+        entry_rows = []
+
+        for char_id in chars or CHARACTERS:
+            char = CHARACTERS[char_id]
+            char_loadouts = loadouts(char_id)
+            for level in range(1, RARITY_MAX_LEVEL[char['rarity']] + 1):
+                if levels and level not in levels:
+                    continue
+                group = len(self.groups)
+                self.groups.append((char_id, level))
+                stats = calculate_stats_for_level(char_id, level)
+                hp.append(stats['hp'])
+                defense.append(stats['defense'])
+
+                first_row = len(rows)
+                for index, ability in enumerate(char['abilities']):
+                    effect = EFFECT_CODES.get(ability.get('effect_type', ''), 0)
+                    if effect == EFFECT_CODES[EFFECT_DAMAGE]:
+                        value = get_ability_damage(char_id, index, level)
+                    else:
+                        value = ability['effect_value']
+                    rows.append((
+                        ability['energy_cost'], ability.get('energy_restore', 0), effect,
+                        value, ability.get('effect_percent', 0), index
+                    ))
+
+                start = len(self.entries)
+                for loadout in char_loadouts:
+                    self.entries.append((group, loadout))
+                    entry_rows.append([first_row + index for index in loadout])
+                group_entries.append(np.arange(start, len(self.entries)))
+
+        if not self.groups:
+            raise ValueError("No characters match the given levels")
+
+        width = max(len(row) for row in entry_rows)
+        self.entry_rows = np.full((len(entry_rows), width), -1, dtype=np.int64)
+        for entry, row in enumerate(entry_rows):
+            self.entry_rows[entry, :len(row)] = row
+        self.entry_group = np.array([group for group, _ in self.entries], dtype=np.int64)
+        self.group_entries = group_entries
+        self.group_hp = np.array(hp, dtype=np.int64)
+        self.group_defense = np.array(defense, dtype=np.int64)
+
+        table = np.array(rows, dtype=np.int64)
+        # Padding slots (-1) read the extra last row, they are masked out anyway
+        table = np.vstack([table, np.zeros((1, table.shape[1]), dtype=np.int64)])
+        self.cost, self.restore, self.effect, self.value, self.percent, self.ability_index = table.T
+
+    def label(self, group: int) -> str:
+        char_id, level = self.groups[group]
+        return f"{CHARACTERS[char_id]['name_en']} L{level}"
+
+    def play(self, entries: 'np.ndarray', rng: 'np.random.Generator', max_turns: int = MAX_TURNS,
+             record: bool = False) -> Tuple['np.ndarray', 'np.ndarray', Optional['np.ndarray']]:
+        """Play len(entries) games, entries[:, 0] moves first
+        Returns the winning side (0, 1, -1 for a draw), turns played and,
+        with record, the ability index played on every turn (-1 after the end).
+        """
+        n = len(entries)
+        groups = self.entry_group[entries]
+        hp = self.group_hp[groups]
+        max_hp = hp.copy()
+        defense = self.group_defense[groups]
+        energy = np.full((n, 2), MAX_ENERGY, dtype=np.int64)
+        attack_buff = np.zeros((n, 2), dtype=np.int64)
+        defense_mod = np.zeros((n, 2), dtype=np.int64)
+
+        winner = np.full(n, -1, dtype=np.int8)
+        turns = np.zeros(n, dtype=np.int32)
+        choices = np.full((n, max_turns), -1, dtype=np.int16) if record else None
+        active = np.arange(n)
+
+        for turn in range(max_turns):
+            if not active.size:
+                break
+            me, opp = turn & 1, (turn & 1) ^ 1
+
+            slots = self.entry_rows[entries[active, me]]
+            usable = (slots >= 0) & (self.cost[slots] <= energy[active, me, None])
+            keys = rng.random(slots.shape)
+            keys[~usable] = -1
+            row = slots[np.arange(active.size), keys.argmax(axis=1)]
+
+            energy[active, me] = np.minimum(MAX_ENERGY, energy[active, me] - self.cost[row] + self.restore[row])
+
+            effect = self.effect[row]
+            hit = effect == EFFECT_CODES[EFFECT_DAMAGE]
+            if hit.any():
+                games = active[hit]
+                damage = self.value[row[hit]]
+                buff = attack_buff[games, me]
+                damage = np.where(buff > 0, (damage * (1 + buff / 100)).astype(np.int64), damage)
+                debuff = defense_mod[games, opp]
+                target_defense = defense[games, opp]
+                target_defense = np.where(
+                    debuff < 0, (target_defense * (1 + debuff / 100)).astype(np.int64), target_defense
+                )
+                hp[games, opp] -= np.maximum(1, damage - target_defense)
+
+            heal = effect == EFFECT_CODES[EFFECT_HEAL]
+            if heal.any():
+                games = active[heal]
+                hp[games, me] = np.minimum(max_hp[games, me], hp[games, me] + self.value[row[heal]])
+
+            debuff = effect == EFFECT_CODES[EFFECT_DEFENSE_BUFF]
+            if debuff.any():
+                defense_mod[active[debuff], opp] += self.percent[row[debuff]]
+
+            buff = effect == EFFECT_CODES[EFFECT_ATTACK_BUFF]
+            if buff.any():
+                attack_buff[active[buff], me] += self.percent[row[buff]]
+
+            turns[active] = turn + 1
+            if record:
+                choices[active, turn] = self.ability_index[row]
+
+            won = hp[active, opp] <= 0
+            winner[active[won]] = me
+            active = active[~won]
+
+        return winner, turns, choices
+
+    def random_games(self, pairs: 'np.ndarray', rng: 'np.random.Generator') -> Tuple['np.ndarray', 'np.ndarray']:
+        """Random loadouts for group pairs, randomly swapped so either may move first
+        Returns entries (first mover in column 0) and whether each game is swapped.
+        """
+        entries = np.empty(pairs.shape, dtype=np.int64)
+        for column in (0, 1):
+            for group, choices in enumerate(self.group_entries):
+                games = np.flatnonzero(pairs[:, column] == group)
+                entries[games, column] = choices[rng.integers(len(choices), size=games.size)]
+        swapped = rng.random(len(pairs)) < 0.5
+        entries[swapped] = entries[swapped][:, ::-1]
+        return entries, swapped
+
+    def run(self, games: int, rng: 'np.random.Generator', batch: int) -> Dict[str, Any]:
+        """games per ordered pair of groups, in batches of at most batch games"""
+        size = len(self.groups)
+        cells = np.array([(a, b) for a in range(size) for b in range(size)], dtype=np.int64)
+        cell_of_game = np.repeat(np.arange(len(cells)), games)
+
+        wins = np.zeros(len(cells))
+        draws = np.zeros(len(cells))
+        turn_total = np.zeros(len(cells))
+        first_wins = 0
+        entry_wins = np.zeros(len(self.entries))
+        entry_games = np.zeros(len(self.entries))
+
+        for start in range(0, len(cell_of_game), batch):
+            cell = cell_of_game[start:start + batch]
+            pairs = cells[cell]
+            entries, swapped = self.random_games(pairs, rng)
+            winner, turns, _ = self.play(entries, rng)
+
+            row_side = swapped.astype(np.int8)  # Side the row group played on
+            row_won = winner == row_side
+            col_won = winner == 1 - row_side
+            wins += np.bincount(cell, weights=row_won, minlength=len(cells))
+            draws += np.bincount(cell, weights=winner < 0, minlength=len(cells))
+            turn_total += np.bincount(cell, weights=turns, minlength=len(cells))
+            first_wins += int((winner == 0).sum())
+
+            row_entry = np.where(swapped, entries[:, 1], entries[:, 0])
+            col_entry = np.where(swapped, entries[:, 0], entries[:, 1])
+            entry_wins += np.bincount(row_entry, weights=row_won, minlength=len(self.entries))
+            entry_wins += np.bincount(col_entry, weights=col_won, minlength=len(self.entries))
+            entry_games += np.bincount(row_entry, minlength=len(self.entries))
+            entry_games += np.bincount(col_entry, minlength=len(self.entries))
+
+        return {
+            'games': len(cell_of_game),
+            'win_rate': (wins / games).reshape(size, size),
+            'draw_rate': (draws / games).reshape(size, size),
+            'avg_turns': (turn_total / games).reshape(size, size),
+            'first_move_win_rate': first_wins / len(cell_of_game),
+            'entry_win_rate': np.divide(entry_wins, entry_games, out=np.zeros_like(entry_wins), where=entry_games > 0),
+            'entry_games': entry_games
+        }
+
+    def verify(self, games: int, rng: 'np.random.Generator', max_turns: int = MAX_TURNS) -> List[str]:
+        """Replay random games through DuelEngine, returns the mismatches"""
+        size = len(self.groups)
+        pairs = rng.integers(size, size=(games, 2))
+        entries, _ = self.random_games(pairs, rng)
+        winner, turns, choices = self.play(entries, rng, max_turns, record=True)
+
+        errors = []
+        for game in range(games):
+            sides = []
+            for side, entry in enumerate(entries[game]):
+                group, loadout = self.entries[entry]
+                char_id, level = self.groups[group]
+                slots = {str(slot): index for slot, index in enumerate(loadout, 1)}
+                sides.append(engine.new_side(side, char_id, level, slots))
+            state = engine.new_duel(*sides, seed=0)
+            slot_of = [{index: slot for slot, index in side.slots.items()} for side in sides]
+
+            for turn in range(turns[game]):
+                result = engine.apply_action(state, slot_of[state.turn][int(choices[game, turn])])
+                if result.error:
+                    errors.append(f"game {game} turn {turn + 1}: {result.error}")
+                    break
+            expected = -1 if state.winner is None else state.winner
+            if expected != winner[game]:
+                errors.append(f"game {game}: engine winner {expected}, simulator {winner[game]}")
+        return errors
+
+
+def print_matrix(sim: Simulator, title: str, matrix: 'np.ndarray', fmt: str) -> None:
+    width = max(len(sim.label(group)) for group in range(len(sim.groups)))
+    print(f"\n{title}")
+    print(" " * (width + 5) + "".join(f"{column + 1:>7}" for column in range(len(sim.groups))))
+    for group, row in enumerate(matrix):
+        print(f"{group + 1:>3}. {sim.label(group):<{width}}" + "".join(f"{value:>7{fmt}}" for value in row))
+
+
+def loadout_report(sim: Simulator, result: Dict[str, Any], top: int) -> Dict[str, Any]:
+    """Best and worst loadouts of every group by overall win rate"""
+    report = {}
+    for group, choices in enumerate(sim.group_entries):
+        played = [entry for entry in choices if result['entry_games'][entry] > 0]
+        played.sort(key=lambda entry: result['entry_win_rate'][entry], reverse=True)
+        abilities = CHARACTERS[sim.groups[group][0]]['abilities']
+
+        def describe(entry):
+            return {
+                'abilities': [abilities[index]['name'] for index in sim.entries[entry][1]],
+                'win_rate': round(float(result['entry_win_rate'][entry]), 4),
+                'games': int(result['entry_games'][entry])
+            }
+        report[sim.label(group)] = {
+            'best': [describe(entry) for entry in played[:top]],
+            'worst': [describe(entry) for entry in played[-top:][::-1]] if len(played) > top else []
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate duels between all characters, levels and loadouts")
+    parser.add_argument('--games', type=int, default=10000, help="Games per pair of character levels")
+    parser.add_argument('--levels', type=int, nargs='+', help="Only these levels")
+    parser.add_argument('--chars', nargs='+', choices=list(CHARACTERS), help="Only these characters")
+    parser.add_argument('--batch', type=int, default=200000, help="Games simulated at once")
+    parser.add_argument('--seed', type=int, help="Seed for reproducible runs")
+    parser.add_argument('--top', type=int, default=3, help="Loadouts listed per character level")
+    parser.add_argument('--out', help="Write all results as JSON")
+    parser.add_argument('--verify', type=int, metavar='GAMES', help="Check this many games against DuelEngine")
+    args = parser.parse_args()
+
+    if np is None:
+        sys.exit("balance_sim.py requires numpy (pip install numpy)")
+
+    rng = np.random.default_rng(args.seed)
+    sim = Simulator(args.levels, args.chars)
+
+    if args.verify:
+        errors = sim.verify(args.verify, rng)
+        for error in errors[:10]:
+            print(error)
+        print(f"Verified {args.verify} games against DuelEngine, {len(errors)} differ")
+        sys.exit(1 if errors else 0)
+
+    start = time.perf_counter()
+    result = sim.run(args.games, rng, args.batch)
+    elapsed = time.perf_counter() - start
+
+    print(f"{result['games']} games between {len(sim.groups)} character levels and "
+          f"{len(sim.entries)} loadouts in {elapsed:.2f} s ({result['games'] / elapsed:.0f}/s)")
+    print(f"First move wins {result['first_move_win_rate']:.1%}")
+    print_matrix(sim, "Win rate of row against column, %", result['win_rate'] * 100, '.1f')
+    print_matrix(sim, "Average turns", result['avg_turns'], '.1f')
+    if result['draw_rate'].any():
+        print_matrix(sim, f"Draws after {MAX_TURNS} turns, %", result['draw_rate'] * 100, '.1f')
+
+    loadout_stats = loadout_report(sim, result, args.top)
+    print("\nBest loadouts")
+    for label, stats in loadout_stats.items():
+        best = stats['best'][0]
+        print(f"{label}: {best['win_rate']:.1%}  {', '.join(best['abilities'])}")
+
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump({
+                'games_per_pair': args.games,
+                'groups': [sim.label(group) for group in range(len(sim.groups))],
+                'win_rate': result['win_rate'].round(4).tolist(),
+                'draw_rate': result['draw_rate'].round(4).tolist(),
+                'avg_turns': result['avg_turns'].round(2).tolist(),
+                'first_move_win_rate': round(result['first_move_win_rate'], 4),
+                'loadouts': loadout_stats
+            }, f, ensure_ascii=False, indent=2)
+        print(f"\nResults written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Benchmark of storage file formats for Soul Meter bot
+Times saving and loading a synthetic profile.json-sized table in every
+STORAGE_FORMAT available here, for growing user counts.
+
+    python bench_formats.py --users 1000 10000 100000
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from typing import Dict, Any
+
+from char import CHARACTERS
+from storage_format import FORMATS, check_format, save_file, load_file
+
+
+def make_user(telegram_id: int, sid: int) -> Dict[str, Any]:
+    """Synthetic profile shaped like the ones storage.get_user creates"""
+    char_ids = list(CHARACTERS)
+    active_char = random.choice(char_ids + [None])
+    return {
+        'telegram_id': telegram_id,
+        'sid': sid,
+        'level': 1,
+        'souls': random.randint(0, 50000),
+        'exp': random.randint(0, 20000),
+        'trophy_souls': random.randint(0, 10000),
+        'trophies': random.randint(0, 5000),
+        'chests': {
+            'weak_soul': random.randint(0, 20),
+            'time': random.randint(0, 10),
+            'death': random.randint(0, 5),
+            'infinity': random.randint(0, 1)
+        },
+        'active_char': active_char,
+        'last_up': '2026-01-27T13:12:57.344549',
+        'up_count': random.randint(0, 500),
+        'skill_slots': {active_char: {'1': 0, '2': 1}} if active_char else {},
+        'avatar': None,
+        'username': f"player{telegram_id}",
+        'first_name': f"Игрок {sid}"
+    }
+
+
+def make_profiles(user_count: int) -> Dict[str, Any]:
+    users = {}
+    for sid in range(1, user_count + 1):
+        telegram_id = 1_000_000_000 + sid
+        users[str(telegram_id)] = make_user(telegram_id, sid)
+    return {'users': users, 'next_sid': user_count + 1}
+
+
+def bench(data: Dict[str, Any], fmt: str, path: str, repeat: int) -> Dict[str, float]:
+    save_times, load_times = [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        save_file(path, data, fmt)
+        save_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        loaded = load_file(path)
+        load_times.append(time.perf_counter() - start)
+
+    assert loaded == data, f"{fmt} round trip changed the data"
+    return {
+        'save_ms': min(save_times) * 1000,
+        'load_ms': min(load_times) * 1000,
+        'size_kb': os.path.getsize(path) / 1024
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark storage file formats")
+    parser.add_argument('--users', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--formats', nargs='+', default=list(FORMATS))
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    formats = []
+    for fmt in args.formats:
+        try:
+            formats.append(check_format(fmt))
+        except RuntimeError as e:
+            print(f"Skipping {fmt}: {e}")
+
+    random.seed(0)
+    print(f"{'users':>8} {'format':>8} {'save ms':>10} {'load ms':>10} {'size KB':>10}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for user_count in args.users:
+            data = make_profiles(user_count)
+            for fmt in formats:
+                result = bench(data, fmt, os.path.join(tmp_dir, f"profile.{fmt}"), args.repeat)
+                print(f"{user_count:>8} {fmt:>8} {result['save_ms']:>10.1f} {result['load_ms']:>10.1f} {result['size_kb']:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+"""
+Benchmark suite for storage backends of Soul Meter bot
+Generates synthetic profile.json/userchar.json at several scales and times
+the storage API on every backend/mode, reporting p50/p99 latency,
+throughput, startup and flush time and peak RSS.
+
+Every mode runs in its own process so RSS and module state don't leak
+between runs; nothing touches the real storage directory.
+
+    python bench_storage.py
+    python bench_storage.py --users 1000000 --modes json sqlite --output 1m.json
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, Any, List
+
+from bench_formats import make_profiles
+from char import CHARACTERS
+from storage_format import DEFAULT_FORMAT, FORMATS, save_file
+
+MODES = {
+    'json': {'STORAGE_BACKEND': 'json', 'STORAGE_JOURNAL': '1'},
+    'json-nojournal': {'STORAGE_BACKEND': 'json', 'STORAGE_JOURNAL': '0'},
+    'sqlite': {'STORAGE_BACKEND': 'sqlite'},
+    'sharded': {'STORAGE_BACKEND': 'sharded'},
+    'dbm': {'STORAGE_BACKEND': 'dbm'},
+}
+
+OPERATIONS = (
+    'get_user', 'save_user', 'get_user_by_username', 'get_user_characters',
+    'add_character_to_user', 'set_user_skill_slot'
+)
+
+
+def make_user_chars(profiles: Dict[str, Any]) -> Dict[str, Any]:
+    """Synthetic userchar.json with 1-5 characters per user"""
+    char_ids = list(CHARACTERS)
+    user_chars = {}
+    for str_id in profiles['users']:
+        chars = {}
+        for char_id in random.sample(char_ids, random.randint(1, min(5, len(char_ids)))):
+            chars[char_id] = {'char_id': char_id, 'level': random.randint(1, 10), 'count': random.randint(1, 3)}
+        user_chars[str_id] = chars
+    return {'user_chars': user_chars}
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    return samples[min(len(samples) - 1, int(len(samples) * pct))]
+
+
+def time_calls(func, args_list: List[tuple]) -> Dict[str, float]:
+    samples = []
+    for args in args_list:
+        start = time.perf_counter()
+        func(*args)
+        samples.append(time.perf_counter() - start)
+    total = sum(samples)
+    samples.sort()
+    return {
+        'p50_us': percentile(samples, 0.50) * 1e6,
+        'p99_us': percentile(samples, 0.99) * 1e6,
+        'ops_per_s': len(samples) / total if total else float('inf')
+    }
+
+
+def worker_prepare(snapshot_dir: str, mode_dir: str) -> None:
+    """Put the generated snapshot into place for the selected backend"""
+    profile_path = os.path.join(snapshot_dir, 'profile.json')
+    userchar_path = os.path.join(snapshot_dir, 'userchar.json')
+    backend = os.environ['STORAGE_BACKEND']
+
+    if backend == 'json':
+        shutil.copy(profile_path, mode_dir)
+        shutil.copy(userchar_path, mode_dir)
+    elif backend == 'sqlite':
+        import storage_sqlite
+        storage_sqlite.import_json(profile_path, userchar_path)
+    elif backend == 'sharded':
+        import storage_sharded
+        storage_sharded.import_json(profile_path, userchar_path)
+    elif backend == 'dbm':
+        import storage_dbm
+        storage_dbm.import_json(profile_path, userchar_path)
+
+
+def worker_run(user_count: int, op_count: int) -> Dict[str, Any]:
+    """Time the storage API against an already prepared backend"""
+    import storage
+
+    start = time.perf_counter()
+    storage.load_users()
+    load_s = time.perf_counter() - start
+
+    random.seed(1)
+    char_ids = list(CHARACTERS)
+    ids = [1_000_000_000 + random.randint(1, user_count) for _ in range(op_count)]
+
+    results = {}
+    results['get_user'] = time_calls(storage.get_user, [(i,) for i in ids])
+
+    users = [storage.get_user(i) for i in ids]
+    for user in users:
+        user['souls'] += 1
+    results['save_user'] = time_calls(storage.save_user, [(u,) for u in users])
+
+    results['get_user_by_username'] = time_calls(storage.get_user_by_username, [(f"player{i}",) for i in ids])
+    results['get_user_characters'] = time_calls(storage.get_user_characters, [(i,) for i in ids])
+    results['add_character_to_user'] = time_calls(
+        storage.add_character_to_user, [(i, random.choice(char_ids)) for i in ids]
+    )
+    results['set_user_skill_slot'] = time_calls(
+        storage.set_user_skill_slot, [(i, random.choice(char_ids), random.randint(1, 4), random.randint(0, 3)) for i in ids]
+    )
+
+    start = time.perf_counter()
+    storage.flush_users(force=True)
+    flush_s = time.perf_counter() - start
+
+    return {
+        'load_s': load_s,
+        'flush_s': flush_s,
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'operations': results
+    }
+
+
+def run_worker(step: str, mode: str, mode_dir: str, snapshot_dir: str, user_count: int, op_count: int, fmt: str) -> str:
+    env = dict(os.environ)
+    env.update(MODES[mode])
+    env.update({
+        'STORAGE_DIR': mode_dir,
+        'STORAGE_DB_PATH': os.path.join(mode_dir, 'soulmeter.db'),
+        'STORAGE_USERS_DIR': os.path.join(mode_dir, 'users'),
+        'STORAGE_DBM_PATH': os.path.join(mode_dir, 'soulmeter.dbm'),
+        'STORAGE_FORMAT': fmt
+    })
+    cmd = [
+        sys.executable, os.path.abspath(__file__), '--worker', step,
+        '--dir', mode_dir, '--snapshot', snapshot_dir,
+        '--users', str(user_count), '--ops', str(op_count)
+    ]
+    output = subprocess.run(cmd, env=env, check=True, capture_output=True, text=True).stdout
+    return output.strip().splitlines()[-1] if output.strip() else ''
+
+
+def print_results(user_count: int, mode: str, result: Dict[str, Any]) -> None:
+    print(f"\n{user_count} users, {mode}: load {result['load_s']:.2f} s, "
+          f"flush {result['flush_s']:.2f} s, peak RSS {result['peak_rss_mb']:.0f} MB")
+    print(f"  {'operation':<24} {'p50 us':>10} {'p99 us':>10} {'ops/s':>12}")
+    for op in OPERATIONS:
+        stats = result['operations'][op]
+        print(f"  {op:<24} {stats['p50_us']:>10.1f} {stats['p99_us']:>10.1f} {stats['ops_per_s']:>12.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark storage backends")
+    parser.add_argument('--users', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--modes', nargs='+', choices=list(MODES), default=list(MODES))
+    parser.add_argument('--ops', type=int, default=2000, help="Calls per operation")
+    parser.add_argument('--format', choices=FORMATS, default=DEFAULT_FORMAT)
+    parser.add_argument('--output', help="Also write results as JSON to this file")
+    parser.add_argument('--worker', choices=('prepare', 'run'), help=argparse.SUPPRESS)
+    parser.add_argument('--dir', help=argparse.SUPPRESS)
+    parser.add_argument('--snapshot', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker == 'prepare':
+        worker_prepare(args.snapshot, args.dir)
+        return
+    if args.worker == 'run':
+        print(json.dumps(worker_run(args.users[0], args.ops)))
+        return
+
+    all_results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for user_count in args.users:
+            random.seed(0)
+            snapshot_dir = os.path.join(tmp_dir, f"snapshot-{user_count}")
+            os.makedirs(snapshot_dir)
+            profiles = make_profiles(user_count)
+            save_file(os.path.join(snapshot_dir, 'profile.json'), profiles, args.format)
+            save_file(os.path.join(snapshot_dir, 'userchar.json'), make_user_chars(profiles), args.format)
+            del profiles
+
+            for mode in args.modes:
+                mode_dir = os.path.join(tmp_dir, f"{mode}-{user_count}")
+                os.makedirs(mode_dir)
+                run_worker('prepare', mode, mode_dir, snapshot_dir, user_count, args.ops, args.format)
+                result = json.loads(run_worker('run', mode, mode_dir, snapshot_dir, user_count, args.ops, args.format))
+                all_results.setdefault(str(user_count), {})[mode] = result
+                print_results(user_count, mode, result)
+                shutil.rmtree(mode_dir)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(all_results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,8 @@
 Character definitions for Soul Meter bot
 Each character has Russian name (in bot), English name (in code)
 """
-from typing import Dict, Any, List
+from types import MappingProxyType
+from typing import Optional, Dict, Any, List, Mapping
 
 # Rarity constants
 RARITY_HUMAN = "human"           # ⚪️ Человеческая - max 3 levels
@@ -45,6 +46,9 @@ UPGRADE_REQUIREMENTS = {
     10: (50000, 7500, 5000)
 }
 
+# Stats and ability damage grow by dividing by this for each level above 1
+LEVEL_SCALE = 0.9
+
 # Maximum weight for abilities (currently 10 for everyone)
 MAX_ABILITY_WEIGHT = 10
 
@@ -264,6 +268,7 @@ CHARACTERS: Dict[str, Dict[str, Any]] = {
         "base_damage": [700, 1000],
         "base_defense": 500,
         "base_crit": 15,
+        "image": "media/saber/saber.jpg",  # Shown in character info
         "abilities": [
             create_ability(
                 name="Удар",
@@ -295,33 +300,79 @@ def get_characters_by_rarity(rarity: str) -> List[str]:
     return [char_id for char_id, char in CHARACTERS.items() if char['rarity'] == rarity]
 
 
-def calculate_stats_for_level(char_id: str, level: int) -> Dict[str, Any]:
-    """Calculate character stats for given level"""
-    char = CHARACTERS.get(char_id)
-    if not char:
-        return None
-    
-    # Base stats at level 1
-    hp = char['base_hp']
-    damage_min = char['base_damage'][0]
-    damage_max = char['base_damage'][1]
-    defense = char['base_defense']
-    crit = char['base_crit']
-    
-    # Apply level scaling: divide by 0.9 for each level above 1
+def scale_for_level(value: int, level: int) -> int:
+    """Scale a level 1 value to level, rounding down after every step"""
     for _ in range(1, level):
-        hp = int(hp / 0.9)
-        damage_min = int(damage_min / 0.9)
-        damage_max = int(damage_max / 0.9)
-        defense = int(defense / 0.9)
-        crit = int(crit / 0.9)
-    
-    return {
+        value = int(value / LEVEL_SCALE)
+    return value
+
+
+def _level_table(value: int, max_level: int) -> List[int]:
+    """Scaled value for every level from 0 to max_level (levels 0 and 1 are the base value)"""
+    table = [value, value]
+    for _ in range(2, max_level + 1):
+        table.append(int(table[-1] / LEVEL_SCALE))
+    return table
+
+
+def _make_stats(hp: int, damage_min: int, damage_max: int, defense: int, crit: int) -> Mapping[str, Any]:
+    return MappingProxyType({
         'hp': hp,
-        'damage': [damage_min, damage_max],
+        'damage': (damage_min, damage_max),
         'defense': defense,
         'crit': crit
-    }
+    })
+
+
+# Level-scaled values of every character up to its rarity's max level, built at import:
+# _STATS_BY_LEVEL[char_id][level] and _ABILITY_DAMAGE_BY_LEVEL[char_id][ability_index][level]
+_STATS_BY_LEVEL: Dict[str, List[Mapping[str, Any]]] = {}
+_ABILITY_DAMAGE_BY_LEVEL: Dict[str, List[List[int]]] = {}
+
+
+def _build_level_tables() -> None:
+    for char_id, char in CHARACTERS.items():
+        max_level = RARITY_MAX_LEVEL[char['rarity']]
+        columns = zip(
+            _level_table(char['base_hp'], max_level),
+            _level_table(char['base_damage'][0], max_level),
+            _level_table(char['base_damage'][1], max_level),
+            _level_table(char['base_defense'], max_level),
+            _level_table(char['base_crit'], max_level)
+        )
+        _STATS_BY_LEVEL[char_id] = [_make_stats(*values) for values in columns]
+        _ABILITY_DAMAGE_BY_LEVEL[char_id] = [
+            _level_table(ability['effect_value'], max_level) for ability in char['abilities']
+        ]
+
+
+_build_level_tables()
+
+
+def calculate_stats_for_level(char_id: str, level: int) -> Optional[Mapping[str, Any]]:
+    """Character stats for given level (read-only, precomputed up to the max level)"""
+    table = _STATS_BY_LEVEL.get(char_id)
+    if table is None:
+        return None
+    if 0 <= level < len(table):
+        return table[level]
+    
+    char = CHARACTERS[char_id]
+    return _make_stats(
+        scale_for_level(char['base_hp'], level),
+        scale_for_level(char['base_damage'][0], level),
+        scale_for_level(char['base_damage'][1], level),
+        scale_for_level(char['base_defense'], level),
+        scale_for_level(char['base_crit'], level)
+    )
+
+
+def get_ability_damage(char_id: str, ability_index: int, level: int) -> int:
+    """effect_value of a character's ability scaled to level"""
+    table = _ABILITY_DAMAGE_BY_LEVEL[char_id][ability_index]
+    if 0 <= level < len(table):
+        return table[level]
+    return scale_for_level(CHARACTERS[char_id]['abilities'][ability_index]['effect_value'], level)
 
 
 def get_upgrade_requirements(target_level: int) -> tuple:
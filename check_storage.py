@@ -0,0 +1,207 @@
+"""
+Conformance check for storage backends of Soul Meter bot
+Runs the same scenario through the storage API on every backend listed in
+storage_backend.BACKENDS: user creation and SIDs, username lookups,
+character collections, skill slots, commit_user, iteration, leaderboards,
+and that everything survives a restart. The json backend also runs the
+cold-tier archive with STORAGE_ARCHIVE_DAYS set. Each backend runs in fresh
+processes on a temporary directory; nothing touches the real storage.
+
+    python check_storage.py
+    python check_storage.py --backends sqlite dbm
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from storage_backend import BACKENDS
+
+ALICE = 1_000_000_001
+BOB = 1_000_000_002
+NOBODY = 1_000_000_999
+
+
+def check(condition: bool, message: str) -> None:
+    if not condition:
+        raise AssertionError(message)
+
+
+def step_write() -> None:
+    import storage
+    import leaderboard
+
+    storage.load_users()
+    check(storage.peek_user(NOBODY) is None, "peek_user created a user")
+
+    alice = storage.get_user(ALICE)
+    bob = storage.get_user(BOB)
+    check((alice['sid'], bob['sid']) == (1, 2), f"SIDs {alice['sid']}, {bob['sid']} instead of 1, 2")
+    check(storage.get_user(ALICE)['sid'] == 1, "get_user of an existing user changed its SID")
+    check(storage.allocate_sid() == 3, "allocate_sid did not continue after existing users")
+    check(set(storage.peek_users([ALICE, BOB, NOBODY])) == {ALICE, BOB}, "peek_users returned wrong users")
+
+    alice['username'] = 'Alice'
+    alice['souls'] = 150
+    alice['trophies'] = 40
+    storage.save_user(alice)
+    check(storage.peek_user(ALICE)['souls'] == 150, "save_user was not stored")
+    check(storage.get_user_by_username('@ALICE')['telegram_id'] == ALICE, "username lookup is not case-insensitive")
+    alice['username'] = 'alice_renamed'
+    storage.save_user(alice)
+    check(storage.get_user_by_username('alice') is None, "old username still resolves")
+    check(storage.get_user_by_username('Alice_Renamed')['telegram_id'] == ALICE, "new username not indexed")
+
+    storage.add_character_to_user(ALICE, 'Saber')
+    storage.add_character_to_user(ALICE, 'Saber')
+    storage.add_character_to_user(ALICE, 'Yuichi_Katagiri')
+    check(storage.get_user_character(ALICE, 'Saber')['count'] == 2, "duplicate did not raise count")
+    check(len(storage.get_user_characters(ALICE)) == 2, "duplicates are stored as separate entries")
+    storage.update_user_character(ALICE, 'Yuichi_Katagiri', {'level': 5})
+    check(storage.get_user_character(ALICE, 'Yuichi_Katagiri')['level'] == 5, "update_user_character was not stored")
+    storage.update_user_character(ALICE, 'Missing', {'level': 5})
+    check(storage.get_user_character(ALICE, 'Missing') is None, "update_user_character created a character")
+
+    storage.set_user_skill_slot(ALICE, 'Saber', 1, 2)
+    check(dict(storage.get_user_skill_slots(ALICE, 'Saber')) == {'1': 2}, "skill slot was not stored")
+    check(dict(storage.get_user_skill_slots(NOBODY, 'Saber')) == {}, "skill slots of unknown user are not empty")
+
+    bob = storage.get_user(BOB)
+    bob['trophies'] = 90
+    storage.commit_user(bob, {'Saber': {'char_id': 'Saber', 'level': 3, 'count': 1}})
+    check(storage.get_user_character(BOB, 'Saber')['level'] == 3, "commit_user did not store characters")
+    check(leaderboard.get_top('trophies', 2) == [(BOB, 90), (ALICE, 40)], "leaderboard does not follow writes")
+
+    storage.flush_users(force=True)
+    storage.sync_users()
+
+
+def step_reopen() -> None:
+    import storage
+    import leaderboard
+
+    storage.load_users()
+    alice = storage.peek_user(ALICE)
+    check(alice is not None and alice['souls'] == 150, "profile lost after restart")
+    check(storage.get_user_by_username('alice_renamed')['telegram_id'] == ALICE, "username index lost after restart")
+    check(storage.get_user_character(ALICE, 'Saber')['count'] == 2, "characters lost after restart")
+    check(dict(storage.get_user_skill_slots(ALICE, 'Saber')) == {'1': 2}, "skill slots lost after restart")
+    check(leaderboard.get_rank(BOB, 'trophies') == 1, "leaderboard not rebuilt on load")
+
+    users = {user['telegram_id']: chars for user, chars in storage.iter_users()}
+    check(set(users) == {ALICE, BOB}, "iter_users returned wrong users")
+    check(set(users[ALICE]) == {'Saber', 'Yuichi_Katagiri'}, "iter_users returned wrong characters")
+
+    check(storage.get_user(NOBODY)['sid'] == 4, "SID counter did not survive restart")
+    storage.flush_users(force=True)
+
+
+def step_archive() -> None:
+    import storage
+    import leaderboard
+    from storage_journal import load_tables
+
+    storage.load_users()
+    bob = storage.get_user(BOB)
+    del bob['last_seen']  # Saved before last_seen was tracked
+    storage.save_user(bob)
+    storage.flush_users(force=True)
+    storage.load_users()
+    check(storage.peek_user(BOB).get('last_seen') is not None, "last_seen was not backfilled on load")
+    check(storage.archive_inactive_users() == 0, "active users were archived")
+
+    bob = storage.get_user(BOB)
+    bob['last_seen'] = '2020-01-01T00:00:00'
+    storage.save_user(bob)
+    check(storage.archive_inactive_users() == 1, "inactive user was not archived")
+    check(leaderboard.get_rank(BOB, 'trophies') is None, "archived user is still on the leaderboard")
+    storage.flush_users(force=True)
+    profiles, user_chars = load_tables(os.path.join(storage.STORAGE_DIR, 'profile.json'),
+                                       os.path.join(storage.STORAGE_DIR, 'userchar.json'))
+    check(str(BOB) in profiles['users'] and 'Saber' in user_chars.get(str(BOB), {}), "load_tables lost an archived user")
+
+    def grant(user, chars):
+        user['souls'] = user.get('souls', 0) + 10
+        return user['telegram_id'] == BOB
+    check(storage.grant_users(grant) == 1, "grant_users skipped an archived user")
+    check(storage.archive_inactive_users() == 1, "a grant counted as activity")
+
+    check(storage.peek_user(BOB)['trophies'] == 90, "archived profile was not readable")
+    check(storage.get_user_character(BOB, 'Saber')['level'] == 3, "archived characters were not readable")
+    check(leaderboard.get_rank(BOB, 'trophies') == 1, "restored user is not back on the leaderboard")
+    check(storage.archive_inactive_users() == 0, "a read did not count as activity")
+
+    bob = storage.get_user(BOB)
+    bob['last_seen'] = '2020-01-01T00:00:00'
+    storage.save_user(bob)
+    check(storage.archive_inactive_users() == 1, "inactive user was not archived again")
+    storage.flush_users(force=True)
+
+
+def step_archive_reopen() -> None:
+    import storage
+
+    storage.load_users()
+    bob = storage.peek_user(BOB)
+    check(bob is not None and bob['souls'] == 10, "archived user lost after restart")
+    check(storage.get_user_character(BOB, 'Saber')['level'] == 3, "archived characters lost after restart")
+    storage.flush_users(force=True)
+
+
+STEPS = {'write': step_write, 'reopen': step_reopen, 'archive': step_archive, 'archive_reopen': step_archive_reopen}
+ARCHIVE_STEPS = ('archive', 'archive_reopen')  # Only the json backend has a cold tier
+
+
+def run_backend(backend: str, tmp_dir: str) -> None:
+    env = dict(os.environ)
+    env.update({
+        'STORAGE_BACKEND': backend,
+        'STORAGE_DIR': tmp_dir,
+        'STORAGE_DB_PATH': os.path.join(tmp_dir, 'soulmeter.db'),
+        'STORAGE_USERS_DIR': os.path.join(tmp_dir, 'users'),
+        'STORAGE_DBM_PATH': os.path.join(tmp_dir, 'soulmeter.dbm'),
+        'STORAGE_ARCHIVE_DAYS': '0'
+    })
+    for step in STEPS:
+        if step in ARCHIVE_STEPS:
+            if backend != 'json':
+                continue
+            env['STORAGE_ARCHIVE_DAYS'] = '30'
+        result = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--step', step],
+            env=env, capture_output=True, text=True
+        )
+        if result.returncode != 0:
+            lines = (result.stderr or result.stdout).strip().splitlines()
+            raise AssertionError(f"{step}: {lines[-1] if lines else 'failed'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check storage backends against the storage API")
+    parser.add_argument('--backends', nargs='+', choices=list(BACKENDS), default=list(BACKENDS))
+    parser.add_argument('--step', choices=list(STEPS), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.step:
+        STEPS[args.step]()
+        return
+
+    failed = 0
+    for backend in args.backends:
+        start = time.perf_counter()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            try:
+                run_backend(backend, tmp_dir)
+            except AssertionError as e:
+                failed += 1
+                print(f"{backend:<8} FAIL  {e}")
+                continue
+        print(f"{backend:<8} ok    {time.perf_counter() - start:.2f} s")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
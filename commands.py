@@ -4,18 +4,17 @@ Contains /char, /skill commands and character management
 """
 from aiogram import Router, F
 from aiogram.filters import Command
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile, InputMediaPhoto
+from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto
 from aiogram.enums import ContentType
+from aiogram.exceptions import TelegramBadRequest
 
-from storage import (
-    get_user, save_user, get_user_characters, get_user_character,
-    update_user_character, get_user_skill_slots, set_user_skill_slot
-)
+from storage import transaction, peek_user_async, get_user_characters_async, get_user_character_async
 from char import (
     CHARACTERS, get_character, calculate_stats_for_level,
     get_upgrade_requirements, RARITY_EMOJI, RARITY_NAME, RARITY_MAX_LEVEL,
     MAX_ABILITY_WEIGHT, MAX_ABILITY_SLOTS
 )
+from media import media_cache, is_file_id_error
 
 router = Router()
 
@@ -48,7 +47,7 @@ async def cmd_char(message: Message):
 
 
 async def show_char_list(message: Message, user_id: int, page: int, edit: bool = False):
-    chars = get_user_characters(user_id)
+    chars = await get_user_characters_async(user_id)
     
     if not chars:
         text = "🎭 <i>У вас пока нет персонажей</i>\n\nИспользуйте /up для получения сундуков с персонажами"
@@ -68,7 +67,9 @@ async def show_char_list(message: Message, user_id: int, page: int, edit: bool =
         char = get_character(char_data['char_id'])
         if char:
             rarity = RARITY_EMOJI[char['rarity']]
-            lines.append(f"{start + i}. <b>{char['name_ru']}</b> <i>{rarity} {char['anime']}</i>")
+            count = char_data.get('count', 1)
+            copies = f" ×{count}" if count > 1 else ""
+            lines.append(f"{start + i}. <b>{char['name_ru']}</b>{copies} <i>{rarity} {char['anime']}</i>")
     
     text = "\n".join(lines)
     
@@ -115,7 +116,7 @@ async def callback_char_page(callback: CallbackQuery):
         return
     _, user_id, page_str = parse_callback(callback.data)
     
-    chars = get_user_characters(user_id)
+    chars = await get_user_characters_async(user_id)
     page = int(page_str)
     max_page = (len(chars) - 1) // CHARS_PER_PAGE
     
@@ -134,7 +135,7 @@ async def callback_char_select(callback: CallbackQuery):
     _, user_id, data = parse_callback(callback.data)
     page, idx = map(int, data.split("_"))
     
-    chars = get_user_characters(user_id)
+    chars = await get_user_characters_async(user_id)
     char_idx = page * CHARS_PER_PAGE + idx
     
     if char_idx >= len(chars):
@@ -146,9 +147,16 @@ async def callback_char_select(callback: CallbackQuery):
     await callback.answer()
 
 
+async def send_char_image(message: Message, image: str, text: str, keyboard: InlineKeyboardMarkup, edit: bool):
+    """Put the character picture into message, or below it once it was deleted"""
+    if edit:
+        return await message.edit_media(media=InputMediaPhoto(media=media_cache.input_file(image), caption=text), reply_markup=keyboard)
+    return await message.answer_photo(media_cache.input_file(image), caption=text, reply_markup=keyboard)
+
+
 async def show_char_info(message: Message, user_id: int, char_id: str, page: int = 0, idx: int = 0):
     char = get_character(char_id)
-    user_char = get_user_character(user_id, char_id)
+    user_char = await get_user_character_async(user_id, char_id)
     
     if not char or not user_char:
         await message.edit_text("🔴 Персонаж не найден")
@@ -203,14 +211,22 @@ async def show_char_info(message: Message, user_id: int, char_id: str, page: int
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
     
-    # Check for character specific image (Saber)
-    if char_id == "Saber":
-        photo = FSInputFile("media/saber/saber.jpg")
-        if message.content_type == ContentType.PHOTO:
-             await message.edit_media(media=InputMediaPhoto(media=photo, caption=text), reply_markup=keyboard)
-        else:
-             await message.delete()
-             await message.answer_photo(photo, caption=text, reply_markup=keyboard)
+    # Check for character specific image, uploaded once and then sent by file_id
+    image = char.get('image')
+    if image:
+        edit = message.content_type == ContentType.PHOTO
+        if not edit:
+            await message.delete()
+        try:
+            sent = await send_char_image(message, image, text, keyboard, edit)
+        except TelegramBadRequest as e:
+            if 'message is not modified' in str(e):
+                return
+            if not is_file_id_error(e):
+                raise
+            media_cache.forget(image)  # Stale file_id, send the file itself
+            sent = await send_char_image(message, image, text, keyboard, edit)
+        media_cache.remember(image, sent)
     else:
         # Standard text display
         if message.content_type == ContentType.TEXT:
@@ -254,9 +270,8 @@ async def callback_char_use(callback: CallbackQuery):
         return
     _, user_id, char_id = parse_callback(callback.data)
     
-    user = get_user(user_id)
-    user['active_char'] = char_id
-    save_user(user)
+    async with transaction(user_id) as tx:
+        tx.user['active_char'] = char_id
     
     char = get_character(char_id)
     await callback.answer(f"🟢 Персонаж {char['name_ru']} выбран!", show_alert=True)
@@ -279,7 +294,7 @@ async def callback_char_level(callback: CallbackQuery):
 
 async def show_char_level(message: Message, user_id: int, char_id: str, page: int = 0, idx: int = 0):
     char = get_character(char_id)
-    user_char = get_user_character(user_id, char_id)
+    user_char = await get_user_character_async(user_id, char_id)
     
     if not char or not user_char:
         return
@@ -333,11 +348,11 @@ async def callback_char_upgrade(callback: CallbackQuery):
     page = int(parts[1]) if len(parts) > 1 else 0
     idx = int(parts[2]) if len(parts) > 2 else 0
     
-    user = get_user(user_id)
-    user_char = get_user_character(user_id, char_id)
+    user = await peek_user_async(user_id)
+    user_char = await get_user_character_async(user_id, char_id)
     char = get_character(char_id)
     
-    if not char or not user_char:
+    if not user or not char or not user_char:
         return
     
     level = user_char.get('level', 1)
@@ -390,24 +405,26 @@ async def callback_char_upgrade_confirm(callback: CallbackQuery):
     page = int(parts[1]) if len(parts) > 1 else 0
     idx = int(parts[2]) if len(parts) > 2 else 0
     
-    user = get_user(user_id)
-    user_char = get_user_character(user_id, char_id)
-    char = get_character(char_id)
-    
-    level = user_char.get('level', 1)
-    next_level = level + 1
-    souls_req, trophy_souls_req, trophies_req = get_upgrade_requirements(next_level)
-    
-    # Final check
-    if user['souls'] < souls_req or user['trophy_souls'] < trophy_souls_req or user['trophies'] < trophies_req:
+    async with transaction(user_id) as tx:
+        user = tx.user
+        user_char = tx.get_character(char_id)
+        char = get_character(char_id)
+        
+        level = user_char.get('level', 1)
+        next_level = level + 1
+        souls_req, trophy_souls_req, trophies_req = get_upgrade_requirements(next_level)
+        
+        # Final check
+        enough = user['souls'] >= souls_req and user['trophy_souls'] >= trophy_souls_req and user['trophies'] >= trophies_req
+        if enough:
+            # Upgrade
+            user['souls'] -= souls_req
+            tx.update_character(char_id, {'level': next_level})
+    
+    if not enough:
         await callback.answer("🔴 Недостаточно ресурсов!", show_alert=True)
         return
     
-    # Upgrade
-    user['souls'] -= souls_req
-    save_user(user)
-    update_user_character(user_id, char_id, {'level': next_level})
-    
     await callback.answer(f"🟢 Персонаж улучшен до уровня {next_level}!", show_alert=True)
     await callback.answer(f"🟢 Персонаж улучшен до уровня {next_level}!", show_alert=True)
     await show_char_level(callback.message, user_id, char_id, page, idx)
@@ -479,7 +496,7 @@ async def cmd_skill(message: Message):
         await message.answer("🔴 Персонаж не найден")
         return
     
-    user_char = get_user_character(message.from_user.id, char_id)
+    user_char = await get_user_character_async(message.from_user.id, char_id)
     if not user_char:
         await message.answer("🔴 У вас нет этого персонажа")
         return
@@ -490,21 +507,25 @@ async def cmd_skill(message: Message):
     
     ability = char['abilities'][ability_idx]
     
-    # Calculate current total weight
-    current_slots = get_user_skill_slots(message.from_user.id, char_id)
-    total_weight = 0
-    for s, a_idx in current_slots.items():
-        if int(s) != slot:  # Don't count the slot we're replacing
-            total_weight += char['abilities'][a_idx]['weight']
-    
-    if total_weight + ability['weight'] > MAX_ABILITY_WEIGHT:
+    async with transaction(message.from_user.id) as tx:
+        # Calculate current total weight
+        current_slots = tx.get_skill_slots(char_id)
+        total_weight = 0
+        for s, a_idx in current_slots.items():
+            if int(s) != slot:  # Don't count the slot we're replacing
+                total_weight += char['abilities'][a_idx]['weight']
+        
+        too_heavy = total_weight + ability['weight'] > MAX_ABILITY_WEIGHT
+        if not too_heavy:
+            tx.set_skill_slot(char_id, slot, ability_idx)
+            
+            # Check for 0-energy ability
+            updated_slots = tx.get_skill_slots(char_id)
+    
+    if too_heavy:
         await message.answer(f"🔴 Вам не хватает максимального веса для добавления этой способности\nТекущий вес: {total_weight}, максимальный: {MAX_ABILITY_WEIGHT}")
         return
     
-    set_user_skill_slot(message.from_user.id, char_id, slot, ability_idx)
-    
-    # Check for 0-energy ability
-    updated_slots = get_user_skill_slots(message.from_user.id, char_id)
     has_zero_energy = False
     for s_idx in updated_slots.values():
          if char['abilities'][s_idx]['energy_cost'] == 0:
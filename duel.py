@@ -3,31 +3,43 @@ Duel system for Soul Meter bot
 Contains /duels, /frienduel, /s commands and battle logic
 """
 import asyncio
-import random
+import os
+import time
 from typing import Dict, Optional
-from datetime import datetime, timedelta
+from datetime import datetime
 
 from aiogram import Router, F, Bot
 from aiogram.filters import Command
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile, InputMediaAnimation
+from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, InputMediaAnimation
 from aiogram.enums import ContentType
 
 from storage import (
-    get_user, save_user, get_user_characters, get_user_character,
-    get_user_skill_slots, add_to_duel_queue, remove_from_duel_queue,
-    get_queue_match, create_duel, get_active_duel, end_duel, active_duels
+    add_to_duel_queue, remove_from_duel_queue,
+    get_queue_match, create_duel, get_active_duel, end_duel, active_duels,
+    transaction, peek_user_async, get_user_character_async, get_user_skill_slots_async,
+    save_duel, save_pending_duel, drop_pending_duel, match_duel_queue, duel_queue
 )
+from matchmaking import MATCH_TICK_INTERVAL, MATCH_QUEUE_TIMEOUT, rating_of
+from timers import timers
+from media import media_cache, is_file_id_error
 from char import (
-    CHARACTERS, get_character, calculate_stats_for_level,
+    get_character,
     EFFECT_DAMAGE, EFFECT_HEAL, EFFECT_DEFENSE_BUFF, EFFECT_ATTACK_BUFF
 )
-from utils import calculate_damage, apply_defense
+from duel_engine import SideState, ActionResult, ERROR_NO_ABILITY, ERROR_NO_ENERGY, engine as duel_engine
 
 router = Router()
+
+# Timeouts in seconds, all served by the single timers.timers task
+DUEL_ACCEPT_TIMEOUT = float(os.getenv('DUEL_ACCEPT_TIMEOUT', '60'))
+DUEL_TURN_TIMEOUT = float(os.getenv('DUEL_TURN_TIMEOUT', '120'))
+DUEL_MAX_MISSED_TURNS = int(os.getenv('DUEL_MAX_MISSED_TURNS', '2'))  # Timed out turns in a row that lose the duel
+FRIEND_CHALLENGE_TIMEOUT = float(os.getenv('FRIEND_CHALLENGE_TIMEOUT', '300'))
+
     
-def has_zero_energy_ability(user_id: int, char_id: str) -> bool:
+async def has_zero_energy_ability(user_id: int, char_id: str) -> bool:
     """Check if user has at least one 0-energy ability equipped"""
-    slots = get_user_skill_slots(user_id, char_id)
+    slots = await get_user_skill_slots_async(user_id, char_id)
     char = get_character(char_id)
     if not char or not slots:
         return False
@@ -63,56 +75,33 @@ async def check_duel_callback(callback: CallbackQuery, duel: dict) -> bool:
     return True
 
 
+def _change_str(value: int) -> str:
+    return f" <code>{value:+d}</code>" if value != 0 else ""
+
+
+def _abilities_text(side: SideState) -> str:
+    char = get_character(side.char_id)
+    if not char or not side.slots:
+        return ""
+    abilities = []
+    for slot, abil_idx in sorted(side.slots.items(), key=lambda x: int(x[0])):
+        abil = char['abilities'][abil_idx]
+        abilities.append(f"{slot}. {abil['name']}")
+    return " ".join(abilities)
+
+
 def get_duel_message(duel: dict, user_id: int = None, bot_instance: Bot = None) -> str:
     """Generate duel status message for a user"""
     is_friendly = duel.get('is_friendly', False)
+    state = duel['state']
     
     # For friendly duels, show both players' stats without "my/opponent" perspective
     if is_friendly:
-        user1_hp = duel['user1_hp']
-        user1_energy = duel['user1_energy']
-        user1_char_id = duel['user1_char']
-        user1_slots = duel['user1_slots']
-        
-        user2_hp = duel['user2_hp']
-        user2_energy = duel['user2_energy']
-        user2_char_id = duel['user2_char']
-        user2_slots = duel['user2_slots']
-        
-        char1 = get_character(user1_char_id)
-        char2 = get_character(user2_char_id)
-        
-        # Damage/energy change indicators
-        user1_dmg = duel['last_damage'].get(duel['user1_id'], 0)
-        user2_dmg = duel['last_damage'].get(duel['user2_id'], 0)
-        user1_eng_change = duel['last_energy_change'].get(duel['user1_id'], 0)
-        user2_eng_change = duel['last_energy_change'].get(duel['user2_id'], 0)
+        side1, side2 = state.a, state.b
+        char1 = get_character(side1.char_id)
+        char2 = get_character(side2.char_id)
         
-        user1_dmg_str = f" <code>{user1_dmg:+d}</code>" if user1_dmg != 0 else ""
-        user2_dmg_str = f" <code>{user2_dmg:+d}</code>" if user2_dmg != 0 else ""
-        user1_eng_str = f" <code>{user1_eng_change:+d}</code>" if user1_eng_change != 0 else ""
-        user2_eng_str = f" <code>{user2_eng_change:+d}</code>" if user2_eng_change != 0 else ""
-        
-        # User1 abilities
-        user1_abilities_text = ""
-        if char1 and user1_slots:
-            abilities = []
-            for slot, abil_idx in sorted(user1_slots.items(), key=lambda x: int(x[0])):
-                abil = char1['abilities'][abil_idx]
-                abilities.append(f"{slot}. {abil['name']}")
-            user1_abilities_text = " ".join(abilities)
-        
-        # User2 abilities
-        user2_abilities_text = ""
-        if char2 and user2_slots:
-            abilities = []
-            for slot, abil_idx in sorted(user2_slots.items(), key=lambda x: int(x[0])):
-                abil = char2['abilities'][abil_idx]
-                abilities.append(f"{slot}. {abil['name']}")
-            user2_abilities_text = " ".join(abilities)
-        
-        is_user1_turn = duel['current_turn'] == duel['user1_id']
-        turn_text = "<b><i>❗Ход игрока 1</i></b>" if is_user1_turn else "<b><i>❗Ход игрока 2</i></b>"
+        turn_text = "<b><i>❗Ход игрока 1</i></b>" if state.turn == 0 else "<b><i>❗Ход игрока 2</i></b>"
         
         log_text = f"{duel['last_action_log']}" if duel.get('last_action_log') else ""
         
@@ -122,19 +111,19 @@ def get_duel_message(duel: dict, user_id: int = None, bot_instance: Bot = None)
 
 <blockquote><b>Игрок 1
 🟢 Активный персонаж ›› {char1['name_ru']}
-❤️ Здоровье ›› {user1_hp}{user1_dmg_str}
-⚡️ Энергия ›› {user1_energy}/10{user1_eng_str}
+❤️ Здоровье ›› {side1.hp}{_change_str(side1.hp_change)}
+⚡️ Энергия ›› {side1.energy}/10{_change_str(side1.energy_change)}
 
 ✨ Способности
-{user1_abilities_text}</b></blockquote>
+{_abilities_text(side1)}</b></blockquote>
 
 <blockquote><i>Игрок 2
 🟢 Активный персонаж ›› {char2['name_ru']}
-❤️ Здоровье ›› {user2_hp}{user2_dmg_str}
-⚡️ Энергия ›› {user2_energy}/10{user2_eng_str}
+❤️ Здоровье ›› {side2.hp}{_change_str(side2.hp_change)}
+⚡️ Энергия ›› {side2.energy}/10{_change_str(side2.energy_change)}
 
 ✨ Способности
-{user2_abilities_text}</i></blockquote>
+{_abilities_text(side2)}</i></blockquote>
 
 {log_text}
 {turn_text}"""
@@ -142,52 +131,13 @@ def get_duel_message(duel: dict, user_id: int = None, bot_instance: Bot = None)
         return text
     
     # Regular duel - show from user's perspective
-    is_user1 = user_id == duel['user1_id']
-    
-    my_hp = duel['user1_hp'] if is_user1 else duel['user2_hp']
-    my_energy = duel['user1_energy'] if is_user1 else duel['user2_energy']
-    my_char_id = duel['user1_char'] if is_user1 else duel['user2_char']
-    my_slots = duel['user1_slots'] if is_user1 else duel['user2_slots']
-    
-    opp_hp = duel['user2_hp'] if is_user1 else duel['user1_hp']
-    opp_energy = duel['user2_energy'] if is_user1 else duel['user1_energy']
-    opp_char_id = duel['user2_char'] if is_user1 else duel['user1_char']
-    opp_slots = duel['user2_slots'] if is_user1 else duel['user1_slots']
+    me = state.side(user_id)
+    opp = state.other(user_id)
     
-    my_char = get_character(my_char_id)
-    opp_char = get_character(opp_char_id)
+    my_char = get_character(me.char_id)
+    opp_char = get_character(opp.char_id)
     
-    # Damage/energy change indicators
-    my_dmg = duel['last_damage'].get(user_id, 0)
-    opp_id = duel['user2_id'] if is_user1 else duel['user1_id']
-    opp_dmg = duel['last_damage'].get(opp_id, 0)
-    my_eng_change = duel['last_energy_change'].get(user_id, 0)
-    opp_eng_change = duel['last_energy_change'].get(opp_id, 0)
-    
-    my_dmg_str = f" <code>{my_dmg:+d}</code>" if my_dmg != 0 else ""
-    opp_dmg_str = f" <code>{opp_dmg:+d}</code>" if opp_dmg != 0 else ""
-    my_eng_str = f" <code>{my_eng_change:+d}</code>" if my_eng_change != 0 else ""
-    opp_eng_str = f" <code>{opp_eng_change:+d}</code>" if opp_eng_change != 0 else ""
-    
-    # My abilities
-    my_abilities_text = ""
-    if my_char and my_slots:
-        abilities = []
-        for slot, abil_idx in sorted(my_slots.items(), key=lambda x: int(x[0])):
-            abil = my_char['abilities'][abil_idx]
-            abilities.append(f"{slot}. {abil['name']}")
-        my_abilities_text = " ".join(abilities)
-    
-    # Opponent abilities
-    opp_abilities_text = ""
-    if opp_char and opp_slots:
-        abilities = []
-        for slot, abil_idx in sorted(opp_slots.items(), key=lambda x: int(x[0])):
-            abil = opp_char['abilities'][abil_idx]
-            abilities.append(f"{slot}. {abil['name']}")
-        opp_abilities_text = " ".join(abilities)
-    
-    is_my_turn = duel['current_turn'] == user_id
+    is_my_turn = state.current.user_id == user_id
     turn_text = "<b><i>❗Ваш ход</i></b>" if is_my_turn else "<b><i>❗Ход противника</i></b>"
     
     log_text = f"\n\n{duel['last_action_log']}" if duel.get('last_action_log') else ""
@@ -198,19 +148,19 @@ def get_duel_message(duel: dict, user_id: int = None, bot_instance: Bot = None)
 
 <blockquote><b>Вы
 🟢 Активный персонаж ›› {my_char['name_ru']}
-❤️ Здоровье ›› {my_hp}{my_dmg_str}
-⚡️ Энергия ›› {my_energy}/10{my_eng_str}
+❤️ Здоровье ›› {me.hp}{_change_str(me.hp_change)}
+⚡️ Энергия ›› {me.energy}/10{_change_str(me.energy_change)}
 
 ✨ Способности
-{my_abilities_text}</b></blockquote>
+{_abilities_text(me)}</b></blockquote>
 
 <blockquote><i>Ваш противник
 🟢 Активный персонаж ›› {opp_char['name_ru']}
-❤️ Здоровье ›› {opp_hp}{opp_dmg_str}
-⚡️ Энергия ›› {opp_energy}/10{opp_eng_str}
+❤️ Здоровье ›› {opp.hp}{_change_str(opp.hp_change)}
+⚡️ Энергия ›› {opp.energy}/10{_change_str(opp.energy_change)}
 
 ✨ Способности
-{opp_abilities_text}</i></blockquote>
+{_abilities_text(opp)}</i></blockquote>
 
 {log_text}
 {turn_text}"""
@@ -221,63 +171,30 @@ def get_duel_message(duel: dict, user_id: int = None, bot_instance: Bot = None)
 def get_duel_keyboard(duel: dict, user_id: int = None) -> InlineKeyboardMarkup:
     """Generate ability buttons for duel"""
     is_friendly = duel.get('is_friendly', False)
+    state = duel['state']
     
-    if is_friendly:
-        # For friendly duels, show buttons for current turn player
-        # Use special callback format that allows any participant to click
-        current_turn_id = duel['current_turn']
-        is_user1_turn = current_turn_id == duel['user1_id']
-        
-        char_id = duel['user1_char'] if is_user1_turn else duel['user2_char']
-        slots = duel['user1_slots'] if is_user1_turn else duel['user2_slots']
-        
-        char = get_character(char_id)
-        if not char or not slots:
-            return InlineKeyboardMarkup(inline_keyboard=[])
-        
-        buttons = []
-        row = []
-        
-        sorted_slots = sorted(slots.items(), key=lambda x: int(x[0]))
-        
-        for i, (slot, abil_idx) in enumerate(sorted_slots):
-            abil = char['abilities'][abil_idx]
-            btn_text = f"{slot}⚡{abil['energy_cost']}"
-            # Use "fduelact" callback for friendly duels - checks turn, not user_id
-            row.append(InlineKeyboardButton(
-                text=btn_text,
-                callback_data=f"fduelact:{duel['user1_id']}:{slot}"
-            ))
-            if len(row) == 3:
-                buttons.append(row)
-                row = []
-        
-        if row:
-            buttons.append(row)
-        
-        return InlineKeyboardMarkup(inline_keyboard=buttons)
+    # Friendly duels show the buttons of the player whose turn it is, ranked
+    # duels the buttons of the player viewing the message
+    side = state.current if is_friendly else state.side(user_id)
     
-    # Regular duel
-    is_user1 = user_id == duel['user1_id']
-    my_char_id = duel['user1_char'] if is_user1 else duel['user2_char']
-    my_slots = duel['user1_slots'] if is_user1 else duel['user2_slots']
-    
-    char = get_character(my_char_id)
-    if not char or not my_slots:
+    char = get_character(side.char_id)
+    if not char or not side.slots:
         return InlineKeyboardMarkup(inline_keyboard=[])
     
     buttons = []
     row = []
     
-    sorted_slots = sorted(my_slots.items(), key=lambda x: int(x[0]))
+    sorted_slots = sorted(side.slots.items(), key=lambda x: int(x[0]))
     
     for i, (slot, abil_idx) in enumerate(sorted_slots):
         abil = char['abilities'][abil_idx]
         btn_text = f"{slot}⚡{abil['energy_cost']}"
-        row.append(InlineKeyboardButton(
-            text=btn_text,
-            callback_data=make_callback("duelact", user_id, f"{slot}")
-        ))
+        if is_friendly:
+            # "fduelact" checks whose turn it is, not who the message is for
+            callback_data = f"fduelact:{duel['user1_id']}:{slot}"
+        else:
+            callback_data = make_callback("duelact", user_id, f"{slot}")
+        row.append(InlineKeyboardButton(text=btn_text, callback_data=callback_data))
         if len(row) == 3:
             buttons.append(row)
             row = []
@@ -287,26 +204,66 @@ def get_duel_keyboard(duel: dict, user_id: int = None) -> InlineKeyboardMarkup:
     
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
+
+def format_action_log(name: str, result: ActionResult) -> str:
+    """Log line under the duel message for the action just played"""
+    ability = result.ability
+    used = f"{name} использовал {ability['name']} -{ability['energy_cost']}⚡"
+    effect_type = ability.get('effect_type', '')
+    if effect_type == EFFECT_DAMAGE:
+        return f"<i>{used} и нанес {result.damage} урона</i>"
+    if effect_type == EFFECT_HEAL:
+        return f"<i>{used} и восстановил {result.heal} здоровья</i>"
+    if effect_type in (EFFECT_DEFENSE_BUFF, EFFECT_ATTACK_BUFF):
+        return f"<i>{used}</i>"
+    return ""
+
+
+ACTION_ERRORS = {
+    ERROR_NO_ABILITY: "🔴 Способность не найдена",
+    ERROR_NO_ENERGY: "🔴 Недостаточно энергии",
+}
+
+
+async def start_duel(duel: dict) -> bool:
+    """Set up both sides from the players' active characters, user1 moves first
+    False if the duel was ended or started elsewhere while the players were loaded.
+    """
+    sides = []
+    for user_id in (duel['user1_id'], duel['user2_id']):
+        user = await peek_user_async(user_id)
+        user_char = await get_user_character_async(user_id, user['active_char'])
+        slots = await get_user_skill_slots_async(user_id, user['active_char'])
+        sides.append(duel_engine.new_side(user_id, user['active_char'], user_char.get('level', 1), slots))
+    
+    if get_active_duel(duel['user1_id']) is not duel or duel['status'] != 'pending':
+        return False
+    duel['state'] = duel_engine.new_duel(*sides)
+    duel['status'] = 'active'
+    return True
+
 async def update_duel_interface(callback: CallbackQuery, text: str, keyboard: InlineKeyboardMarkup, gif_path: str = None):
     """Helper to handle Text <-> Animation transitions in duel interface"""
     try:
         # Determine if we need to show animation or text
         if gif_path:
              # We want to show Animation
-             media = InputMediaAnimation(media=FSInputFile(gif_path), caption=text)
+             # Uploaded once, then sent by the file_id from media_cache
+             media = InputMediaAnimation(media=media_cache.input_file(gif_path), caption=text)
              
              if callback.message.content_type == ContentType.ANIMATION:
                  # Animation -> Animation: Edit media
-                 await callback.message.edit_media(media=media, reply_markup=keyboard)
+                 media_cache.remember(gif_path, await callback.message.edit_media(media=media, reply_markup=keyboard))
              else:
                  # Text/Photo/Video -> Animation: Delete and Send
                  # (Photo/Video -> Animation *might* work with edit_media but Delete/Send is safer for aspect ratios etc)
                  # Actually edit_media works fine between visual types usually, but let's be safe if coming from Text
                  if callback.message.content_type in [ContentType.PHOTO, ContentType.VIDEO]:
-                      await callback.message.edit_media(media=media, reply_markup=keyboard)
+                      sent = await callback.message.edit_media(media=media, reply_markup=keyboard)
                  else:
                       await callback.message.delete()
-                      await callback.message.answer_animation(animation=FSInputFile(gif_path), caption=text, reply_markup=keyboard)
+                      sent = await callback.message.answer_animation(animation=media_cache.input_file(gif_path), caption=text, reply_markup=keyboard)
+                 media_cache.remember(gif_path, sent)
         else:
              # We want to show Text
              if callback.message.content_type == ContentType.TEXT:
@@ -319,6 +276,8 @@ async def update_duel_interface(callback: CallbackQuery, text: str, keyboard: In
                  
     except Exception as e:
         print(f"Error updating duel interface: {e}")
+        if gif_path and is_file_id_error(e):
+            media_cache.forget(gif_path)  # Stale file_id, upload again next time
         # Fallback to simple answer if something breaks
         try:
             await callback.message.answer(text, reply_markup=keyboard)
@@ -326,6 +285,133 @@ async def update_duel_interface(callback: CallbackQuery, text: str, keyboard: In
             pass
 
 
+async def award_ranked_win(duel: dict, winner_id: int, loser_id: int) -> tuple:
+    """Apply ranked rewards rolled from the duel RNG, so the duel log replays them
+    Returns (trophies gained, souls gained) of the winner.
+    """
+    trophy_gain, trophy_loss, soul_reward = duel_engine.roll_rewards(duel['state'])
+    duel['rewards'] = [trophy_gain, trophy_loss, soul_reward]
+    
+    async with transaction(winner_id) as tx:
+        tx.user['trophies'] += trophy_gain
+        tx.user['souls'] += soul_reward
+    
+    async with transaction(loser_id) as tx:
+        tx.user['trophies'] = max(0, tx.user['trophies'] - trophy_loss)
+    
+    return trophy_gain, soul_reward
+
+
+async def send_to_player(bot: Bot, user_id: int, text: str, keyboard: InlineKeyboardMarkup = None) -> None:
+    try:
+        await bot.send_message(user_id, text, reply_markup=keyboard)
+    except Exception:
+        pass  # Player may have blocked the bot
+
+
+# ==================== Timeouts ====================
+def duel_timer_key(duel: dict) -> tuple:
+    return ('duel', duel['user1_id'])
+
+
+def arm_duel_timer(bot: Bot, duel: dict) -> None:
+    """(Re)start the deadline to accept a matched duel or to play the current turn"""
+    delay = DUEL_ACCEPT_TIMEOUT if duel['status'] == 'pending' else DUEL_TURN_TIMEOUT
+    timers.schedule(duel_timer_key(duel), delay, on_duel_timeout, bot, duel)
+
+
+async def on_duel_timeout(bot: Bot, duel: dict) -> None:
+    """Drop an unaccepted duel, skip a timed out turn or forfeit after DUEL_MAX_MISSED_TURNS in a row"""
+    if get_active_duel(duel['user1_id']) is not duel:
+        return  # Ended meanwhile
+    is_friendly = duel.get('is_friendly', False)
+    players = (duel['user1_id'], duel['user2_id'])
+    
+    if duel['status'] == 'pending':
+        end_duel(duel['user1_id'])
+        for user_id in players:
+            await send_to_player(bot, user_id, "<i>⏰ Дуэль не была принята вовремя</i>")
+        return
+    
+    state = duel['state']
+    if duel['status'] != 'active' or state.winner is not None:
+        return  # Won while the timer was due
+    if state.current.missed + 1 >= DUEL_MAX_MISSED_TURNS:
+        loser_id = state.current.user_id
+        winner_id = duel_engine.forfeit(state)
+        duel['status'] = 'finished'
+        
+        if is_friendly:
+            end_duel(winner_id)
+            if duel.get('message'):
+                await duel['message'].answer("⚔️ <b>Дуэль закончилась: игрок не сделал ход вовремя</b>")
+            return
+        
+        trophy_gain, soul_reward = await award_ranked_win(duel, winner_id, loser_id)
+        end_duel(winner_id)
+        await send_to_player(bot, winner_id, f"""🏆 <b>Дуэль окончена!</b>
+
+<i>Противник не сделал ход вовремя, победа засчитана вам</i>
+
+🏆 +{trophy_gain} трофеев
+🧿 +{soul_reward} душ""")
+        await send_to_player(bot, loser_id, """🔴 <b>Дуэль окончена!</b>
+
+<i>Вы не сделали ход вовремя, победа засчитана противнику</i>""")
+        return
+    
+    duel_engine.skip_turn(state)
+    duel['last_action_log'] = "<i>⏰ Время хода истекло, ход переходит сопернику</i>"
+    save_duel(duel)
+    arm_duel_timer(bot, duel)
+    
+    if is_friendly:
+        if duel.get('message'):
+            await duel['message'].answer(get_duel_message(duel, None), reply_markup=get_duel_keyboard(duel, None))
+    else:
+        for user_id in players:
+            await send_to_player(bot, user_id, get_duel_message(duel, user_id), get_duel_keyboard(duel, user_id))
+
+
+async def on_challenge_timeout(target_id: int, challenge: dict, message: Optional[Message]) -> None:
+    """Expire a friendly challenge nobody answered"""
+    if pending_friendly_duels.get(target_id) is not challenge:
+        return  # Answered meanwhile
+    pending_friendly_duels.pop(target_id)
+    drop_pending_duel(target_id)
+    if message:
+        try:
+            await message.edit_text("<i>⏰ Вызов истёк</i>")
+        except Exception:
+            pass  # Message was deleted
+
+
+async def on_queue_timeout(bot: Bot, user_id: int) -> None:
+    """Stop searching for a player nobody was matched with"""
+    if user_id not in duel_queue:
+        return
+    remove_from_duel_queue(user_id)
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🟢 Начать подбор", callback_data=make_callback("duelstart", user_id))]
+    ])
+    await send_to_player(bot, user_id, "<i>⏰ Противник не найден, подбор остановлен</i>", keyboard)
+
+
+def arm_restored_timers(bot: Bot) -> None:
+    """Schedule the deadlines of duels, challenges and queue entries restored by storage.load_duels"""
+    for duel in {id(duel): duel for duel in active_duels.values()}.values():
+        arm_duel_timer(bot, duel)
+    
+    now = datetime.now()
+    for target_id, challenge in pending_friendly_duels.items():
+        left = FRIEND_CHALLENGE_TIMEOUT - (now - challenge['created_at']).total_seconds()
+        timers.schedule(('challenge', target_id), max(0.0, left), on_challenge_timeout, target_id, challenge, None)
+    
+    for entry in duel_queue:
+        left = MATCH_QUEUE_TIMEOUT - (time.time() - entry.joined)
+        timers.schedule(('queue', entry.user_id), max(0.0, left), on_queue_timeout, bot, entry.user_id)
+
+
 # ==================== /duels ====================
 @router.message(Command("duels"))
 async def cmd_duels(message: Message):
@@ -340,6 +426,35 @@ async def cmd_duels(message: Message):
     await message.answer(text, reply_markup=keyboard)
 
 
+MATCH_FOUND_TEXT = "<i>⚔️ Противник найден!</i>"
+
+
+def get_match_keyboard(user_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text="🟢 Принять", callback_data=make_callback("duelaccept", user_id)),
+            InlineKeyboardButton(text="🔴 Отклонить", callback_data=make_callback("duelreject", user_id))
+        ]
+    ])
+
+
+async def notify_match(bot: Bot, user_id: int) -> None:
+    """Send the accept/reject buttons to a player who was waiting in the queue"""
+    await send_to_player(bot, user_id, MATCH_FOUND_TEXT, get_match_keyboard(user_id))
+
+
+async def run_matchmaking(bot: Bot, interval: float = MATCH_TICK_INTERVAL) -> None:
+    """Pair queued players as their rating windows widen, until cancelled"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            for user_id, opponent_id in match_duel_queue():
+                arm_duel_timer(bot, create_duel(user_id, opponent_id))
+                await asyncio.gather(notify_match(bot, user_id), notify_match(bot, opponent_id))
+        except Exception as e:
+            print(f"Error matching duels: {e}")
+
+
 @router.callback_query(F.data.startswith("duelstart:"))
 async def callback_duel_start(callback: CallbackQuery):
     _, user_id, _ = parse_callback(callback.data)
@@ -354,18 +469,18 @@ async def callback_duel_start(callback: CallbackQuery):
         return
     
     # Check if user has active character
-    user = get_user(user_id)
-    if not user.get('active_char'):
+    user = await peek_user_async(user_id)
+    if not user or not user.get('active_char'):
         await callback.answer("🔴 Сначала выберите персонажа командой /char", show_alert=True)
         return
     
     # Check if user has skills equipped
-    slots = get_user_skill_slots(user_id, user['active_char'])
+    slots = await get_user_skill_slots_async(user_id, user['active_char'])
     if not slots:
         await callback.answer("🔴 Сначала выберите способности командой /skill", show_alert=True)
         return
     
-    if not has_zero_energy_ability(user_id, user['active_char']):
+    if not await has_zero_energy_ability(user_id, user['active_char']):
          await callback.answer("🔴 Выберите хотя бы одну способность за 0 энергии", show_alert=True)
          return
     
@@ -374,42 +489,22 @@ async def callback_duel_start(callback: CallbackQuery):
         await callback.answer("🔴 Вы уже в дуэли", show_alert=True)
         return
     
-    # Try to find opponent
-    opponent_id = get_queue_match(user_id)
+    # Try to find opponent close in trophies
+    rating = rating_of(user)
+    opponent_id = get_queue_match(user_id, rating)
     
     if opponent_id:
-        # Match found
-        remove_from_duel_queue(opponent_id)
-        duel = create_duel(user_id, opponent_id)
-        
-        # Get opponent info
-        opponent_user = get_user(opponent_id)
+        # Match found, create_duel takes the opponent out of the queue
+        arm_duel_timer(callback.bot, create_duel(user_id, opponent_id))
         
-        text = f"<i>⚔️ Противник найден!</i>"
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [
-                InlineKeyboardButton(text="🟢 Принять", callback_data=make_callback("duelaccept", user_id)),
-                InlineKeyboardButton(text="🔴 Отклонить", callback_data=make_callback("duelreject", user_id))
-            ]
-        ])
-        
-        await callback.message.edit_text(text, reply_markup=keyboard)
+        await callback.message.edit_text(MATCH_FOUND_TEXT, reply_markup=get_match_keyboard(user_id))
         
         # Notify opponent as well
-        try:
-            opponent_text = f"<i>⚔️ Противник найден!</i>"
-            opponent_keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [
-                    InlineKeyboardButton(text="🟢 Принять", callback_data=make_callback("duelaccept", opponent_id)),
-                    InlineKeyboardButton(text="🔴 Отклонить", callback_data=make_callback("duelreject", opponent_id))
-                ]
-            ])
-            await callback.bot.send_message(opponent_id, opponent_text, reply_markup=opponent_keyboard)
-        except Exception:
-            pass  # Opponent may have blocked the bot
+        await notify_match(callback.bot, opponent_id)
     else:
-        # Add to queue
-        add_to_duel_queue(user_id)
+        # Add to queue, run_matchmaking pairs the player once the rating window is wide enough
+        add_to_duel_queue(user_id, rating)
+        timers.schedule(('queue', user_id), MATCH_QUEUE_TIMEOUT, on_queue_timeout, callback.bot, user_id)
         
         text = "🗡️ <i>Идёт подбор противника</i>"
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -430,6 +525,7 @@ async def callback_duel_cancel(callback: CallbackQuery):
         return
     
     remove_from_duel_queue(user_id)
+    timers.cancel(('queue', user_id))
     
     # Return to duels menu
     text = """❗<b>Информация о дуэлях</b>
@@ -456,35 +552,11 @@ async def callback_duel_accept(callback: CallbackQuery):
     if not await check_duel_callback(callback, duel):
         return
     
-    # Initialize duel
-    user1 = get_user(duel['user1_id'])
-    user2 = get_user(duel['user2_id'])
-    
-    char1 = get_character(user1['active_char'])
-    char2 = get_character(user2['active_char'])
-    
-    user1_char = get_user_character(duel['user1_id'], user1['active_char'])
-    user2_char = get_user_character(duel['user2_id'], user2['active_char'])
-    
-    stats1 = calculate_stats_for_level(user1['active_char'], user1_char.get('level', 1))
-    stats2 = calculate_stats_for_level(user2['active_char'], user2_char.get('level', 1))
-    
-    duel['user1_hp'] = stats1['hp']
-    duel['user2_hp'] = stats2['hp']
-    duel['user1_energy'] = 10
-    duel['user2_energy'] = 10
-    duel['user1_char'] = user1['active_char']
-    duel['user2_char'] = user2['active_char']
-    duel['user1_slots'] = get_user_skill_slots(duel['user1_id'], user1['active_char'])
-    duel['user2_slots'] = get_user_skill_slots(duel['user2_id'], user2['active_char'])
-    duel['user1_stats'] = stats1
-    duel['user2_stats'] = stats2
-    duel['user1_buffs'] = {'attack': 0, 'defense': 0}
-    duel['user2_buffs'] = {'attack': 0, 'defense': 0}
-    duel['status'] = 'active'
-    duel['current_turn'] = duel['user1_id']  # User1 goes first
-    duel['user1_level'] = user1_char.get('level', 1)
-    duel['user2_level'] = user2_char.get('level', 1)
+    if not await start_duel(duel):
+        await callback.answer("🔴 Дуэль не найдена", show_alert=True)
+        return
+    save_duel(duel)
+    arm_duel_timer(callback.bot, duel)
     
     # Show duel interface
     text = get_duel_message(duel, callback.from_user.id)
@@ -500,6 +572,7 @@ async def callback_duel_reject(callback: CallbackQuery):
     
     duel = get_active_duel(callback.from_user.id)
     if duel:
+        timers.cancel(duel_timer_key(duel))
         end_duel(callback.from_user.id)
     
     # Return to duels menu
@@ -528,119 +601,27 @@ async def callback_duel_action(callback: CallbackQuery):
         await callback.answer("🔴 Дуэль не активна", show_alert=True)
         return
     
-    if duel['current_turn'] != user_id:
+    state = duel['state']
+    if state.current.user_id != user_id:
         await callback.answer("🔴 Сейчас не ваш ход", show_alert=True)
         return
     
-    is_user1 = user_id == duel['user1_id']
-    my_char_id = duel['user1_char'] if is_user1 else duel['user2_char']
-    my_slots = duel['user1_slots'] if is_user1 else duel['user2_slots']
-    my_energy_key = 'user1_energy' if is_user1 else 'user2_energy'
-    opp_hp_key = 'user2_hp' if is_user1 else 'user1_hp'
-    my_hp_key = 'user1_hp' if is_user1 else 'user2_hp'
-    my_buffs_key = 'user1_buffs' if is_user1 else 'user2_buffs'
-    opp_buffs_key = 'user2_buffs' if is_user1 else 'user1_buffs'
-    my_stats_key = 'user1_stats' if is_user1 else 'user2_stats'
-    opp_stats_key = 'user2_stats' if is_user1 else 'user1_stats'
-    opp_id = duel['user2_id'] if is_user1 else duel['user1_id']
-    
-    char = get_character(my_char_id)
-    if not char:
+    opp_id = state.opponent.user_id
+    result = duel_engine.apply_action(state, slot_str)
+    if result.error:
+        await callback.answer(ACTION_ERRORS[result.error], show_alert=True)
         return
     
-    slot = slot_str
-    if slot not in my_slots:
-        await callback.answer("🔴 Способность не найдена", show_alert=True)
-        return
-    
-    abil_idx = my_slots[slot]
-    ability = char['abilities'][abil_idx]
-    
-    # Check energy
-    if duel[my_energy_key] < ability['energy_cost']:
-        await callback.answer("🔴 Недостаточно энергии", show_alert=True)
-        return
-    
-    # Reset last changes
-    duel['last_damage'] = {user_id: 0, opp_id: 0}
-    duel['last_energy_change'] = {user_id: 0, opp_id: 0}
-    
-    # Apply ability
-    duel[my_energy_key] -= ability['energy_cost']
-    duel['last_energy_change'][user_id] = -ability['energy_cost']
-    
-    if ability.get('energy_restore', 0) > 0:
-        restore = ability['energy_restore']
-        duel[my_energy_key] = min(10, duel[my_energy_key] + restore)
-        duel['last_energy_change'][user_id] += restore
-    
-    effect_type = ability.get('effect_type', '')
+    ability = result.ability
+    duel['last_action_log'] = format_action_log(callback.from_user.first_name, result)
     
-    action_log = ""
-    
-    if effect_type == EFFECT_DAMAGE:
-        base_dmg = ability['effect_value']
-        
-        # Apply level scaling
-        my_level_key = 'user1_level' if is_user1 else 'user2_level'
-        level = duel.get(my_level_key, 1)
-        for _ in range(1, level):
-            base_dmg = int(base_dmg / 0.9)
-            
-        attack_buff = duel[my_buffs_key]['attack']
-        defense_debuff = duel[opp_buffs_key]['defense']
-        opp_defense = duel[opp_stats_key]['defense']
-        
-        # Apply buffs
-        if attack_buff > 0:
-            base_dmg = int(base_dmg * (1 + attack_buff / 100))
-        
-        final_dmg = apply_defense(base_dmg, opp_defense, defense_debuff)
-        duel[opp_hp_key] -= final_dmg
-        duel['last_damage'][opp_id] = -final_dmg
-        
-        action_log = f"<i>{callback.from_user.first_name} использовал {ability['name']} -{ability['energy_cost']}⚡ и нанес {final_dmg} урона</i>"
-        
-    elif effect_type == EFFECT_HEAL:
-        heal = ability['effect_value']
-        max_hp = duel[my_stats_key]['hp']
-        old_hp = duel[my_hp_key]
-        duel[my_hp_key] = min(max_hp, duel[my_hp_key] + heal)
-        actual_heal = duel[my_hp_key] - old_hp
-        duel['last_damage'][user_id] = actual_heal
-        
-        action_log = f"<i>{callback.from_user.first_name} использовал {ability['name']} -{ability['energy_cost']}⚡ и восстановил {actual_heal} здоровья</i>"
-        
-    elif effect_type == EFFECT_DEFENSE_BUFF:
-        duel[opp_buffs_key]['defense'] += ability['effect_percent']
-        action_log = f"<i>{callback.from_user.first_name} использовал {ability['name']} -{ability['energy_cost']}⚡</i>"
-        
-    elif effect_type == EFFECT_ATTACK_BUFF:
-        duel[my_buffs_key]['attack'] += ability['effect_percent']
-        action_log = f"<i>{callback.from_user.first_name} использовал {ability['name']} -{ability['energy_cost']}⚡</i>"
-        
-    duel['last_action_log'] = action_log
-    
-    # Check win condition
-    if duel[opp_hp_key] <= 0:
+    if result.finished:
         duel['status'] = 'finished'
-        duel['winner'] = user_id
+        timers.cancel(duel_timer_key(duel))  # Before any await, so the turn can't time out on a won duel
         
         # Award trophies
         if not duel.get('is_friendly', False):
-            winner = get_user(user_id)
-            loser = get_user(opp_id)
-            
-            trophy_gain = random.randint(10, 30)
-            trophy_loss = random.randint(5, 15)
-            soul_reward = random.randint(50, 150)
-            
-            winner['trophies'] += trophy_gain
-            winner['souls'] += soul_reward
-            loser['trophies'] = max(0, loser['trophies'] - trophy_loss)
-            
-            save_user(winner)
-            save_user(loser)
+            trophy_gain, soul_reward = await award_ranked_win(duel, user_id, opp_id)
         
         text = f"""🏆 <b>Дуэль окончена!</b>
 
@@ -654,8 +635,8 @@ async def callback_duel_action(callback: CallbackQuery):
         await callback.answer("🏆 Победа!")
         return
     
-    # Switch turn
-    duel['current_turn'] = opp_id
+    save_duel(duel)
+    arm_duel_timer(callback.bot, duel)
     
     # Update message
     text = get_duel_message(duel, user_id)
@@ -685,17 +666,17 @@ async def cmd_frienduel(message: Message):
         return
     
     # Check if challenger has character
-    user = get_user(message.from_user.id)
-    if not user.get('active_char'):
+    user = await peek_user_async(message.from_user.id)
+    if not user or not user.get('active_char'):
         await message.answer("🔴 Сначала выберите персонажа командой /char")
         return
     
-    slots = get_user_skill_slots(message.from_user.id, user['active_char'])
+    slots = await get_user_skill_slots_async(message.from_user.id, user['active_char'])
     if not slots:
         await message.answer("🔴 Сначала выберите способности командой /skill")
         return
         
-    if not has_zero_energy_ability(message.from_user.id, user['active_char']):
+    if not await has_zero_energy_ability(message.from_user.id, user['active_char']):
         await message.answer("🔴 Вы не можете начать дуэль, так как у вас нет способности с 0 энергии")
         return
     
@@ -705,6 +686,7 @@ async def cmd_frienduel(message: Message):
         'challenger_name': message.from_user.first_name,
         'created_at': datetime.now()
     }
+    save_pending_duel(target.id, pending_friendly_duels[target.id])
     
     target_link = f'<a href="tg://user?id={target.id}">{target.first_name}</a>'
     
@@ -717,7 +699,11 @@ async def cmd_frienduel(message: Message):
         ]
     ])
     
-    await message.answer(text, reply_markup=keyboard)
+    sent = await message.answer(text, reply_markup=keyboard)
+    timers.schedule(
+        ('challenge', target.id), FRIEND_CHALLENGE_TIMEOUT, on_challenge_timeout,
+        target.id, pending_friendly_duels[target.id], sent
+    )
 
 
 @router.callback_query(F.data.startswith("friendaccept:"))
@@ -733,53 +719,34 @@ async def callback_friend_accept(callback: CallbackQuery):
         return
     
     pending = pending_friendly_duels.pop(target_id)
+    drop_pending_duel(target_id)
+    timers.cancel(('challenge', target_id))
     challenger_id = pending['challenger_id']
     
     # Check if target has character
-    user = get_user(target_id)
-    if not user.get('active_char'):
+    user = await peek_user_async(target_id)
+    if not user or not user.get('active_char'):
         await callback.answer("🔴 Сначала выберите персонажа командой /char", show_alert=True)
         return
     
-    slots = get_user_skill_slots(target_id, user['active_char'])
+    slots = await get_user_skill_slots_async(target_id, user['active_char'])
     if not slots:
         await callback.answer("🔴 Сначала выберите способности командой /skill", show_alert=True)
         return
 
-    if not has_zero_energy_ability(target_id, user['active_char']):
+    if not await has_zero_energy_ability(target_id, user['active_char']):
         await callback.answer("🔴 Вы не можете принять дуэль, так как у вас нет способности с 0 энергии", show_alert=True)
         return
     
     # Create friendly duel
     duel = create_duel(challenger_id, target_id, is_friendly=True)
     
-    # Initialize duel
-    user1 = get_user(challenger_id)
-    user2 = get_user(target_id)
-    
-    user1_char = get_user_character(challenger_id, user1['active_char'])
-    user2_char = get_user_character(target_id, user2['active_char'])
-    
-    stats1 = calculate_stats_for_level(user1['active_char'], user1_char.get('level', 1))
-    stats2 = calculate_stats_for_level(user2['active_char'], user2_char.get('level', 1))
-    
-    duel['user1_hp'] = stats1['hp']
-    duel['user2_hp'] = stats2['hp']
-    duel['user1_energy'] = 10
-    duel['user2_energy'] = 10
-    duel['user1_char'] = user1['active_char']
-    duel['user2_char'] = user2['active_char']
-    duel['user1_slots'] = get_user_skill_slots(challenger_id, user1['active_char'])
-    duel['user2_slots'] = get_user_skill_slots(target_id, user2['active_char'])
-    duel['user1_stats'] = stats1
-    duel['user2_stats'] = stats2
-    duel['user1_buffs'] = {'attack': 0, 'defense': 0}
-    duel['user2_buffs'] = {'attack': 0, 'defense': 0}
-    duel['status'] = 'active'
-    duel['current_turn'] = challenger_id
-    duel['user1_level'] = user1_char.get('level', 1)
-    duel['user2_level'] = user2_char.get('level', 1)
+    if not await start_duel(duel):
+        await callback.answer("🔴 Дуэль не найдена", show_alert=True)
+        return
     duel['message'] = callback.message
+    save_duel(duel)
+    arm_duel_timer(callback.bot, duel)
     
     text = get_duel_message(duel, target_id)
     keyboard = get_duel_keyboard(duel, target_id)
@@ -814,97 +781,23 @@ async def callback_friendly_duel_action(callback: CallbackQuery):
         return
     
     # Check if it's the current player's turn (not specific user)
-    if duel['current_turn'] != callback.from_user.id:
+    state = duel['state']
+    if state.current.user_id != callback.from_user.id:
         await callback.answer("🔴 Сейчас не ваш ход", show_alert=True)
         return
     
     user_id = callback.from_user.id
-    is_user1 = user_id == duel['user1_id']
-    my_char_id = duel['user1_char'] if is_user1 else duel['user2_char']
-    my_slots = duel['user1_slots'] if is_user1 else duel['user2_slots']
-    my_energy_key = 'user1_energy' if is_user1 else 'user2_energy'
-    opp_hp_key = 'user2_hp' if is_user1 else 'user1_hp'
-    my_hp_key = 'user1_hp' if is_user1 else 'user2_hp'
-    my_buffs_key = 'user1_buffs' if is_user1 else 'user2_buffs'
-    opp_buffs_key = 'user2_buffs' if is_user1 else 'user1_buffs'
-    my_stats_key = 'user1_stats' if is_user1 else 'user2_stats'
-    opp_stats_key = 'user2_stats' if is_user1 else 'user1_stats'
-    opp_id = duel['user2_id'] if is_user1 else duel['user1_id']
-    
-    char = get_character(my_char_id)
-    if not char:
-        return
-    
-    slot = slot_str
-    if slot not in my_slots:
-        await callback.answer("🔴 Способность не найдена", show_alert=True)
+    result = duel_engine.apply_action(state, slot_str)
+    if result.error:
+        await callback.answer(ACTION_ERRORS[result.error], show_alert=True)
         return
     
-    abil_idx = my_slots[slot]
-    ability = char['abilities'][abil_idx]
-    
-    # Check energy
-    if duel[my_energy_key] < ability['energy_cost']:
-        await callback.answer("🔴 Недостаточно энергии", show_alert=True)
-        return
-    
-    # Reset last changes
-    duel['last_damage'] = {duel['user1_id']: 0, duel['user2_id']: 0}
-    duel['last_energy_change'] = {duel['user1_id']: 0, duel['user2_id']: 0}
-    
-    # Apply ability
-    duel[my_energy_key] -= ability['energy_cost']
-    duel['last_energy_change'][user_id] = -ability['energy_cost']
-    
-    if ability.get('energy_restore', 0) > 0:
-        restore = ability['energy_restore']
-        duel[my_energy_key] = min(10, duel[my_energy_key] + restore)
-        duel['last_energy_change'][user_id] += restore
-    
-    effect_type = ability.get('effect_type', '')
-    
-    action_log = ""
-    
-    if effect_type == EFFECT_DAMAGE:
-        base_dmg = ability['effect_value']
-        attack_buff = duel[my_buffs_key]['attack']
-        defense_debuff = duel[opp_buffs_key]['defense']
-        opp_defense = duel[opp_stats_key]['defense']
-        
-        # Apply buffs
-        if attack_buff > 0:
-            base_dmg = int(base_dmg * (1 + attack_buff / 100))
-        
-        final_dmg = apply_defense(base_dmg, opp_defense, defense_debuff)
-        duel[opp_hp_key] -= final_dmg
-        duel['last_damage'][opp_id] = -final_dmg
-        
-        action_log = f"<i>{callback.from_user.first_name} использовал {ability['name']} -{ability['energy_cost']}⚡ и нанес {final_dmg} урона</i>"
-        
-    elif effect_type == EFFECT_HEAL:
-        heal = ability['effect_value']
-        max_hp = duel[my_stats_key]['hp']
-        old_hp = duel[my_hp_key]
-        duel[my_hp_key] = min(max_hp, duel[my_hp_key] + heal)
-        actual_heal = duel[my_hp_key] - old_hp
-        duel['last_damage'][user_id] = actual_heal
-        
-        action_log = f"<i>{callback.from_user.first_name} использовал {ability['name']} -{ability['energy_cost']}⚡ и восстановил {actual_heal} здоровья</i>"
-        
-    elif effect_type == EFFECT_DEFENSE_BUFF:
-        duel[opp_buffs_key]['defense'] += ability['effect_percent']
-        action_log = f"<i>{callback.from_user.first_name} использовал {ability['name']} -{ability['energy_cost']}⚡</i>"
-        
-    elif effect_type == EFFECT_ATTACK_BUFF:
-        duel[my_buffs_key]['attack'] += ability['effect_percent']
-        action_log = f"<i>{callback.from_user.first_name} использовал {ability['name']} -{ability['energy_cost']}⚡</i>"
-
-    duel['last_action_log'] = action_log
+    ability = result.ability
+    duel['last_action_log'] = format_action_log(callback.from_user.first_name, result)
     
-    # Check win condition
-    if duel[opp_hp_key] <= 0:
+    if result.finished:
         duel['status'] = 'finished'
-        duel['winner'] = user_id
+        timers.cancel(duel_timer_key(duel))
         
         text = f"⚔️ <b>Дуэль закончилась, победил {callback.from_user.first_name}</b>"
         
@@ -913,8 +806,8 @@ async def callback_friendly_duel_action(callback: CallbackQuery):
         await callback.answer("🏆 Победа!")
         return
     
-    # Switch turn
-    duel['current_turn'] = opp_id
+    save_duel(duel)
+    arm_duel_timer(callback.bot, duel)
     
     # Update message for both players (since it's the same message in group chat)
     text = get_duel_message(duel, None)  # Pass None for friendly duels
@@ -936,6 +829,8 @@ async def callback_friend_reject(callback: CallbackQuery):
     
     if target_id in pending_friendly_duels:
         pending_friendly_duels.pop(target_id)
+        drop_pending_duel(target_id)
+        timers.cancel(('challenge', target_id))
     
     await callback.message.edit_text("<i>🔴 Вызов отклонён</i>")
     await callback.answer()
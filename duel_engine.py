@@ -0,0 +1,274 @@
+"""
+Duel engine for Soul Meter bot
+Turn resolution without Telegram: a duel is a DuelState of two SideState
+objects, and DuelEngine.apply_action plays one ability slot of the side
+whose turn it is. Ranked and friendly duels in duel.py both run on it, and
+it can be driven in bulk for balance simulations and benchmarks.
+
+Every duel owns a seeded DuelRng and a compact log of [side, slot, draws]
+per played turn, so a finished duel is fully described by its sides, seed
+and log and can be replayed deterministically (see replay_duels.py).
+"""
+import random
+from typing import Optional, Dict, Any, List, Tuple
+
+from char import (
+    get_character, calculate_stats_for_level, get_ability_damage,
+    EFFECT_DAMAGE, EFFECT_HEAL, EFFECT_DEFENSE_BUFF, EFFECT_ATTACK_BUFF
+)
+from utils import apply_defense
+
+MAX_ENERGY = 10
+
+# ActionResult.error values
+ERROR_NO_ABILITY = 'no_ability'
+ERROR_NO_ENERGY = 'no_energy'
+
+# Log slots of turns that played no ability
+SLOT_SKIP = 'skip'
+SLOT_FORFEIT = 'forfeit'
+
+# Ranked rewards, rolled from the duel RNG when it ends
+TROPHY_GAIN = (10, 30)
+TROPHY_LOSS = (5, 15)
+SOUL_REWARD = (50, 150)
+
+_MASK64 = (1 << 64) - 1
+_GOLDEN64 = 0x9E3779B97F4A7C15
+
+
+class DuelRng:
+    """splitmix64 over (seed, draw counter)
+    The whole generator state is two ints, so it is stored with the duel and
+    any draw can be recomputed from the seed alone.
+    """
+    __slots__ = ('seed', 'draws')
+
+    def __init__(self, seed: int, draws: int = 0):
+        self.seed = seed
+        self.draws = draws
+
+    def next64(self) -> int:
+        self.draws += 1
+        z = (self.seed + self.draws * _GOLDEN64) & _MASK64
+        z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+        z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _MASK64
+        return z ^ (z >> 31)
+
+    def randint(self, a: int, b: int) -> int:
+        """Random integer in [a, b], both included"""
+        return a + self.next64() % (b - a + 1)
+
+
+def new_seed() -> int:
+    return random.getrandbits(63)
+
+
+class SideState:
+    """One duelist: character, equipped slots and current fight values
+    hp_change and energy_change hold what the last action did to this side,
+    missed counts turns in a row it let time out.
+    """
+    __slots__ = (
+        'user_id', 'char_id', 'level', 'slots', 'max_hp', 'defense',
+        'hp', 'energy', 'attack_buff', 'defense_mod', 'hp_change', 'energy_change', 'missed'
+    )
+
+    def __init__(self, user_id: int, char_id: str, level: int, slots: Dict[str, int], max_hp: int, defense: int,
+                 hp: Optional[int] = None, energy: int = MAX_ENERGY, attack_buff: int = 0, defense_mod: int = 0,
+                 hp_change: int = 0, energy_change: int = 0, missed: int = 0):
+        self.user_id = user_id
+        self.char_id = char_id
+        self.level = level
+        self.slots = slots  # {slot number as str: ability index}
+        self.max_hp = max_hp
+        self.defense = defense
+        self.hp = max_hp if hp is None else hp
+        self.energy = energy
+        self.attack_buff = attack_buff  # Percent added to own damage
+        self.defense_mod = defense_mod  # Percent applied to own defense, negative is a debuff
+        self.hp_change = hp_change
+        self.energy_change = energy_change
+        self.missed = missed
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'SideState':
+        return cls(**data)
+
+
+class DuelState:
+    """Both sides of a duel, whose turn it is, the winner once finished, RNG and turn log"""
+    __slots__ = ('a', 'b', 'turn', 'winner', 'rng', 'log')
+
+    def __init__(self, a: SideState, b: SideState, turn: int = 0, winner: Optional[int] = None,
+                 rng: Optional[DuelRng] = None, log: Optional[List[list]] = None):
+        self.a = a
+        self.b = b
+        self.turn = turn  # 0 - side a acts, 1 - side b
+        self.winner = winner  # user_id of the winner
+        self.rng = rng or DuelRng(new_seed())
+        self.log = [] if log is None else log  # [side, slot, rng draws after the turn] per played turn
+
+    @property
+    def current(self) -> SideState:
+        return self.b if self.turn else self.a
+
+    @property
+    def opponent(self) -> SideState:
+        return self.a if self.turn else self.b
+
+    def side(self, user_id: int) -> SideState:
+        return self.a if user_id == self.a.user_id else self.b
+
+    def other(self, user_id: int) -> SideState:
+        return self.b if user_id == self.a.user_id else self.a
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'a': self.a.to_dict(), 'b': self.b.to_dict(), 'turn': self.turn, 'winner': self.winner,
+            'seed': self.rng.seed, 'draws': self.rng.draws, 'log': self.log
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'DuelState':
+        # Duels saved before the RNG was added get a fresh seed and an empty log
+        rng = DuelRng(data['seed'], data['draws']) if 'seed' in data else None
+        return cls(SideState.from_dict(data['a']), SideState.from_dict(data['b']), data['turn'], data['winner'],
+                   rng, data.get('log'))
+
+    def replay_record(self) -> Dict[str, Any]:
+        """Everything replay_duels.py needs to play this duel again: starting sides, seed and log"""
+        return {
+            'sides': [[side.user_id, side.char_id, side.level, side.slots] for side in (self.a, self.b)],
+            'seed': self.rng.seed,
+            'log': self.log,
+            'winner': self.winner
+        }
+
+    @classmethod
+    def from_legacy(cls, duel: Dict[str, Any]) -> 'DuelState':
+        """Rebuild the state of a duel saved with per-user keys ('user1_hp', ...)"""
+        sides = []
+        for prefix in ('user1', 'user2'):
+            user_id = duel[f'{prefix}_id']
+            buffs = duel[f'{prefix}_buffs']
+            sides.append(SideState(
+                user_id, duel[f'{prefix}_char'], duel.get(f'{prefix}_level', 1), duel[f'{prefix}_slots'],
+                duel[f'{prefix}_stats']['hp'], duel[f'{prefix}_stats']['defense'],
+                hp=duel[f'{prefix}_hp'], energy=duel[f'{prefix}_energy'],
+                attack_buff=buffs['attack'], defense_mod=buffs['defense']
+            ))
+        turn = 0 if duel['current_turn'] == duel['user1_id'] else 1
+        return cls(sides[0], sides[1], turn, duel.get('winner'))
+
+
+class ActionResult:
+    """Outcome of one apply_action call"""
+    __slots__ = ('ability', 'error', 'damage', 'heal', 'finished', 'winner')
+
+    def __init__(self, ability: Optional[Dict[str, Any]] = None, error: Optional[str] = None):
+        self.ability = ability
+        self.error = error
+        self.damage = 0
+        self.heal = 0
+        self.finished = False
+        self.winner = None
+
+
+class DuelEngine:
+    """Duel rules; level-scaled values come from the tables in char"""
+
+    def new_side(self, user_id: int, char_id: str, level: int, slots: Dict[str, int]) -> SideState:
+        """Side at full health and energy with stats for the character level"""
+        stats = calculate_stats_for_level(char_id, level)
+        return SideState(user_id, char_id, level, dict(slots), stats['hp'], stats['defense'])
+
+    def new_duel(self, a: SideState, b: SideState, seed: Optional[int] = None) -> DuelState:
+        """Duel where side a moves first, with a fresh RNG seed unless one is given"""
+        return DuelState(a, b, rng=DuelRng(new_seed() if seed is None else seed))
+
+    def apply_action(self, state: DuelState, slot: str) -> ActionResult:
+        """Play the ability in slot for the side whose turn it is
+        On success the turn passes to the other side, unless the duel is won,
+        and the turn is appended to state.log. Anything random has to be drawn
+        from state.rng so that the log replays.
+        """
+        me = state.current
+        opp = state.opponent
+
+        char = get_character(me.char_id)
+        if not char or slot not in me.slots:
+            return ActionResult(error=ERROR_NO_ABILITY)
+        ability_index = me.slots[slot]
+        ability = char['abilities'][ability_index]
+        result = ActionResult(ability)
+
+        cost = ability['energy_cost']
+        if me.energy < cost:
+            result.error = ERROR_NO_ENERGY
+            return result
+
+        me.hp_change = opp.hp_change = opp.energy_change = 0
+        me.missed = 0
+        me.energy -= cost
+        me.energy_change = -cost
+
+        restore = ability.get('energy_restore', 0)
+        if restore > 0:
+            me.energy = min(MAX_ENERGY, me.energy + restore)
+            me.energy_change += restore
+
+        effect_type = ability.get('effect_type', '')
+        if effect_type == EFFECT_DAMAGE:
+            damage = get_ability_damage(me.char_id, ability_index, me.level)
+            if me.attack_buff > 0:
+                damage = int(damage * (1 + me.attack_buff / 100))
+            result.damage = apply_defense(damage, opp.defense, opp.defense_mod)
+            opp.hp -= result.damage
+            opp.hp_change = -result.damage
+
+        elif effect_type == EFFECT_HEAL:
+            old_hp = me.hp
+            me.hp = min(me.max_hp, me.hp + ability['effect_value'])
+            result.heal = me.hp - old_hp
+            me.hp_change = result.heal
+
+        elif effect_type == EFFECT_DEFENSE_BUFF:
+            opp.defense_mod += ability['effect_percent']
+
+        elif effect_type == EFFECT_ATTACK_BUFF:
+            me.attack_buff += ability['effect_percent']
+
+        state.log.append([state.turn, slot, state.rng.draws])
+        if opp.hp <= 0:
+            state.winner = me.user_id
+            result.finished = True
+            result.winner = me.user_id
+        else:
+            state.turn ^= 1
+        return result
+
+    def skip_turn(self, state: DuelState) -> None:
+        """Pass the turn without playing, e.g. when the player ran out of time"""
+        me = state.current
+        me.missed += 1
+        me.hp_change = me.energy_change = state.opponent.hp_change = state.opponent.energy_change = 0
+        state.log.append([state.turn, SLOT_SKIP, state.rng.draws])
+        state.turn ^= 1
+
+    def forfeit(self, state: DuelState) -> int:
+        """End the duel with a loss for the side whose turn it is, returns the winner"""
+        state.log.append([state.turn, SLOT_FORFEIT, state.rng.draws])
+        state.winner = state.opponent.user_id
+        return state.winner
+
+    def roll_rewards(self, state: DuelState) -> Tuple[int, int, int]:
+        """Ranked rewards of a finished duel: (winner trophies, loser trophy loss, winner souls)"""
+        rng = state.rng
+        return rng.randint(*TROPHY_GAIN), rng.randint(*TROPHY_LOSS), rng.randint(*SOUL_REWARD)
+
+
+engine = DuelEngine()
@@ -0,0 +1,171 @@
+"""
+Analytics export for Soul Meter bot
+Streams every user of the configured storage backend into flat files for
+economy balancing and writes summary aggregates:
+
+    users.csv       one row per user: currencies, trophies, chests, collection size
+    characters.csv  one row per owned character: rarity, level, copies
+    summary.json    totals/min/max/mean of currencies, chest inventory totals,
+                    ownership and level distributions per rarity and per character
+
+Rows are written as they are read and aggregates are running counters, so
+memory stays constant with the SQLite and sharded backends (the JSON backend
+keeps its tables in memory anyway). Uses STORAGE_BACKEND like the bot does.
+
+    python export_analytics.py --out export
+    python export_analytics.py --backend sqlite --format jsonl --out export
+"""
+import argparse
+import csv
+import json
+import os
+from typing import Dict, Any
+
+from char import CHARACTERS
+from storage_backend import BACKENDS
+
+CHEST_TYPES = ('weak_soul', 'time', 'death', 'infinity')
+NUMERIC_FIELDS = ('level', 'souls', 'exp', 'trophy_souls', 'trophies')
+
+USER_COLUMNS = (
+    ('telegram_id', 'sid') + NUMERIC_FIELDS
+    + tuple(f"chest_{chest}" for chest in CHEST_TYPES)
+    + ('active_char', 'characters', 'copies', 'last_up', 'last_seen')
+)
+CHARACTER_COLUMNS = ('telegram_id', 'char_id', 'rarity', 'level', 'count')
+
+
+class RowWriter:
+    """CSV or JSONL writer with a fixed column order"""
+
+    def __init__(self, path: str, columns: tuple, fmt: str):
+        self.columns = columns
+        self.fmt = fmt
+        self.file = open(path, 'w', encoding='utf-8', newline='')
+        if fmt == 'csv':
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(columns)
+
+    def write(self, row: Dict[str, Any]) -> None:
+        if self.fmt == 'csv':
+            self.writer.writerow([row.get(column) for column in self.columns])
+        else:
+            self.file.write(json.dumps({column: row.get(column) for column in self.columns}, ensure_ascii=False) + '\n')
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class Stat:
+    """Running total/min/max/mean of one field"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value: int) -> None:
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'total': self.total,
+            'min': self.min,
+            'max': self.max,
+            'mean': round(self.total / self.count, 2) if self.count else None
+        }
+
+
+def _new_bucket() -> Dict[str, Any]:
+    return {'owners': 0, 'copies': 0, 'levels': {}}
+
+
+def export(out_dir: str, fmt: str) -> Dict[str, Any]:
+    import storage
+
+    os.makedirs(out_dir, exist_ok=True)
+    storage.load_users()
+
+    users_out = RowWriter(os.path.join(out_dir, f"users.{fmt}"), USER_COLUMNS, fmt)
+    chars_out = RowWriter(os.path.join(out_dir, f"characters.{fmt}"), CHARACTER_COLUMNS, fmt)
+
+    user_count = 0
+    stats = {field: Stat() for field in NUMERIC_FIELDS}
+    chest_totals = {chest: 0 for chest in CHEST_TYPES}
+    per_rarity: Dict[str, Dict[str, Any]] = {}
+    per_char: Dict[str, Dict[str, Any]] = {}
+    per_level: Dict[int, int] = {}
+
+    try:
+        for user, characters in storage.iter_users():
+            user_count += 1
+            chests = user.get('chests') or {}
+            row = {field: user.get(field) for field in USER_COLUMNS}
+            for chest in CHEST_TYPES:
+                row[f"chest_{chest}"] = chests.get(chest, 0)
+                chest_totals[chest] += chests.get(chest, 0)
+            for field in NUMERIC_FIELDS:
+                stats[field].add(user.get(field) or 0)
+
+            copies = 0
+            owned_rarities = set()
+            for char_id, char in characters.items():
+                rarity = CHARACTERS.get(char_id, {}).get('rarity', 'unknown')
+                level = char.get('level', 1)
+                count = char.get('count', 1)
+                copies += count
+                chars_out.write({
+                    'telegram_id': user['telegram_id'], 'char_id': char_id,
+                    'rarity': rarity, 'level': level, 'count': count
+                })
+
+                for bucket in (per_rarity.setdefault(rarity, _new_bucket()), per_char.setdefault(char_id, _new_bucket())):
+                    bucket['copies'] += count
+                    bucket['levels'][level] = bucket['levels'].get(level, 0) + 1
+                per_char[char_id]['owners'] += 1
+                owned_rarities.add(rarity)
+                per_level[level] = per_level.get(level, 0) + 1
+
+            for rarity in owned_rarities:
+                per_rarity[rarity]['owners'] += 1
+
+            row['characters'] = len(characters)
+            row['copies'] = copies
+            users_out.write(row)
+    finally:
+        users_out.close()
+        chars_out.close()
+
+    summary = {
+        'users': user_count,
+        'fields': {field: stat.as_dict() for field, stat in stats.items()},
+        'chests': chest_totals,
+        'rarity': per_rarity,
+        'characters': per_char,
+        'levels': dict(sorted(per_level.items()))
+    }
+    with open(os.path.join(out_dir, 'summary.json'), 'w', encoding='utf-8') as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export Soul Meter player data for analytics")
+    parser.add_argument('--out', default='export', help="Output directory")
+    parser.add_argument('--format', choices=('csv', 'jsonl'), default='csv')
+    parser.add_argument('--backend', choices=list(BACKENDS), help="Overrides STORAGE_BACKEND")
+    args = parser.parse_args()
+
+    if args.backend:
+        os.environ['STORAGE_BACKEND'] = args.backend
+
+    summary = export(args.out, args.format)
+    print(f"Exported {summary['users']} users to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Leaderboards for Soul Meter bot
+In-memory sorted indexes over the profile fields players are ranked by.
+Storage backends feed them on load and on every profile write, so /top
+and "my rank" never scan the user base: both are a binary search.
+"""
+import threading
+from bisect import bisect_left, insort
+from typing import Optional, Dict, Any, List, Tuple, Iterable
+
+LEADERBOARD_FIELDS = ('trophies', 'souls', 'trophy_souls')
+
+
+class SortedIndex:
+    """Users ordered by one field, highest first, ties by telegram_id
+    Lookups are O(log N); an update moves one entry of a flat list.
+    """
+
+    def __init__(self):
+        self._keys: List[Tuple[int, int]] = []  # (-value, telegram_id)
+        self._values: Dict[int, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def update(self, telegram_id: int, value: int) -> None:
+        old_value = self._values.get(telegram_id)
+        if old_value == value:
+            return
+        if old_value is not None:
+            del self._keys[bisect_left(self._keys, (-old_value, telegram_id))]
+        insort(self._keys, (-value, telegram_id))
+        self._values[telegram_id] = value
+
+    def remove(self, telegram_id: int) -> None:
+        value = self._values.pop(telegram_id, None)
+        if value is not None:
+            del self._keys[bisect_left(self._keys, (-value, telegram_id))]
+
+    def top(self, count: int) -> List[Tuple[int, int]]:
+        """First count entries as (telegram_id, value)"""
+        return [(telegram_id, -neg_value) for neg_value, telegram_id in self._keys[:count]]
+
+    def rank(self, telegram_id: int) -> Optional[int]:
+        """1-based place of the user, None if not indexed"""
+        value = self._values.get(telegram_id)
+        if value is None:
+            return None
+        return bisect_left(self._keys, (-value, telegram_id)) + 1
+
+
+_indexes = {field: SortedIndex() for field in LEADERBOARD_FIELDS}
+_lock = threading.Lock()
+
+
+def _value(user: Dict[str, Any], field: str) -> int:
+    return user.get(field) or 0
+
+
+def rebuild(users: Iterable[Dict[str, Any]]) -> None:
+    """Replace all indexes with the given profiles"""
+    rows = {field: [] for field in LEADERBOARD_FIELDS}
+    values = {field: {} for field in LEADERBOARD_FIELDS}
+    for user in users:
+        telegram_id = int(user['telegram_id'])
+        for field in LEADERBOARD_FIELDS:
+            value = _value(user, field)
+            rows[field].append((-value, telegram_id))
+            values[field][telegram_id] = value
+
+    with _lock:
+        for field in LEADERBOARD_FIELDS:
+            index = SortedIndex()
+            index._keys = sorted(rows[field])
+            index._values = values[field]
+            _indexes[field] = index
+
+
+def update_user(user: Dict[str, Any]) -> None:
+    """Reindex one profile after it was written"""
+    telegram_id = int(user['telegram_id'])
+    with _lock:
+        for field in LEADERBOARD_FIELDS:
+            _indexes[field].update(telegram_id, _value(user, field))
+
+
+def remove_user(telegram_id: int) -> None:
+    """Take a player off all leaderboards"""
+    with _lock:
+        for index in _indexes.values():
+            index.remove(int(telegram_id))
+
+
+def get_top(field: str = 'trophies', count: int = 10) -> List[Tuple[int, int]]:
+    """Top players by field as (telegram_id, value)"""
+    with _lock:
+        return _indexes[field].top(count)
+
+
+def get_rank(telegram_id: int, field: str = 'trophies') -> Optional[int]:
+    """Place of a player by field, None if unknown"""
+    with _lock:
+        return _indexes[field].rank(telegram_id)
@@ -5,6 +5,7 @@ Bot for anime character duels
 import asyncio
 import os
 import random
+import signal
 from datetime import datetime, timedelta
 from typing import Optional
 
@@ -21,14 +22,10 @@ from dotenv import load_dotenv
 
 import storage
 from storage import (
-    get_user, save_user, get_user_characters, add_character_to_user,
-    get_user_character, update_user_character, get_user_skill_slots,
-    set_user_skill_slot, add_to_duel_queue, remove_from_duel_queue,
-    get_user_character, update_user_character, get_user_skill_slots,
-    set_user_skill_slot, add_to_duel_queue, remove_from_duel_queue,
-    get_queue_match, create_duel, get_active_duel, end_duel,
-    get_user_by_username
+    transaction, get_user_by_username_async, get_user_characters_async,
+    add_character_to_user_async, peek_user_async, peek_users_async
 )
+from leaderboard import get_top, get_rank
 from char import (
     CHARACTERS, get_character, get_all_characters, calculate_stats_for_level,
     get_upgrade_requirements, RARITY_EMOJI, RARITY_NAME, RARITY_MAX_LEVEL,
@@ -81,12 +78,10 @@ async def check_user_callback(callback: CallbackQuery) -> bool:
 # ==================== /start ====================
 @router.message(CommandStart())
 async def cmd_start(message: Message):
-    user = get_user(message.from_user.id)
-    
     # Update user info
-    user['username'] = message.from_user.username
-    user['first_name'] = message.from_user.first_name
-    save_user(user)
+    async with transaction(message.from_user.id) as tx:
+        tx.user['username'] = message.from_user.username
+        tx.user['first_name'] = message.from_user.first_name
     
     text = """👋 Здравствуй я Soul Meter
 
@@ -122,10 +117,9 @@ async def callback_profile(callback: CallbackQuery):
 @router.message(Command("my_soul", "My_Soul"))
 async def cmd_my_soul(message: Message):
     # Update user info
-    user = get_user(message.from_user.id)
-    user['username'] = message.from_user.username
-    user['first_name'] = message.from_user.first_name
-    save_user(user)
+    async with transaction(message.from_user.id) as tx:
+        tx.user['username'] = message.from_user.username
+        tx.user['first_name'] = message.from_user.first_name
 
     await show_profile(message, message.from_user.id, viewer_id=message.from_user.id)
 
@@ -143,7 +137,7 @@ async def cmd_soul(message: Message):
         if username.lower() == "me":
             target_user_id = message.from_user.id
         else:
-            found_user = get_user_by_username(username)
+            found_user = await get_user_by_username_async(username)
             if found_user:
                 target_user_id = found_user['telegram_id']
             else:
@@ -158,8 +152,14 @@ async def cmd_soul(message: Message):
 
 
 async def show_profile(message: Message, target_user_id: int, viewer_id: int, message_to_edit: Message = None):
-    user_data = get_user(target_user_id)
-    user_chars = get_user_characters(target_user_id)
+    user_data = await peek_user_async(target_user_id)
+    if not user_data:
+        if target_user_id == viewer_id:
+            await message.answer("🔴 Сначала используйте /start")
+        else:
+            await message.answer("🔴 Пользователь не найден в базе данных бота")
+        return
+    user_chars = await get_user_characters_async(target_user_id)
     
     active_char_name = "Не выбран"
     if user_data.get('active_char'):
@@ -331,9 +331,8 @@ async def process_avatar_upload(message: Message, state: FSMContext):
         await message.answer("🔴 Неподдерживаемый формат")
         return
         
-    user = get_user(message.from_user.id)
-    user['avatar'] = avatar_data
-    save_user(user)
+    async with transaction(message.from_user.id) as tx:
+        tx.user['avatar'] = avatar_data
     
     # Try to delete the prompt message and send new one, or edit if possible.
     # Editing text-to-media is hard. Deleting and sending new is safer.
@@ -361,36 +360,40 @@ async def process_avatar_upload(message: Message, state: FSMContext):
 # ==================== /up ====================
 @router.message(Command("up"))
 async def cmd_up(message: Message):
-    user = get_user(message.from_user.id)
-    
-    # Check cooldown
-    if user.get('last_up'):
-        last_up = datetime.fromisoformat(user['last_up'])
-        cooldown_end = last_up + timedelta(minutes=15)
-        now = datetime.now()
+    # Replies are sent after the transaction, so the user's lock isn't held over a request
+    async with transaction(message.from_user.id) as tx:
+        user = tx.user
         
-        if now < cooldown_end:
-            remaining = int((cooldown_end - now).total_seconds())
-            await message.answer(f"<i>💼 Вы ещё не отдохнули, подождите ещё {format_time_remaining(remaining)}</i>")
-            return
-    
-    # Check if first 5 ups (guaranteed positive)
-    is_guaranteed = user.get('up_count', 0) < 5
-    
-    # Roll rewards
-    trophy_change, exp = roll_up_rewards(is_guaranteed)
-    chest = roll_chest_drop()
-    
-    # Apply rewards
-    user['trophy_souls'] = max(0, user['trophy_souls'] + trophy_change)
-    user['exp'] += exp
-    user['up_count'] = user.get('up_count', 0) + 1
-    user['last_up'] = datetime.now().isoformat()
-    
-    if chest:
-        user['chests'][chest] = user['chests'].get(chest, 0) + 1
+        # Check cooldown
+        remaining = 0
+        if user.get('last_up'):
+            last_up = datetime.fromisoformat(user['last_up'])
+            cooldown_end = last_up + timedelta(minutes=15)
+            now = datetime.now()
+            
+            if now < cooldown_end:
+                remaining = int((cooldown_end - now).total_seconds())
+        
+        if not remaining:
+            # Check if first 5 ups (guaranteed positive)
+            is_guaranteed = user.get('up_count', 0) < 5
+            
+            # Roll rewards
+            trophy_change, exp = roll_up_rewards(is_guaranteed)
+            chest = roll_chest_drop()
+            
+            # Apply rewards
+            user['trophy_souls'] = max(0, user['trophy_souls'] + trophy_change)
+            user['exp'] += exp
+            user['up_count'] = user.get('up_count', 0) + 1
+            user['last_up'] = datetime.now().isoformat()
+            
+            if chest:
+                user['chests'][chest] = user['chests'].get(chest, 0) + 1
     
-    save_user(user)
+    if remaining:
+        await message.answer(f"<i>💼 Вы ещё не отдохнули, подождите ещё {format_time_remaining(remaining)}</i>")
+        return
     
     # Format message
     trophy_str = f"+{trophy_change}" if trophy_change >= 0 else str(trophy_change)
@@ -431,7 +434,10 @@ async def cmd_up(message: Message):
 # ==================== /so ====================
 @router.message(Command("so"))
 async def cmd_so(message: Message):
-    user = get_user(message.from_user.id)
+    user = await peek_user_async(message.from_user.id)
+    if not user:
+        await message.answer("🔴 Сначала используйте /start")
+        return
     
     text = f"""💳 <b>Ваш баланс</b>
 
@@ -449,6 +455,43 @@ async def cmd_so(message: Message):
     await message.answer(text)
 
 
+# ==================== /top ====================
+TOP_SIZE = 10
+TOP_FIELDS = {
+    'trophies': "🏆 Трофеи",
+    'souls': "🧿 Души",
+    'trophy_souls': "🧧 Трофейные души"
+}
+
+
+@router.message(Command("top"))
+async def cmd_top(message: Message):
+    args = message.text.split()[1:]
+    field = args[0].lower() if args else 'trophies'
+    if field not in TOP_FIELDS:
+        await message.answer("ℹ️ Использование: /top, /top souls или /top trophy_souls")
+        return
+    
+    top = get_top(field, TOP_SIZE)
+    users = await peek_users_async([telegram_id for telegram_id, _ in top])
+    
+    lines = []
+    for place, (telegram_id, value) in enumerate(top, start=1):
+        user = users.get(telegram_id)
+        name = user.get('first_name', "Пользователь") if user else "Пользователь"
+        lines.append(f"{place}. {name} ›› <code>{value}</code>")
+    
+    text = f"""<b>{TOP_FIELDS[field]} ›› Топ {TOP_SIZE}</b>
+
+<blockquote>{chr(10).join(lines) if lines else "<i>Пока никого нет</i>"}</blockquote>"""
+    
+    rank = get_rank(message.from_user.id, field)
+    if rank:
+        text += f"\n<i>Ваше место ›› {rank}</i>"
+    
+    await message.answer(text)
+
+
 # ==================== /chests ====================
 
 def get_chests_keyboard(user_id: int, with_back: bool = False) -> InlineKeyboardMarkup:
@@ -471,7 +514,10 @@ def get_chests_keyboard(user_id: int, with_back: bool = False) -> InlineKeyboard
 
 @router.message(Command("chests"))
 async def cmd_chests(message: Message):
-    user = get_user(message.from_user.id)
+    user = await peek_user_async(message.from_user.id)
+    if not user:
+        await message.answer("🔴 Сначала используйте /start")
+        return
     
     text = f"""<blockquote><i>Сундуки
   ⤷💼 Сундук слабой души ›› {user['chests'].get('weak_soul', 0)}
@@ -489,7 +535,10 @@ async def callback_chests_menu(callback: CallbackQuery):
     if not await check_user_callback(callback):
         return
         
-    user = get_user(callback.from_user.id)
+    user = await peek_user_async(callback.from_user.id)
+    if not user:
+        await callback.answer("🔴 Сначала используйте /start", show_alert=True)
+        return
     
     text = f"""<blockquote><i>Сундуки
   ⤷💼 Сундук слабой души ›› {user['chests'].get('weak_soul', 0)}
@@ -523,7 +572,7 @@ async def callback_open_chest(callback: CallbackQuery):
         'infinity': 'бесконечности'
     }
 
-    result_text = perform_chest_opening(user_id, chest_type)
+    result_text = await perform_chest_opening(user_id, chest_type)
     
     # If error (starts with red circle), show alert
     if result_text.startswith("🔴"):
@@ -534,9 +583,7 @@ async def callback_open_chest(callback: CallbackQuery):
         await callback.answer()
 
 
-def perform_chest_opening(user_id: int, chest_type: str) -> str:
-    user = get_user(user_id)
-    
+async def perform_chest_opening(user_id: int, chest_type: str) -> str:
     chest_names = {
         'weak_soul': 'слабой души',
         'time': 'времени', 
@@ -544,27 +591,27 @@ def perform_chest_opening(user_id: int, chest_type: str) -> str:
         'infinity': 'бесконечности'
     }
     
-    if user['chests'].get(chest_type, 0) <= 0:
-        return "🔴 У вас нет такого сундука"
-    
-    # Open chest
-    user['chests'][chest_type] -= 1
-    
-    # Get owned characters to exclude duplicates
-    user_chars = get_user_characters(user_id)
-    exclude_ids = [c['char_id'] for c in user_chars]
-    
-    rewards = open_chest(chest_type, exclude_ids)
-    
-    # Apply rewards
-    user['souls'] += rewards['souls']
-    user['trophy_souls'] += rewards['trophy_souls']
-    user['exp'] += rewards['exp']
-    
-    if rewards['character']:
-        add_character_to_user(user_id, rewards['character'])
-    
-    save_user(user)
+    async with transaction(user_id) as tx:
+        user = tx.user
+        
+        if user['chests'].get(chest_type, 0) <= 0:
+            return "🔴 У вас нет такого сундука"
+        
+        # Open chest
+        user['chests'][chest_type] -= 1
+        
+        # Get owned characters to exclude duplicates
+        exclude_ids = list(tx.characters)
+        
+        rewards = open_chest(chest_type, exclude_ids)
+        
+        # Apply rewards
+        user['souls'] += rewards['souls']
+        user['trophy_souls'] += rewards['trophy_souls']
+        user['exp'] += rewards['exp']
+        
+        if rewards['character']:
+            tx.add_character(rewards['character'])
     
     # Format rewards text
     reward_lines = []
@@ -591,25 +638,25 @@ def perform_chest_opening(user_id: int, chest_type: str) -> str:
 # ==================== /open_ commands ====================
 @router.message(Command("open_s"))
 async def cmd_open_weak_soul(message: Message):
-    text = perform_chest_opening(message.from_user.id, "weak_soul")
+    text = await perform_chest_opening(message.from_user.id, "weak_soul")
     await message.answer(text)
 
 
 @router.message(Command("open_t"))
 async def cmd_open_time(message: Message):
-    text = perform_chest_opening(message.from_user.id, "time")
+    text = await perform_chest_opening(message.from_user.id, "time")
     await message.answer(text)
 
 
 @router.message(Command("open_d"))
 async def cmd_open_death(message: Message):
-    text = perform_chest_opening(message.from_user.id, "death")
+    text = await perform_chest_opening(message.from_user.id, "death")
     await message.answer(text)
 
 
 @router.message(Command("open_i"))
 async def cmd_open_infinity(message: Message):
-    text = perform_chest_opening(message.from_user.id, "infinity")
+    text = await perform_chest_opening(message.from_user.id, "infinity")
     await message.answer(text)
 
 
@@ -647,14 +694,144 @@ async def cmd_chargive(message: Message):
         await message.answer("🔴 Ответьте на сообщение пользователя или используйте /chargive в ответ на сообщение")
         return
     
-    add_character_to_user(target_user.id, char_id)
+    await add_character_to_user_async(target_user.id, char_id)
     char = get_character(char_id)
     await message.answer(f"🟢 Персонаж <b>{char['name_ru']}</b> выдан пользователю {target_user.first_name}")
 
 
+# ==================== /grant (admin) ====================
+GRANT_CHESTS = {
+    'weak_soul': 'слабой души',
+    'time': 'времени',
+    'death': 'смерти',
+    'infinity': 'бесконечности'
+}
+GRANT_FILTERS = ('active', 'trophies', 'level')
+GRANT_PROGRESS_INTERVAL = 3  # Seconds between progress message edits
+
+GRANT_USAGE = """Использование: <code>/grant награда [количество] [фильтры]</code>
+<i>Награды:</i> <code>souls</code>, <code>chest_weak_soul</code>, <code>chest_time</code>, <code>chest_death</code>, <code>chest_infinity</code>, <code>char:Имя_Персонажа</code>
+<i>Фильтры:</i> <code>active:дни</code>, <code>trophies:минимум</code>, <code>level:минимум</code>
+Например: <code>/grant chest_time 1 active:7</code>"""
+
+
+def parse_grant_args(args: list) -> tuple:
+    """Parse /grant arguments into (reward, amount, filters), ValueError on bad input"""
+    if not args:
+        raise ValueError("Не указана награда")
+    
+    reward = args[0]
+    if reward.startswith('char:'):
+        if reward[5:] not in CHARACTERS:
+            raise ValueError(f"Персонаж {reward[5:]} не найден")
+    elif reward != 'souls' and reward.removeprefix('chest_') not in GRANT_CHESTS:
+        raise ValueError(f"Неизвестная награда {reward}")
+    
+    rest = args[1:]
+    amount = 1
+    if rest and rest[0].isdigit():
+        amount = int(rest.pop(0))
+    if amount <= 0:
+        raise ValueError("Количество должно быть больше нуля")
+    
+    filters = {}
+    for arg in rest:
+        name, _, value = arg.partition(':')
+        if name not in GRANT_FILTERS or not value.isdigit():
+            raise ValueError(f"Неизвестный фильтр {arg}")
+        filters[name] = int(value)
+    
+    return reward, amount, filters
+
+
+def make_grant(reward: str, amount: int, filters: dict):
+    """Build the grant(profile, characters) callback for storage.grant_users_async"""
+    active_since = datetime.now() - timedelta(days=filters['active']) if 'active' in filters else None
+    
+    def grant(user: dict, characters: dict) -> bool:
+        if active_since and storage.last_active(user) < active_since:
+            return False
+        if user.get('trophies', 0) < filters.get('trophies', 0) or user.get('level', 1) < filters.get('level', 0):
+            return False
+        
+        if reward == 'souls':
+            user['souls'] = user.get('souls', 0) + amount
+        elif reward.startswith('char:'):
+            char_id = reward[5:]
+            char = characters.setdefault(char_id, {'char_id': char_id, 'level': 1, 'count': 0})
+            char['count'] = char.get('count', 1) + amount
+        else:
+            chests = user.setdefault('chests', {})
+            chest = reward.removeprefix('chest_')
+            chests[chest] = chests.get(chest, 0) + amount
+        return True
+    
+    return grant
+
+
+def describe_grant(reward: str, amount: int) -> str:
+    if reward == 'souls':
+        return f"{amount} душ"
+    if reward.startswith('char:'):
+        return f"персонаж <b>{get_character(reward[5:])['name_ru']}</b> ×{amount}"
+    return f"сундук {GRANT_CHESTS[reward.removeprefix('chest_')]} ×{amount}"
+
+
+@router.message(Command("grant"))
+async def cmd_grant(message: Message):
+    if not is_admin(message.from_user.id):
+        await message.answer("🔴 Команда доступна только администраторам")
+        return
+    
+    try:
+        reward, amount, filters = parse_grant_args(message.text.split()[1:])
+    except ValueError as e:
+        await message.answer(f"🔴 {e}\n\n{GRANT_USAGE}")
+        return
+    
+    description = describe_grant(reward, amount)
+    status = await message.answer(f"⏳ Выдача: {description}...")
+    
+    # Updated from the storage I/O thread, read here between message edits
+    counters = {'scanned': 0, 'granted': 0}
+    
+    def on_progress(scanned: int, granted: int):
+        counters.update(scanned=scanned, granted=granted)
+    
+    task = asyncio.create_task(storage.grant_users_async(make_grant(reward, amount, filters), on_progress))
+    while not task.done():
+        await asyncio.wait({task}, timeout=GRANT_PROGRESS_INTERVAL)
+        if not task.done():
+            try:
+                await status.edit_text(f"⏳ Выдача: {description}\nПроверено игроков: {counters['scanned']}, выдано: {counters['granted']}")
+            except Exception:
+                pass  # Progress didn't change since the last edit
+    
+    try:
+        granted = task.result()
+    except Exception as e:
+        await status.edit_text(f"🔴 Выдача прервана: {e}")
+        return
+    await status.edit_text(f"🟢 Выдано: {description}\nИгроков получило: {granted} из {counters['scanned']}")
+
+
 # Import additional routers
 from commands import router as commands_router
-from duel import router as duel_router
+from duel import router as duel_router, pending_friendly_duels, run_matchmaking, arm_restored_timers
+from timers import timers
+import media
+
+@dp.update.outer_middleware()
+async def track_activity(handler, event, data):
+    """Players who only look around count as active too, see storage.touch_user_async"""
+    user = data.get('event_from_user')
+    if user:
+        try:
+            await storage.touch_user_async(user.id)
+        except Exception as e:
+            print(f"Error updating last_seen: {e}")
+    return await handler(event, data)
+
 
 dp.include_router(router)
 dp.include_router(commands_router)
@@ -670,6 +847,7 @@ async def setup_bot_commands(bot: Bot):
         BotCommand(command="up", description="Пойти на охоту"),
         BotCommand(command="so", description="Баланс"),
         BotCommand(command="chests", description="Сундуки"),
+        BotCommand(command="top", description="Рейтинг игроков"),
         BotCommand(command="char", description="Персонажи"),
         BotCommand(command="skill", description="Настройка способностей"),
         BotCommand(command="duels", description="Дуэли"),
@@ -686,6 +864,16 @@ async def health_check(request):
 
 async def main():
     print("Bot starting...")
+    await storage.load_users_async()
+    # Bring back duels interrupted by the last restart before handling updates
+    pending_friendly_duels.update(storage.load_duels())
+    arm_restored_timers(bot)
+    uploaded = await media.warm_up(bot)
+    if uploaded:
+        print(f"Uploaded {uploaded} media files to Telegram")
+    flush_task = asyncio.create_task(storage.run_flush_loop())
+    timer_task = asyncio.create_task(timers.run())
+    
     await setup_bot_commands(bot)
     
     # Создаем веб-сервер для keep-alive
@@ -704,11 +892,30 @@ async def main():
     print(f"Web server started on port {port}")
     print("Bot and web server started successfully!")
     
-    # Запускаем бота в фоне
-    asyncio.create_task(dp.start_polling(bot))
+    # Запускаем бота в фоне; сигналы ловим сами, иначе aiogram перехватит SIGTERM
+    # и профили из кэша записи не будут сброшены
+    polling_task = asyncio.create_task(dp.start_polling(bot, handle_signals=False))
+    match_task = asyncio.create_task(run_matchmaking(bot))
     
-    # Ждем бесконечно
-    await asyncio.Event().wait()
+    # Ждем до сигнала остановки, затем сбрасываем профили на диск
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass  # Windows
+    
+    try:
+        await stop_event.wait()
+    finally:
+        polling_task.cancel()
+        flush_task.cancel()
+        match_task.cancel()
+        timer_task.cancel()
+        await storage.flush_users_async(force=True)
+        await storage.compact_duels_async()
+        print("Storage flushed, bot stopped")
 
 
 if __name__ == "__main__":
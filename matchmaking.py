@@ -0,0 +1,125 @@
+"""
+Matchmaking for Soul Meter bot
+Ranked duel queue keyed by trophies. Players wait in FIFO buckets of
+BUCKET_SIZE trophies, so joining and leaving are O(1) and a search only
+looks at the buckets inside the rating window. The window starts at
+MATCH_WINDOW trophies and widens by MATCH_WINDOW_GROWTH per second waited;
+two players are matched when their difference fits both of their windows.
+Matchmaker.match pairs everyone it can in one pass, oldest first, and is
+run periodically by duel.run_matchmaking.
+"""
+import os
+import time
+from typing import Optional, Dict, Any, List, Tuple, Iterator
+
+BUCKET_SIZE = int(os.getenv('MATCH_BUCKET_SIZE', '50'))
+MATCH_WINDOW = int(os.getenv('MATCH_WINDOW', '100'))
+MATCH_WINDOW_GROWTH = float(os.getenv('MATCH_WINDOW_GROWTH', '10'))
+MATCH_TICK_INTERVAL = float(os.getenv('MATCH_TICK_INTERVAL', '2'))
+# Seconds a player waits for an opponent before the search is stopped
+MATCH_QUEUE_TIMEOUT = float(os.getenv('MATCH_QUEUE_TIMEOUT', '600'))
+
+
+def rating_of(user: Dict[str, Any]) -> int:
+    """Rating a player is matched by"""
+    return user.get('trophies') or 0
+
+
+class QueueEntry:
+    """One waiting player, joined is a time.time() timestamp"""
+    __slots__ = ('user_id', 'rating', 'joined', 'bucket')
+
+    def __init__(self, user_id: int, rating: int, joined: float, bucket: int):
+        self.user_id = user_id
+        self.rating = rating
+        self.joined = joined
+        self.bucket = bucket
+
+
+class Matchmaker:
+    """Rating-bucketed FIFO queues
+    Buckets are insertion-ordered dicts used as ordered sets, so removal
+    from the middle of a queue is O(1) like appending.
+    """
+
+    def __init__(self, bucket_size: int = BUCKET_SIZE, window: int = MATCH_WINDOW,
+                 growth: float = MATCH_WINDOW_GROWTH):
+        self.bucket_size = bucket_size
+        self.base_window = window
+        self.growth = growth
+        self._entries: Dict[int, QueueEntry] = {}  # In joining order
+        self._buckets: Dict[int, Dict[int, None]] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._entries
+
+    def __iter__(self) -> Iterator[QueueEntry]:
+        return iter(list(self._entries.values()))
+
+    def get(self, user_id: int) -> Optional[QueueEntry]:
+        return self._entries.get(user_id)
+
+    def add(self, user_id: int, rating: int, joined: Optional[float] = None) -> None:
+        """Put a player at the end of the bucket of their rating"""
+        self.remove(user_id)
+        bucket = rating // self.bucket_size
+        self._entries[user_id] = QueueEntry(user_id, rating, time.time() if joined is None else joined, bucket)
+        self._buckets.setdefault(bucket, {})[user_id] = None
+
+    def remove(self, user_id: int) -> bool:
+        """Take a player out of the queue, False if they weren't in it"""
+        entry = self._entries.pop(user_id, None)
+        if entry is None:
+            return False
+        bucket = self._buckets[entry.bucket]
+        del bucket[user_id]
+        if not bucket:
+            del self._buckets[entry.bucket]
+        return True
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._buckets.clear()
+
+    def window(self, waited: float) -> int:
+        """Largest accepted rating difference after waiting this many seconds"""
+        return self.base_window + int(max(0.0, waited) * self.growth)
+
+    def find(self, rating: int, window: int, now: float, skip: Optional[int] = None) -> Optional[int]:
+        """Longest waiting player of the nearest bucket whose rating fits both windows"""
+        own = rating // self.bucket_size
+        low = (rating - window) // self.bucket_size
+        high = (rating + window) // self.bucket_size
+        for distance in range(max(own - low, high - own) + 1):
+            for bucket in ((own,) if distance == 0 else (own - distance, own + distance)):
+                if bucket < low or bucket > high:
+                    continue
+                for user_id in self._buckets.get(bucket, ()):
+                    if user_id == skip:
+                        continue
+                    entry = self._entries[user_id]
+                    if abs(entry.rating - rating) <= min(window, self.window(now - entry.joined)):
+                        return user_id
+        return None
+
+    def find_for(self, user_id: int, rating: int, now: Optional[float] = None) -> Optional[int]:
+        """Opponent for a player who is just joining, with the starting window"""
+        return self.find(rating, self.base_window, time.time() if now is None else now, skip=user_id)
+
+    def match(self, now: Optional[float] = None) -> List[Tuple[int, int]]:
+        """Pair as many waiting players as possible, oldest first, and remove them"""
+        now = time.time() if now is None else now
+        pairs = []
+        for user_id in list(self._entries):
+            entry = self._entries.get(user_id)
+            if entry is None:
+                continue  # Already paired in this pass
+            opponent_id = self.find(entry.rating, self.window(now - entry.joined), now, skip=user_id)
+            if opponent_id is not None:
+                self.remove(user_id)
+                self.remove(opponent_id)
+                pairs.append((user_id, opponent_id))
+        return pairs
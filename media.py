@@ -0,0 +1,167 @@
+"""
+Media cache for Soul Meter bot
+Local assets (ability GIFs, character pictures) are uploaded to Telegram
+once: the file_id Telegram returns for the first send is kept in
+storage/media_cache.json with the SHA-256 of the file and the bot id, and
+every later send or edit_media reuses it. Editing an asset changes its hash,
+so it is uploaded again on the next send.
+
+With MEDIA_WARMUP_CHAT set, warm_up uploads every asset missing from the
+cache to that chat at startup (and deletes the messages), so the first
+players don't wait for uploads.
+"""
+import hashlib
+import os
+from typing import Optional, Dict, Any, List, Union
+
+from aiogram import Bot
+from aiogram.types import FSInputFile, Message
+
+from char import CHARACTERS
+from storage_format import load_file, save_file
+
+STORAGE_DIR = os.getenv('STORAGE_DIR', os.path.join(os.path.dirname(__file__), 'storage'))
+MEDIA_CACHE_FILE = os.path.join(STORAGE_DIR, 'media_cache.json')
+MEDIA_WARMUP_CHAT = os.getenv('MEDIA_WARMUP_CHAT')
+
+PHOTO_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+# Parts of Telegram error texts saying a file_id can't be sent (any more)
+FILE_ID_ERRORS = ('file identifier', 'file_reference', 'file_id')
+
+
+def asset_paths() -> List[str]:
+    """Every local media file referenced by char.CHARACTERS"""
+    paths = []
+    for char in CHARACTERS.values():
+        if char.get('image'):
+            paths.append(char['image'])
+        for ability in char['abilities']:
+            if ability.get('gif'):
+                paths.append(ability['gif'])
+    return list(dict.fromkeys(paths))
+
+
+def is_file_id_error(error: Exception) -> bool:
+    """Whether Telegram refused a request for an invalid or expired file_id"""
+    text = str(error).lower()
+    return any(marker in text for marker in FILE_ID_ERRORS)
+
+
+def _sent_file_id(message: Any) -> Optional[str]:
+    """file_id of the media in a sent message, None for anything else (edit_media may return True)"""
+    if not isinstance(message, Message):
+        return None
+    if message.animation:
+        return message.animation.file_id
+    if message.photo:
+        return message.photo[-1].file_id
+    if message.video:
+        return message.video.file_id
+    if message.document:
+        return message.document.file_id
+    return None
+
+
+class MediaCache:
+    """file_id per asset path, valid while the file hash and the bot are the same"""
+
+    def __init__(self, path: str = MEDIA_CACHE_FILE):
+        self.path = path
+        self.bot_id: Optional[int] = None
+        self._entries: Dict[str, Dict[str, str]] = {}  # asset path -> {'sha256', 'file_id'}
+        self._hashes: Dict[str, tuple] = {}  # asset path -> (mtime_ns, size, sha256), to hash only changed files
+        self._loaded = False
+
+    def load(self, bot_id: Optional[int] = None) -> None:
+        """Read the cache file, file_ids of another bot are dropped since they don't work for this one"""
+        data = load_file(self.path)
+        self._entries = data.get('files', {})
+        self.bot_id = bot_id if bot_id is not None else data.get('bot_id')
+        if bot_id is not None and data.get('bot_id') not in (None, bot_id):
+            self._entries = {}
+        self._loaded = True
+
+    def _save(self) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        save_file(self.path, {'bot_id': self.bot_id, 'files': self._entries})
+
+    def file_hash(self, path: str) -> str:
+        stat = os.stat(path)
+        known = self._hashes.get(path)
+        if known and known[:2] == (stat.st_mtime_ns, stat.st_size):
+            return known[2]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 16), b''):
+                digest.update(chunk)
+        self._hashes[path] = (stat.st_mtime_ns, stat.st_size, digest.hexdigest())
+        return digest.hexdigest()
+
+    def file_id(self, path: str) -> Optional[str]:
+        """Cached file_id of an asset, None if it was never sent or has changed since"""
+        if not self._loaded:
+            self.load()
+        entry = self._entries.get(path)
+        if entry is None:
+            return None
+        try:
+            if entry['sha256'] == self.file_hash(path):
+                return entry['file_id']
+        except OSError:  # File is gone, the old upload is still better than nothing
+            return entry['file_id']
+        del self._entries[path]
+        self._save()
+        return None
+
+    def input_file(self, path: str) -> Union[str, FSInputFile]:
+        """What to pass to aiogram for this asset: the cached file_id or an upload"""
+        return self.file_id(path) or FSInputFile(path)
+
+    def remember(self, path: str, sent: Any) -> None:
+        """Store the file_id from the message an asset was just sent or edited into"""
+        file_id = _sent_file_id(sent)
+        if not file_id:
+            return
+        if not self._loaded:
+            self.load()
+        try:
+            sha256 = self.file_hash(path)
+        except OSError:
+            return
+        entry = {'sha256': sha256, 'file_id': file_id}
+        if self._entries.get(path) != entry:
+            self._entries[path] = entry
+            self._save()
+
+    def forget(self, path: str) -> None:
+        """Drop a file_id Telegram refused, the next send uploads the file again"""
+        if self._entries.pop(path, None) is not None:
+            self._save()
+
+
+media_cache = MediaCache()
+
+
+async def warm_up(bot: Bot, chat_id: Optional[Union[int, str]] = MEDIA_WARMUP_CHAT) -> int:
+    """Load the cache for this bot and upload assets it lacks through chat_id
+    Returns how many files were uploaded; without a chat only the cache is loaded.
+    """
+    media_cache.load(bot.id)
+    if not chat_id:
+        return 0
+
+    uploaded = 0
+    for path in asset_paths():
+        if media_cache.file_id(path) or not os.path.exists(path):
+            continue
+        try:
+            if path.lower().endswith(PHOTO_EXTENSIONS):
+                sent = await bot.send_photo(chat_id, FSInputFile(path), disable_notification=True)
+            else:
+                sent = await bot.send_animation(chat_id, FSInputFile(path), disable_notification=True)
+            media_cache.remember(path, sent)
+            uploaded += 1
+            await bot.delete_message(chat_id, sent.message_id)
+        except Exception as e:
+            print(f"Error uploading {path}: {e}")
+    return uploaded
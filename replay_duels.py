@@ -0,0 +1,129 @@
+"""
+Duel replay for Soul Meter bot
+Re-runs finished duels from storage/duel_log.jsonl through the current
+duel_engine rules: both sides are rebuilt from character, level and slots,
+the RNG from the seed, and every logged turn is played again. A duel passes
+if each turn is accepted by the same side with the same number of RNG draws,
+the same player wins and ranked rewards roll the same.
+
+Run it after changing char.py or duel_engine.py to see which recorded duels
+would now play out differently, or with --show to walk through one duel.
+
+    python replay_duels.py
+    python replay_duels.py --log other_log.jsonl --fail-limit 20
+    python replay_duels.py --show 15
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from typing import Dict, Any, Optional
+
+from duel_engine import DuelState, SLOT_SKIP, SLOT_FORFEIT, engine
+
+DUEL_LOG_FILE = os.path.join(os.path.dirname(__file__), 'storage', 'duel_log.jsonl')
+
+
+def start_state(record: Dict[str, Any]) -> DuelState:
+    a, b = (engine.new_side(*side) for side in record['sides'])
+    return engine.new_duel(a, b, record['seed'])
+
+
+def replay(record: Dict[str, Any]) -> Optional[str]:
+    """Play a logged duel again, None if it matches or what differs"""
+    state = start_state(record)
+    for number, (side, slot, draws) in enumerate(record['log'], 1):
+        if state.winner is not None:
+            return f"turn {number}: duel already won"
+        if state.turn != side:
+            return f"turn {number}: side {side} acted out of turn"
+        if slot == SLOT_SKIP:
+            engine.skip_turn(state)
+        elif slot == SLOT_FORFEIT:
+            engine.forfeit(state)
+        else:
+            result = engine.apply_action(state, slot)
+            if result.error:
+                return f"turn {number}: slot {slot} rejected ({result.error})"
+        if state.rng.draws != draws:
+            return f"turn {number}: {state.rng.draws} RNG draws instead of {draws}"
+
+    if state.winner != record['winner']:
+        return f"winner {state.winner} instead of {record['winner']}"
+    if record.get('rewards') is not None:
+        rewards = list(engine.roll_rewards(state))
+        if rewards != record['rewards']:
+            return f"rewards {rewards} instead of {record['rewards']}"
+    return None
+
+
+def show(record: Dict[str, Any]) -> None:
+    """Print one duel turn by turn"""
+    state = start_state(record)
+    for label, side in (('A', state.a), ('B', state.b)):
+        print(f"{label}: {side.user_id} {side.char_id} lvl {side.level}  hp {side.max_hp}  def {side.defense}")
+
+    for number, (side, slot, _) in enumerate(record['log'], 1):
+        me = state.current
+        if slot == SLOT_SKIP:
+            engine.skip_turn(state)
+            print(f"{number:>3}. {'AB'[side]} turn timed out")
+            continue
+        if slot == SLOT_FORFEIT:
+            print(f"{number:>3}. {'AB'[side]} forfeits\nWinner: {engine.forfeit(state)}")
+            continue
+        result = engine.apply_action(state, slot)
+        if result.error:
+            print(f"{number:>3}. {'AB'[side]} slot {slot}: {result.error}")
+            break
+        ability = result.ability['name'] if result.ability else '?'
+        print(
+            f"{number:>3}. {'AB'[side]} {ability:<24} dmg {result.damage:<4} heal {result.heal:<4}"
+            f" hp {state.a.hp}/{state.b.hp}  energy {state.a.energy}/{state.b.energy}"
+        )
+        if result.finished:
+            print(f"Winner: {me.user_id} ({me.char_id})")
+
+    if record.get('rewards') is not None:
+        print(f"Rewards: {list(engine.roll_rewards(state))}, logged {record['rewards']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay logged duels against the current duel rules")
+    parser.add_argument('--log', default=DUEL_LOG_FILE, help="Duel log, one JSON record per line")
+    parser.add_argument('--show', type=int, metavar='LINE', help="Print the duel on this line of the log")
+    parser.add_argument('--fail-limit', type=int, default=10, help="How many mismatches to print")
+    args = parser.parse_args()
+
+    with open(args.log, encoding='utf-8') as f:
+        if args.show:
+            for number, line in enumerate(f, 1):
+                if number == args.show:
+                    show(json.loads(line))
+                    return
+            sys.exit(f"{args.log} has less than {args.show} duels")
+
+        start = time.perf_counter()
+        total = failed = 0
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            total += 1
+            try:
+                error = replay(json.loads(line))
+            except (KeyError, IndexError, TypeError, ValueError) as e:
+                error = f"broken record ({e!r})"
+            if error:
+                failed += 1
+                if failed <= args.fail_limit:
+                    print(f"line {number}: {error}")
+        elapsed = time.perf_counter() - start
+
+    rate = total / elapsed if elapsed else 0
+    print(f"Replayed {total} duels in {elapsed:.2f} s ({rate:.0f}/s), {failed} differ")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
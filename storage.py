@@ -1,207 +1,1231 @@
 """
 Storage module for Soul Meter bot
-Handles all JSON file operations for user data, characters, etc.
+Handles all file operations for user data, characters, etc.
 """
+import asyncio
+import copy
+import functools
 import json
 import os
-from typing import Optional, Dict, Any
-from datetime import datetime
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from types import MappingProxyType
+from typing import Optional, Dict, Any, List, Iterable, Iterator, Mapping, Tuple
+from datetime import datetime, timedelta
 
-STORAGE_DIR = os.path.join(os.path.dirname(__file__), 'storage')
+from storage_format import DEFAULT_FORMAT, load_file, save_file, characters_by_id
+from storage_journal import Journal, ARCHIVE_FILE, user_record, char_records, apply_record
+from storage_backend import Grant, Progress, load_backend
+import leaderboard
+from duel_engine import DuelState
+from matchmaking import Matchmaker, rating_of
+
+STORAGE_DIR = os.getenv('STORAGE_DIR', os.path.join(os.path.dirname(__file__), 'storage'))
+
+# Storage backend: 'json' (profile.json/userchar.json), 'sqlite', 'sharded'
+# or 'dbm', see storage_backend.BACKENDS
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'json').lower()
+
+# How often (in seconds) dirty users are written back to disk
+FLUSH_INTERVAL = float(os.getenv('STORAGE_FLUSH_INTERVAL', '5'))
+
+# JSON backend: append every change to storage/journal.jsonl and rewrite
+# profile.json/userchar.json only when compacting, i.e. after
+# STORAGE_COMPACT_RECORDS records or STORAGE_COMPACT_INTERVAL seconds
+JOURNAL_ENABLED = os.getenv('STORAGE_JOURNAL', '1') == '1'
+COMPACT_RECORDS = int(os.getenv('STORAGE_COMPACT_RECORDS', '10000'))
+COMPACT_INTERVAL = float(os.getenv('STORAGE_COMPACT_INTERVAL', '600'))
+
+# Number of threads doing blocking storage I/O for the async API
+IO_WORKERS = int(os.getenv('STORAGE_IO_WORKERS', '4'))
+
+# JSON backend cold tier: users inactive for STORAGE_ARCHIVE_DAYS (0 disables)
+# are moved to storage/archive.json.gz, checked every STORAGE_ARCHIVE_INTERVAL
+# seconds, and restored the next time they are read or written
+ARCHIVE_AFTER_DAYS = float(os.getenv('STORAGE_ARCHIVE_DAYS', '30'))
+ARCHIVE_INTERVAL = float(os.getenv('STORAGE_ARCHIVE_INTERVAL', '3600'))
+# Transactions stamp last_seen on every change; players who only read get it
+# refreshed by touch_user_async at most every STORAGE_LAST_SEEN_INTERVAL seconds
+LAST_SEEN_INTERVAL = float(os.getenv('STORAGE_LAST_SEEN_INTERVAL', '3600'))
+
+# Handlers waiting for durability within this window share one fsync
+GROUP_COMMIT_WINDOW = float(os.getenv('STORAGE_GROUP_COMMIT_MS', '50')) / 1000
 
 # Ensure storage directory exists
 os.makedirs(STORAGE_DIR, exist_ok=True)
 
+_io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix='storage-io')
+
 
 def _load_json(filename: str) -> Dict:
-    """Load JSON file from storage directory"""
-    filepath = os.path.join(STORAGE_DIR, filename)
-    if os.path.exists(filepath):
-        with open(filepath, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return {}
+    """Load storage file (any STORAGE_FORMAT) from storage directory"""
+    return load_file(os.path.join(STORAGE_DIR, filename))
 
 
 def _save_json(filename: str, data: Dict) -> None:
-    """Save data to JSON file in storage directory"""
-    filepath = os.path.join(STORAGE_DIR, filename)
-    with open(filepath, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    """Save data to storage directory in STORAGE_FORMAT (temp file + fsync + rename)"""
+    save_file(os.path.join(STORAGE_DIR, filename), data, DEFAULT_FORMAT, fsync=True)
 
 
-def get_user(telegram_id: int) -> Dict[str, Any]:
-    """Get user profile or create new one if doesn't exist"""
+# In-memory user tables, loaded once from profile.json/userchar.json and
+# written back by flush_users(). Cached entries are never mutated in place:
+# readers get copies and writers replace the whole entry.
+_users: Dict[str, Dict[str, Any]] = {}
+_user_chars: Dict[str, Dict[str, Dict[str, Any]]] = {}  # str telegram_id -> char_id -> character
+_next_sid = 1
+_dirty_users: set = set()
+_dirty_chars: set = set()
+_username_index: Dict[str, str] = {}  # lowercase username -> str telegram_id
+_users_loaded = False
+_users_lock = threading.RLock()
+_peek_cache: Dict[str, tuple] = {}  # str telegram_id -> (profile dict, read-only view)
+_archived: Dict[str, str] = {}  # str telegram_id -> lowercase username, for archived users
+_archived_usernames: Dict[str, str] = {}  # lowercase username -> str telegram_id, for archived users
+
+_journal = Journal(STORAGE_DIR) if JOURNAL_ENABLED else None
+_last_compaction = time.monotonic()
+
+
+def load_users() -> None:
+    """Load profile.json and userchar.json into the in-memory tables
+    and replay the journal written since they were last compacted
+    """
+    global _next_sid, _users_loaded
     data = _load_json('profile.json')
+    chars_data = _load_json('userchar.json')
+    
+    with _users_lock:
+        _users.clear()
+        _users.update(data.get('users', {}))
+        _next_sid = data.get('next_sid', 1)
+        _user_chars.clear()
+        _user_chars.update(chars_data.get('user_chars', {}))
+        _dirty_users.clear()
+        _dirty_chars.clear()
+        _peek_cache.clear()
+        
+        if _journal:
+            _replay_journal(data.get('journal_seq', 0), chars_data.get('journal_seq', 0))
+        
+        migrated = _migrate_user_chars()
+        backfilled = _backfill_last_seen()
+        _rebuild_username_index()
+        _load_archive_index()
+        leaderboard.rebuild(_users.values())
+        _users_loaded = True
+        
+        if migrated:
+            print(f"Migrated character collections of {migrated} users")
+        if backfilled:
+            print(f"Set last_seen of {backfilled} users saved before it was tracked")
+        if migrated or backfilled:
+            # Snapshot right away so the journal never mixes both layouts
+            flush_users(force=True)
+
+
+def _migrate_user_chars() -> int:
+    """Convert collections still in the old list layout, return how many"""
+    migrated = 0
+    for str_id, chars in _user_chars.items():
+        if isinstance(chars, list):
+            _user_chars[str_id] = characters_by_id(chars)
+            _dirty_chars.add(str_id)
+            migrated += 1
+    return migrated
+
+
+def _backfill_last_seen() -> int:
+    """Stamp profiles saved before last_seen existed with the load time, return how many
+    Without it the first archive pass would take them all for inactive.
+    """
+    now = datetime.now().isoformat()
+    backfilled = 0
+    for str_id, user in _users.items():
+        if not user.get('last_seen'):
+            _users[str_id] = {**user, 'last_seen': now}
+            _dirty_users.add(str_id)
+            backfilled += 1
+    return backfilled
+
+
+def _replay_journal(users_seq: int, chars_seq: int) -> None:
+    global _next_sid
+    _journal.close()
+    
+    last_seq = max(users_seq, chars_seq)
+    replayed = 0
+    for record in _journal.read():
+        last_seq = max(last_seq, record['seq'])
+        is_user_op = record['op'].startswith('user')
+        if record['seq'] <= (users_seq if is_user_op else chars_seq):
+            continue  # Already part of the snapshot
+        
+        apply_record(_users, _user_chars, record)
+        replayed += 1
+        if is_user_op:
+            _dirty_users.add(record['id'])
+            if record['op'] == 'user_new':
+                _next_sid = max(_next_sid, record['user']['sid'] + 1)
+            elif record['op'] == 'user_archive':
+                _dirty_chars.add(record['id'])
+        else:
+            _dirty_chars.add(record['id'])
+    
+    _journal.open(last_seq, pending=replayed)
+    if replayed:
+        print(f"Replayed {replayed} journal records")
+
+
+def _journal_user(str_id: str, old: Optional[Dict], new: Dict) -> None:
+    if _journal:
+        record = user_record(str_id, old, new)
+        if record:
+            _journal.append(record)
+
+
+def _journal_chars(str_id: str, old: Dict[str, Dict], new: Dict[str, Dict]) -> None:
+    if _journal:
+        for record in char_records(str_id, old, new):
+            _journal.append(record)
+
+
+def _username_key(username: Optional[str]) -> str:
+    return (username or '').lstrip('@').lower()
+
+
+def _rebuild_username_index() -> None:
+    _username_index.clear()
+    for str_id, user in _users.items():
+        key = _username_key(user.get('username'))
+        if key:
+            _username_index.setdefault(key, str_id)
+
+
+def _ensure_users_loaded() -> None:
+    if not _users_loaded:
+        with _users_lock:
+            if not _users_loaded:
+                load_users()
+
+
+def _load_archive_index() -> None:
+    """Remember who is archived; copies of users restored since are stale"""
+    archive = _load_json(ARCHIVE_FILE)
+    _archived.clear()
+    _archived_usernames.clear()
+    for str_id, user in archive.get('users', {}).items():
+        if str_id not in _users:
+            _set_archived(str_id, _username_key(user.get('username')))
+
+
+def _set_archived(str_id: str, key: str) -> None:
+    _archived[str_id] = key
+    if key:
+        _archived_usernames.setdefault(key, str_id)
+
+
+def _read_archived(str_id: str, archive: Optional[Dict] = None) -> tuple:
+    """Profile and characters of an archived user straight from the archive"""
+    if archive is None:
+        archive = _load_json(ARCHIVE_FILE)
+    return archive['users'][str_id], archive.get('user_chars', {}).get(str_id, {})
+
+
+def _bring_back(str_id: str) -> None:
+    """Restore an archived user before a call takes _users_lock, so the archive
+    is read without holding it. The _restore_archived inside the call is then
+    a no-op, left for a user archived in between.
+    """
+    if str_id not in _archived:
+        return
+    archive = _load_json(ARCHIVE_FILE)
+    with _users_lock:
+        if str_id in archive.get('users', {}):
+            _restore_archived(str_id, archive)
+
+
+def _restore_archived(str_id: str, archive: Optional[Dict] = None, seen: bool = True) -> None:
+    """Move an archived user back into the hot tables (call under _users_lock)
+    seen stamps last_seen, so the next archive pass doesn't move the user straight back.
+    """
+    if str_id not in _archived:
+        return
+    user, chars = _read_archived(str_id, archive)
+    if seen:
+        user = {**user, 'last_seen': datetime.now().isoformat()}
+    key = _archived.pop(str_id)
+    if _archived_usernames.get(key) == str_id:
+        del _archived_usernames[key]
+    
+    _users[str_id] = user
+    _dirty_users.add(str_id)
+    _journal_user(str_id, None, user)
+    if chars:
+        _user_chars[str_id] = chars
+        _dirty_chars.add(str_id)
+        _journal_chars(str_id, {}, chars)
     
-    if 'users' not in data:
-        data['users'] = {}
-    if 'next_sid' not in data:
-        data['next_sid'] = 1
+    key = _username_key(user.get('username'))
+    if key:
+        _username_index.setdefault(key, str_id)
+    leaderboard.update_user(user)
+
+
+def last_active(user: Dict[str, Any]) -> datetime:
+    """Time of the user's last action, datetime.min if never seen"""
+    stamps = [user.get('last_seen'), user.get('last_up')]
+    return max((datetime.fromisoformat(stamp) for stamp in stamps if stamp), default=datetime.min)
+
+
+def archive_inactive_users() -> int:
+    """Move users inactive for ARCHIVE_AFTER_DAYS to the archive, return how many"""
+    if ARCHIVE_AFTER_DAYS <= 0:
+        return 0
+    _ensure_users_loaded()
+    
+    cutoff = datetime.now() - timedelta(days=ARCHIVE_AFTER_DAYS)
+    with _users_lock:
+        inactive = {str_id: (user, _user_chars.get(str_id)) for str_id, user in _users.items()
+                    if last_active(user) < cutoff}
+        if not inactive:
+            return 0
+        live_ids = set(_users) - set(inactive)
+    
+    # Write the archive first: users leave the hot tables only once it is durable
+    archive = _load_json(ARCHIVE_FILE)
+    archive_users = {str_id: user for str_id, user in archive.get('users', {}).items() if str_id not in live_ids}
+    archive_chars = {str_id: chars for str_id, chars in archive.get('user_chars', {}).items() if str_id not in live_ids}
+    for str_id, (user, chars) in inactive.items():
+        archive_users[str_id] = user
+        archive_chars.pop(str_id, None)
+        if chars:
+            archive_chars[str_id] = chars
+    save_file(os.path.join(STORAGE_DIR, ARCHIVE_FILE), {'users': archive_users, 'user_chars': archive_chars},
+              DEFAULT_FORMAT, fsync=True, compress=True)
+    
+    archived = 0
+    with _users_lock:
+        for str_id, (user, chars) in inactive.items():
+            # Skip users that came back while the archive was written
+            if _users.get(str_id) is not user or _user_chars.get(str_id) is not chars:
+                continue
+            if _journal:
+                _journal.append({'op': 'user_archive', 'id': str_id})
+            del _users[str_id]
+            _user_chars.pop(str_id, None)
+            _peek_cache.pop(str_id, None)
+            _dirty_users.add(str_id)
+            _dirty_chars.add(str_id)
+            key = _username_key(user.get('username'))
+            if key and _username_index.get(key) == str_id:
+                del _username_index[key]
+            _set_archived(str_id, key)
+            leaderboard.remove_user(str_id)
+            archived += 1
+    
+    if archived:
+        print(f"Archived {archived} inactive users")
+    return archived
+
+
+def flush_users(force: bool = False) -> None:
+    """Write dirty tables back to profile.json / userchar.json
+    With the journal enabled this only syncs the journal, unless it is due
+    for compaction or force is set.
+    """
+    global _last_compaction
+    with _users_lock:
+        if not _dirty_users and not _dirty_chars:
+            return
+        
+        journal_seq = 0
+        if _journal:
+            due = (_journal.pending >= COMPACT_RECORDS
+                   or time.monotonic() - _last_compaction >= COMPACT_INTERVAL)
+            if not (force or due):
+                _journal.sync()
+                return
+            journal_seq = _journal.rotate()
+            _last_compaction = time.monotonic()
+        
+        dirty_users = set(_dirty_users)
+        dirty_chars = set(_dirty_chars)
+        _dirty_users.clear()
+        _dirty_chars.clear()
+        data = {'users': dict(_users), 'next_sid': _next_sid, 'journal_seq': journal_seq} if dirty_users else None
+        chars_data = {'user_chars': dict(_user_chars), 'journal_seq': journal_seq} if dirty_chars else None
+    
+    try:
+        if data is not None:
+            _save_json('profile.json', data)
+    except Exception:
+        with _users_lock:
+            _dirty_users.update(dirty_users)
+            _dirty_chars.update(dirty_chars)
+        raise
+    
+    try:
+        if chars_data is not None:
+            _save_json('userchar.json', chars_data)
+    except Exception:
+        with _users_lock:
+            _dirty_chars.update(dirty_chars)
+        raise
+    
+    if _journal:
+        _journal.drop_segments(journal_seq)
+
+
+def sync_users() -> None:
+    """Make every change made so far durable
+    With the journal this is one fsync of it, without it dirty tables are
+    written out as snapshots.
+    """
+    if _journal:
+        with _users_lock:
+            _journal.sync()
+    else:
+        flush_users(force=True)
+
+
+async def run_flush_loop(interval: float = FLUSH_INTERVAL) -> None:
+    """Periodically flush dirty users (and archive inactive ones) until cancelled"""
+    last_archive = time.monotonic()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await flush_users_async()
+        except Exception as e:
+            print(f"Error flushing users: {e}")
+        
+        if STORAGE_BACKEND == 'json' and time.monotonic() - last_archive >= ARCHIVE_INTERVAL:
+            last_archive = time.monotonic()
+            try:
+                await _run_io(archive_inactive_users)
+            except Exception as e:
+                print(f"Error archiving users: {e}")
+
+
+def allocate_sid() -> int:
+    """Take the next SID, saved together with the profile it is given to"""
+    global _next_sid
+    _ensure_users_loaded()
+    with _users_lock:
+        sid = _next_sid
+        _next_sid += 1
+        return sid
+
+
+def get_user(telegram_id: int) -> Dict[str, Any]:
+    """Get user profile or create new one if doesn't exist"""
+    _ensure_users_loaded()
     
     str_id = str(telegram_id)
+    _bring_back(str_id)
     
-    if str_id not in data['users']:
-        # Create new user
-        new_user = {
-            'telegram_id': telegram_id,
-            'sid': data['next_sid'],
-            'level': 1,
-            'souls': 0,
-            'exp': 0,
-            'trophy_souls': 0,
-            'trophies': 0,
-            'chests': {
-                'weak_soul': 0,
-                'time': 0,
-                'death': 0,
-                'infinity': 0
-            },
-            'active_char': None,
-            'last_up': None,
-            'up_count': 0,  # Counter for first 5 guaranteed positive ups
-            'skill_slots': {},  # {char_id: {slot_num: ability_index}}
-            'avatar': None  # {type: 'photo'|'animation'|'video', file_id: str}
-        }
-        data['users'][str_id] = new_user
-        data['next_sid'] += 1
-        _save_json('profile.json', data)
-    
-    return data['users'][str_id]
+    with _users_lock:
+        _restore_archived(str_id)
+        if str_id not in _users:
+            # Create new user
+            new_user = {
+                'telegram_id': telegram_id,
+                'sid': allocate_sid(),
+                'level': 1,
+                'souls': 0,
+                'exp': 0,
+                'trophy_souls': 0,
+                'trophies': 0,
+                'chests': {
+                    'weak_soul': 0,
+                    'time': 0,
+                    'death': 0,
+                    'infinity': 0
+                },
+                'active_char': None,
+                'last_up': None,
+                'up_count': 0,  # Counter for first 5 guaranteed positive ups
+                'skill_slots': {},  # {char_id: {slot_num: ability_index}}
+                'avatar': None,  # {type: 'photo'|'animation'|'video', file_id: str}
+                'last_seen': datetime.now().isoformat()
+            }
+            _users[str_id] = new_user
+            _dirty_users.add(str_id)
+            _journal_user(str_id, None, new_user)
+            leaderboard.update_user(new_user)
+        
+        return copy.deepcopy(_users[str_id])
+
+
+def _freeze(value: Any) -> Any:
+    if isinstance(value, dict):
+        return MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def _peek(str_id: str) -> Optional[Mapping[str, Any]]:
+    user = _users.get(str_id)
+    if user is None:
+        if str_id in _archived:
+            return _freeze(_read_archived(str_id)[0])
+        return None
+    # Profiles are replaced, never mutated, on save, so identity tells if the view is stale
+    cached = _peek_cache.get(str_id)
+    if cached is None or cached[0] is not user:
+        cached = (user, _freeze(user))
+        _peek_cache[str_id] = cached
+    return cached[1]
+
+
+def peek_user(telegram_id: int) -> Optional[Mapping[str, Any]]:
+    """Read-only view of user profile, None if user doesn't exist
+    Never creates the user or writes anything, use get_user for that.
+    """
+    _ensure_users_loaded()
+    _bring_back(str(telegram_id))
+    
+    with _users_lock:
+        return _peek(str(telegram_id))
+
+
+def peek_users(telegram_ids: Iterable[int]) -> Dict[int, Mapping[str, Any]]:
+    """Read-only views of several user profiles, unknown ids are left out"""
+    _ensure_users_loaded()
+    telegram_ids = list(telegram_ids)
+    for telegram_id in telegram_ids:
+        _bring_back(str(telegram_id))
+    
+    views = {}
+    with _users_lock:
+        for telegram_id in telegram_ids:
+            view = _peek(str(telegram_id))
+            if view is not None:
+                views[telegram_id] = view
+    return views
 
 
 def get_user_by_username(username: str) -> Optional[Dict[str, Any]]:
     """Find user by username (case-insensitive)"""
-    data = _load_json('profile.json')
-    if 'users' not in data:
+    _ensure_users_loaded()
+    
+    key = _username_key(username)
+    if not key:
         return None
-        
-    target_username = username.lstrip('@').lower()
+    if key in _archived_usernames:
+        _bring_back(_archived_usernames.get(key, ''))
     
-    for user in data['users'].values():
-        user_username = user.get('username', '').lower()
-        if user_username == target_username:
-            return user
-            
-    return None
+    with _users_lock:
+        str_id = _username_index.get(key)
+        if str_id is not None:
+            return copy.deepcopy(_users[str_id])
+        str_id = _archived_usernames.get(key)
+        return _read_archived(str_id)[0] if str_id else None
 
 
 def save_user(user_data: Dict[str, Any]) -> None:
     """Save user profile data"""
-    data = _load_json('profile.json')
-    
-    if 'users' not in data:
-        data['users'] = {}
+    _ensure_users_loaded()
     
     str_id = str(user_data['telegram_id'])
-    data['users'][str_id] = user_data
-    _save_json('profile.json', data)
+    _bring_back(str_id)
+    with _users_lock:
+        _restore_archived(str_id)
+        old_user = _users.get(str_id)
+        if old_user == user_data:
+            return
+        
+        old_key = _username_key(old_user.get('username')) if old_user else ''
+        new_key = _username_key(user_data.get('username'))
+        if old_key != new_key:
+            if old_key and _username_index.get(old_key) == str_id:
+                del _username_index[old_key]
+            if new_key:
+                _username_index[new_key] = str_id
+        
+        _users[str_id] = copy.deepcopy(user_data)
+        _dirty_users.add(str_id)
+        _journal_user(str_id, old_user, _users[str_id])
+        leaderboard.update_user(user_data)
 
 
 def get_user_characters(telegram_id: int) -> list:
     """Get list of characters owned by user"""
-    data = _load_json('userchar.json')
-    
-    if 'user_chars' not in data:
-        data['user_chars'] = {}
+    _ensure_users_loaded()
     
     str_id = str(telegram_id)
-    return data['user_chars'].get(str_id, [])
+    _bring_back(str_id)
+    with _users_lock:
+        if str_id in _archived:
+            return list(_read_archived(str_id)[1].values())
+        return copy.deepcopy(list(_user_chars.get(str_id, {}).values()))
 
 
 def add_character_to_user(telegram_id: int, char_id: str) -> None:
-    """Add a character to user's collection"""
-    data = _load_json('userchar.json')
-    
-    if 'user_chars' not in data:
-        data['user_chars'] = {}
+    """Add a character to user's collection, a duplicate raises its count"""
+    _ensure_users_loaded()
     
     str_id = str(telegram_id)
+    _bring_back(str_id)
     
-    if str_id not in data['user_chars']:
-        data['user_chars'][str_id] = []
-    
-    # Add character with default level 1
-    char_entry = {
-        'char_id': char_id,
-        'level': 1
-    }
-    data['user_chars'][str_id].append(char_entry)
-    _save_json('userchar.json', data)
+    with _users_lock:
+        _restore_archived(str_id)
+        old_chars = _user_chars.get(str_id, {})
+        chars = dict(old_chars)
+        char = chars.get(char_id)
+        if char:
+            chars[char_id] = {**char, 'count': char.get('count', 1) + 1}
+        else:
+            # Add character with default level 1
+            chars[char_id] = {'char_id': char_id, 'level': 1, 'count': 1}
+        _user_chars[str_id] = chars
+        _dirty_chars.add(str_id)
+        _journal_chars(str_id, old_chars, chars)
 
 
 def get_user_character(telegram_id: int, char_id: str) -> Optional[Dict]:
     """Get specific character data for user"""
-    chars = get_user_characters(telegram_id)
-    for char in chars:
-        if char['char_id'] == char_id:
-            return char
-    return None
+    _ensure_users_loaded()
+    
+    str_id = str(telegram_id)
+    _bring_back(str_id)
+    with _users_lock:
+        if str_id in _archived:
+            return _read_archived(str_id)[1].get(char_id)
+        char = _user_chars.get(str_id, {}).get(char_id)
+        return copy.deepcopy(char) if char else None
 
 
 def update_user_character(telegram_id: int, char_id: str, updates: Dict) -> None:
     """Update specific character for user"""
-    data = _load_json('userchar.json')
-    
-    if 'user_chars' not in data:
-        return
+    _ensure_users_loaded()
     
     str_id = str(telegram_id)
+    _bring_back(str_id)
     
-    if str_id not in data['user_chars']:
-        return
+    with _users_lock:
+        _restore_archived(str_id)
+        old_chars = _user_chars.get(str_id, {})
+        if char_id not in old_chars:
+            return
+        
+        # Entries are replaced, never mutated, so old_chars stays a valid journal base
+        chars = dict(old_chars)
+        chars[char_id] = {**copy.deepcopy(old_chars[char_id]), **updates}
+        _user_chars[str_id] = chars
+        _dirty_chars.add(str_id)
+        _journal_chars(str_id, old_chars, chars)
+
+
+def iter_users(batch_size: int = 1000) -> Iterator[Tuple[Dict[str, Any], Dict[str, Dict[str, Any]]]]:
+    """Yield (profile, characters keyed by char_id) for every user, archived ones included
+    The lock is only held while copying one batch, so the bot keeps running.
+    """
+    _ensure_users_loaded()
     
-    for char in data['user_chars'][str_id]:
-        if char['char_id'] == char_id:
-            char.update(updates)
-            break
+    with _users_lock:
+        str_ids = list(_users)
+    for start in range(0, len(str_ids), batch_size):
+        with _users_lock:
+            batch = [(copy.deepcopy(_users[str_id]), copy.deepcopy(_user_chars.get(str_id, {})))
+                     for str_id in str_ids[start:start + batch_size] if str_id in _users]
+        yield from batch
     
-    _save_json('userchar.json', data)
+    with _users_lock:
+        archived_ids = set(_archived)
+    if archived_ids:
+        archive = _load_json(ARCHIVE_FILE)
+        for str_id in archived_ids:
+            yield archive['users'][str_id], archive.get('user_chars', {}).get(str_id, {})
 
 
 def get_user_skill_slots(telegram_id: int, char_id: str) -> Dict[int, int]:
     """Get skill slot assignments for a character"""
-    user = get_user(telegram_id)
+    user = peek_user(telegram_id)
+    if not user:
+        return {}
     skill_slots = user.get('skill_slots', {})
-    return skill_slots.get(char_id, {})
+    return dict(skill_slots.get(char_id, {}))
 
 
 def set_user_skill_slot(telegram_id: int, char_id: str, slot: int, ability_index: int) -> None:
     """Set ability in skill slot"""
-    user = get_user(telegram_id)
+    _bring_back(str(telegram_id))
+    with _users_lock:
+        user = get_user(telegram_id)
+        
+        if 'skill_slots' not in user:
+            user['skill_slots'] = {}
+        
+        if char_id not in user['skill_slots']:
+            user['skill_slots'][char_id] = {}
+        
+        user['skill_slots'][char_id][str(slot)] = ability_index
+        save_user(user)
+
+
+def commit_user(user_data: Dict[str, Any], characters: Dict[str, Dict[str, Any]]) -> None:
+    """Save profile and character collection (keyed by char_id) of one user in a single step"""
+    str_id = str(user_data['telegram_id'])
+    _bring_back(str_id)
+    with _users_lock:
+        save_user(user_data)
+        old_chars = _user_chars.get(str_id, {})
+        if old_chars != characters:
+            _user_chars[str_id] = copy.deepcopy(characters)
+            _dirty_chars.add(str_id)
+            _journal_chars(str_id, old_chars, _user_chars[str_id])
+
+
+def grant_users(grant: Grant, progress: Optional[Progress] = None, batch_size: int = 1000) -> int:
+    """Apply grant(profile, characters) to every user, archived ones included,
+    and return how many it changed. The lock is held one batch at a time and
+    the whole run is made durable with a single journal sync.
+    """
+    _ensure_users_loaded()
+    
+    with _users_lock:
+        str_ids = list(_users)
+        archived_ids = list(_archived)
+    archive = _load_json(ARCHIVE_FILE) if archived_ids else {}
+    str_ids += archived_ids
+    
+    scanned = granted = 0
+    for start in range(0, len(str_ids), batch_size):
+        with _users_lock:
+            for str_id in str_ids[start:start + batch_size]:
+                if str_id in _users:
+                    user, chars = copy.deepcopy((_users[str_id], _user_chars.get(str_id, {})))
+                elif str_id in _archived and str_id in archive.get('users', {}):
+                    user, chars = copy.deepcopy(_read_archived(str_id, archive))
+                else:
+                    continue
+                scanned += 1
+                if grant(user, chars):
+                    # A grant isn't activity: the user stays due for the next archive pass
+                    _restore_archived(str_id, archive, seen=False)
+                    commit_user(user, chars)
+                    granted += 1
+        if progress:
+            progress(scanned, granted)
+    
+    sync_users()
+    return granted
+
+
+# The functions above are the 'json' backend; any other one replaces them
+if STORAGE_BACKEND != 'json':
+    _backend = load_backend(STORAGE_BACKEND)
+    load_users = _backend.load_users
+    flush_users = _backend.flush_users
+    sync_users = _backend.sync_users
+    allocate_sid = _backend.allocate_sid
+    get_user = _backend.get_user
+    peek_user = _backend.peek_user
+    peek_users = _backend.peek_users
+    get_user_by_username = _backend.get_user_by_username
+    save_user = _backend.save_user
+    iter_users = _backend.iter_users
+    get_user_characters = _backend.get_user_characters
+    add_character_to_user = _backend.add_character_to_user
+    get_user_character = _backend.get_user_character
+    update_user_character = _backend.update_user_character
+    get_user_skill_slots = _backend.get_user_skill_slots
+    set_user_skill_slot = _backend.set_user_skill_slot
+    commit_user = _backend.commit_user
+    grant_users = _backend.grant_users
+
+
+# Async API: the same calls, run in the storage I/O thread pool so that
+# disk access and (de)serialization never block the event loop
+async def _run_io(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_io_executor, functools.partial(func, *args))
+
+
+async def load_users_async() -> None:
+    await _run_io(load_users)
+
+
+async def flush_users_async(force: bool = False) -> None:
+    await _run_io(flush_users, force)
+
+
+async def sync_users_async() -> None:
+    await _run_io(sync_users)
+
+
+# Group commit: handlers awaiting durability within GROUP_COMMIT_WINDOW are
+# released together after a single sync_users call
+_commit_waiters: List[asyncio.Future] = []
+_commit_task: Optional[asyncio.Task] = None
+
+
+async def _group_commit() -> None:
+    while _commit_waiters:
+        await asyncio.sleep(GROUP_COMMIT_WINDOW)
+        waiters = _commit_waiters[:]
+        _commit_waiters.clear()
+        try:
+            await sync_users_async()
+        except Exception as e:
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_exception(e)
+        else:
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+
+
+async def wait_durable() -> None:
+    """Wait until every change made before the call is on disk"""
+    global _commit_task
+    waiter = asyncio.get_running_loop().create_future()
+    _commit_waiters.append(waiter)
+    if _commit_task is None or _commit_task.done():
+        _commit_task = asyncio.create_task(_group_commit())
+    await waiter
+
+
+async def get_user_async(telegram_id: int) -> Dict[str, Any]:
+    return await _run_io(get_user, telegram_id)
+
+
+async def peek_user_async(telegram_id: int) -> Optional[Mapping[str, Any]]:
+    return await _run_io(peek_user, telegram_id)
+
+
+async def peek_users_async(telegram_ids: Iterable[int]) -> Dict[int, Mapping[str, Any]]:
+    return await _run_io(peek_users, list(telegram_ids))
+
+
+async def get_user_by_username_async(username: str) -> Optional[Dict[str, Any]]:
+    return await _run_io(get_user_by_username, username)
+
+
+async def save_user_async(user_data: Dict[str, Any]) -> None:
+    await _run_io(save_user, user_data)
+
+
+async def get_user_characters_async(telegram_id: int) -> list:
+    return await _run_io(get_user_characters, telegram_id)
+
+
+async def add_character_to_user_async(telegram_id: int, char_id: str) -> None:
+    await _run_io(add_character_to_user, telegram_id, char_id)
+
+
+async def get_user_character_async(telegram_id: int, char_id: str) -> Optional[Dict]:
+    return await _run_io(get_user_character, telegram_id, char_id)
+
+
+async def update_user_character_async(telegram_id: int, char_id: str, updates: Dict) -> None:
+    await _run_io(update_user_character, telegram_id, char_id, updates)
+
+
+async def get_user_skill_slots_async(telegram_id: int, char_id: str) -> Dict[int, int]:
+    return await _run_io(get_user_skill_slots, telegram_id, char_id)
+
+
+async def set_user_skill_slot_async(telegram_id: int, char_id: str, slot: int, ability_index: int) -> None:
+    await _run_io(set_user_skill_slot, telegram_id, char_id, slot, ability_index)
+
+
+async def commit_user_async(user_data: Dict[str, Any], characters: Dict[str, Dict[str, Any]]) -> None:
+    await _run_io(commit_user, user_data, characters)
+
+
+# A bulk grant writes users outside of transaction(): it starts once the open
+# transactions are done, and new ones wait until it has finished
+_bulk_gate = asyncio.Condition()
+_bulk_running = False
+_open_transactions = 0
+
+
+async def grant_users_async(grant: Grant, progress: Optional[Progress] = None) -> int:
+    """Apply grant to every user as one batch, see grant_users"""
+    global _bulk_running
+    async with _bulk_gate:
+        await _bulk_gate.wait_for(lambda: not _bulk_running)
+        _bulk_running = True
+        await _bulk_gate.wait_for(lambda: _open_transactions == 0)
+    try:
+        return await _run_io(grant_users, grant, progress)
+    finally:
+        async with _bulk_gate:
+            _bulk_running = False
+            _bulk_gate.notify_all()
+
+
+class UserTransaction:
+    """Consistent view of one user's profile, characters and skill slots
+    Handed out by transaction(); changes are committed when the block exits.
+    """
     
-    if 'skill_slots' not in user:
-        user['skill_slots'] = {}
+    def __init__(self, telegram_id: int):
+        self.telegram_id = telegram_id
+        self.user = get_user(telegram_id)
+        self.characters = {char['char_id']: char for char in get_user_characters(telegram_id)}
+        self._original = copy.deepcopy((self.user, self.characters))
     
-    if char_id not in user['skill_slots']:
-        user['skill_slots'][char_id] = {}
+    @property
+    def changed(self) -> bool:
+        return (self.user, self.characters) != self._original
     
-    user['skill_slots'][char_id][str(slot)] = ability_index
-    save_user(user)
+    def get_character(self, char_id: str) -> Optional[Dict]:
+        return self.characters.get(char_id)
+    
+    def add_character(self, char_id: str) -> None:
+        char = self.characters.get(char_id)
+        if char:
+            char['count'] = char.get('count', 1) + 1
+        else:
+            self.characters[char_id] = {'char_id': char_id, 'level': 1, 'count': 1}
+    
+    def update_character(self, char_id: str, updates: Dict) -> None:
+        char = self.get_character(char_id)
+        if char:
+            char.update(updates)
+    
+    def get_skill_slots(self, char_id: str) -> Dict[int, int]:
+        return self.user.get('skill_slots', {}).get(char_id, {})
+    
+    def set_skill_slot(self, char_id: str, slot: int, ability_index: int) -> None:
+        self.user.setdefault('skill_slots', {}).setdefault(char_id, {})[str(slot)] = ability_index
+
+
+# Per-user locks; an entry disappears once no transaction holds it
+_user_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+
+def _get_user_lock(telegram_id: int) -> asyncio.Lock:
+    lock = _user_locks.get(telegram_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _user_locks[telegram_id] = lock
+    return lock
+
+
+@asynccontextmanager
+async def transaction(telegram_id: int, durable: bool = True):
+    """Atomic read-modify-write of one user's data
+    
+    async with transaction(user_id) as tx:
+        tx.user['souls'] += 100
+        tx.add_character('Saber')
+    
+    Transactions of the same user run one at a time, other users are not
+    blocked. Nothing is written if the block raises or changes nothing.
+    With durable set the block exits only once the change is on disk.
+    """
+    global _open_transactions
+    async with _bulk_gate:
+        await _bulk_gate.wait_for(lambda: not _bulk_running)
+        _open_transactions += 1
+    try:
+        lock = _get_user_lock(telegram_id)
+        async with lock:
+            tx = await _run_io(UserTransaction, telegram_id)
+            yield tx
+            changed = tx.changed
+            if changed:
+                tx.user['last_seen'] = datetime.now().isoformat()
+                await commit_user_async(tx.user, tx.characters)
+    finally:
+        async with _bulk_gate:
+            _open_transactions -= 1
+            _bulk_gate.notify_all()
+    
+    # Waiting outside the lock lets the next transaction of this user start
+    if changed and durable:
+        await wait_durable()
+
+
+async def touch_user_async(telegram_id: int) -> None:
+    """Refresh last_seen of an existing user who used the bot, at most every LAST_SEEN_INTERVAL"""
+    user = await peek_user_async(telegram_id)
+    if user is None:
+        return
+    last_seen = user.get('last_seen')
+    if last_seen and (datetime.now() - datetime.fromisoformat(last_seen)).total_seconds() < LAST_SEEN_INTERVAL:
+        return
+    async with transaction(telegram_id, durable=False) as tx:
+        tx.user['last_seen'] = datetime.now().isoformat()
 
 
 # Duel state storage (in-memory for active duels)
 active_duels = {}  # {user_id: duel_data}
-duel_queue = []  # List of user_ids waiting for match
+duel_queue = Matchmaker()  # Players waiting for a ranked duel
+
+# Duel state survives restarts: every change is appended to storage/duels.jsonl
+# as one line and folded into storage/duels.json every DUEL_COMPACT_RECORDS.
+# A started duel is journaled once in full, later saves write only the new
+# turn log entries and the fields that changed since the previous line.
+DUELS_SNAPSHOT = 'duels.json'
+DUEL_COMPACT_RECORDS = int(os.getenv('STORAGE_DUEL_COMPACT_RECORDS', '1000'))
+DUEL_TRANSIENT_KEYS = ('message',)  # Live aiogram objects, can't be stored
+
+# Finished duels (sides, seed, turn log, rewards) are appended one per line
+# to storage/duel_log.jsonl for replay_duels.py
+DUEL_LOG_FILE = os.path.join(STORAGE_DIR, 'duel_log.jsonl')
+DUEL_LOG_ENABLED = os.getenv('STORAGE_DUEL_LOG', '1') != '0'
+
+_duel_journal = Journal(STORAGE_DIR, name='duels')
+_pending_duels: Dict[str, Dict[str, Any]] = {}  # Stored form of duel.pending_friendly_duels
+# Last journaled form of each duel, turn log replaced by its length, to diff the next save against
+_journaled_duels: Dict[str, Dict[str, Any]] = {}
+_duel_compaction: Optional[asyncio.Future] = None  # Snapshot being written in the I/O pool
+
+
+def _encode_duel(duel: Dict) -> Dict:
+    data = {key: value for key, value in duel.items() if key not in DUEL_TRANSIENT_KEYS}
+    if data.get('state') is not None:
+        data['state'] = data['state'].to_dict()
+    return data
+
+
+def _decode_duel(data: Dict) -> Dict:
+    if data.get('state') is not None:
+        data['state'] = DuelState.from_dict(data['state'])
+    elif 'user1_hp' in data:
+        # Saved before duel_engine: one key per user and field
+        data['state'] = DuelState.from_legacy(data) if data['status'] == 'active' else None
+        for key in [key for key in data if key.startswith(('user1_', 'user2_')) and key not in ('user1_id', 'user2_id')]:
+            del data[key]
+        for key in ('current_turn', 'winner', 'last_damage', 'last_energy_change'):
+            data.pop(key, None)
+    return data
+
+
+def _journaled_form(data: Dict) -> Dict:
+    """Encoded duel with the turn log replaced by its length"""
+    if data.get('state') is None:
+        return data
+    return {**data, 'state': {**data['state'], 'log': len(data['state']['log'])}}
+
+
+def _duel_delta(old: Dict, new: Dict) -> Optional[Dict]:
+    """duel_turn record turning the journaled form old into the encoded duel new,
+    None if only a full record can do it (the duel started or was restarted)
+    """
+    old_state, state = old.get('state'), new.get('state')
+    if old_state is None or state is None or old_state['seed'] != state['seed'] or old_state['log'] > len(state['log']):
+        return None
+    
+    record = {'op': 'duel_turn', 'id': str(new['user1_id'])}
+    fields = {key: value for key, value in new.items() if key != 'state' and old.get(key) != value}
+    if fields:
+        record['fields'] = fields
+    changes = {}
+    for key, value in state.items():
+        if key in ('a', 'b'):
+            side = {name: field for name, field in value.items() if old_state[key].get(name) != field}
+            if side:
+                changes[key] = side
+        elif key != 'log' and old_state.get(key) != value:
+            changes[key] = value
+    if changes:
+        record['state'] = changes
+    if len(state['log']) > old_state['log']:
+        record['log'] = state['log'][old_state['log']:]
+    return record
+
+
+def _apply_duel_delta(data: Dict, record: Dict[str, Any]) -> None:
+    """Replay a duel_turn record onto the stored form of its duel"""
+    data.update(record.get('fields', {}))
+    state = data['state']
+    for key, value in record.get('state', {}).items():
+        if key in ('a', 'b'):
+            state[key].update(value)
+        else:
+            state[key] = value
+    state['log'].extend(record.get('log', []))
+
+
+def _record_duel(record: Dict[str, Any]) -> None:
+    if not _duel_journal.is_open:
+        return  # load_duels wasn't called, e.g. in a script
+    _duel_journal.append(record)
+    if _duel_journal.pending >= DUEL_COMPACT_RECORDS and not _duel_compaction_running():
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            compact_duels()
+            return
+        _start_duel_compaction()
+
+
+def _duels_snapshot() -> Dict[str, Any]:
+    """Rotate the duel journal and capture all duel state, on the thread that changes duels"""
+    duels = {}
+    _journaled_duels.clear()
+    for duel in active_duels.values():
+        data = _encode_duel(duel)
+        if data.get('state') is not None:
+            data['state']['log'] = list(data['state']['log'])  # Keeps growing while the snapshot is written
+        duels[str(duel['user1_id'])] = data
+        _journaled_duels[str(duel['user1_id'])] = _journaled_form(data)
+    
+    return {
+        'duels': duels,
+        'queue': [[entry.user_id, entry.rating, entry.joined] for entry in duel_queue],
+        'pending': dict(_pending_duels),
+        'journal_seq': _duel_journal.rotate(sync=False)  # The snapshot is fsynced instead
+    }
+
+
+def _write_duels_snapshot(snapshot: Dict[str, Any]) -> None:
+    _save_json(DUELS_SNAPSHOT, snapshot)
+    _duel_journal.drop_segments(snapshot['journal_seq'])
+
+
+def _duel_compaction_running() -> bool:
+    return _duel_compaction is not None and not _duel_compaction.done()
+
+
+def _duel_compaction_done(future: asyncio.Future) -> None:
+    if not future.cancelled() and future.exception() is not None:
+        print(f"Error compacting duels: {future.exception()}")
 
 
-def add_to_duel_queue(user_id: int) -> None:
-    """Add user to duel matchmaking queue"""
+def _start_duel_compaction() -> asyncio.Future:
+    global _duel_compaction
+    _duel_compaction = asyncio.ensure_future(_run_io(_write_duels_snapshot, _duels_snapshot()))
+    _duel_compaction.add_done_callback(_duel_compaction_done)
+    return _duel_compaction
+
+
+def compact_duels() -> None:
+    """Write all duel state into duels.json and drop the journal behind it"""
+    _write_duels_snapshot(_duels_snapshot())
+
+
+async def compact_duels_async() -> None:
+    """compact_duels with the write in the storage I/O pool, after any compaction still running"""
+    if _duel_compaction_running():
+        await asyncio.wait([_duel_compaction])
+    await _start_duel_compaction()
+
+
+def load_duels() -> Dict[int, Dict[str, Any]]:
+    """Restore active_duels and duel_queue from disk
+    Returns the pending friendly challenges for duel.pending_friendly_duels.
+    """
+    snapshot = _load_json(DUELS_SNAPSHOT)
+    duels = snapshot.get('duels', {})
+    queue = {}
+    for item in snapshot.get('queue', []):
+        if isinstance(item, int):  # Saved before matchmaking: just the user_id
+            item = [item, None, None]
+        queue[item[0]] = item
+    pending = snapshot.get('pending', {})
+    snapshot_seq = snapshot.get('journal_seq', 0)
+    
+    _duel_journal.close()
+    last_seq = snapshot_seq
+    for record in _duel_journal.read():
+        last_seq = max(last_seq, record['seq'])
+        if record['seq'] <= snapshot_seq:
+            continue
+        op = record['op']
+        if op == 'duel':
+            duels[record['id']] = record['duel']
+        elif op == 'duel_turn':
+            if record['id'] in duels:
+                _apply_duel_delta(duels[record['id']], record)
+        elif op == 'duel_end':
+            duels.pop(record['id'], None)
+        elif op == 'queue':  # Whole queue, written before matchmaking
+            queue = {user_id: [user_id, None, None] for user_id in record['queue']}
+        elif op == 'queue_add':
+            queue[record['id']] = [record['id'], record['rating'], record['joined']]
+        elif op == 'queue_remove':
+            queue.pop(record['id'], None)
+        elif op == 'pending':
+            pending[record['id']] = record['pending']
+        elif op == 'pending_end':
+            pending.pop(record['id'], None)
+    _duel_journal.open(last_seq)
+    
+    active_duels.clear()
+    for data in duels.values():
+        duel = _decode_duel(data)
+        active_duels[duel['user1_id']] = duel
+        active_duels[duel['user2_id']] = duel
+    duel_queue.clear()
+    for user_id, rating, joined in queue.values():
+        if rating is None:
+            user = peek_user(user_id)
+            rating = rating_of(user) if user else 0
+        duel_queue.add(user_id, rating, joined)
+    _pending_duels.clear()
+    _pending_duels.update(pending)
+    
+    # Start the new run from a fresh snapshot
+    compact_duels()
+    if duels or queue or pending:
+        print(f"Restored {len(duels)} duels, {len(queue)} queued players, {len(pending)} friendly challenges")
+    
+    return {
+        int(target_id): {**challenge, 'created_at': datetime.fromisoformat(challenge['created_at'])}
+        for target_id, challenge in pending.items()
+    }
+
+
+def save_duel(duel: Dict) -> None:
+    """Persist the current state of a duel, call after every change"""
+    duel_id = str(duel['user1_id'])
+    data = _encode_duel(duel)
+    old = _journaled_duels.get(duel_id)
+    record = _duel_delta(old, data) if old is not None else None
+    _journaled_duels[duel_id] = _journaled_form(data)
+    _record_duel(record or {'op': 'duel', 'id': duel_id, 'duel': data})
+
+
+def save_pending_duel(target_id: int, challenge: Dict[str, Any]) -> None:
+    """Persist a friendly challenge waiting for target_id to answer"""
+    stored = {**challenge, 'created_at': challenge['created_at'].isoformat()}
+    _pending_duels[str(target_id)] = stored
+    _record_duel({'op': 'pending', 'id': str(target_id), 'pending': stored})
+
+
+def drop_pending_duel(target_id: int) -> None:
+    """Forget a friendly challenge that was answered or expired"""
+    if _pending_duels.pop(str(target_id), None) is not None:
+        _record_duel({'op': 'pending_end', 'id': str(target_id)})
+
+
+def add_to_duel_queue(user_id: int, rating: int = 0) -> None:
+    """Add user to duel matchmaking queue, a user already waiting keeps their place"""
     if user_id not in duel_queue:
-        duel_queue.append(user_id)
+        joined = time.time()
+        duel_queue.add(user_id, rating, joined)
+        _record_duel({'op': 'queue_add', 'id': user_id, 'rating': rating, 'joined': joined})
 
 
 def remove_from_duel_queue(user_id: int) -> None:
     """Remove user from duel queue"""
-    if user_id in duel_queue:
-        duel_queue.remove(user_id)
+    if duel_queue.remove(user_id):
+        _record_duel({'op': 'queue_remove', 'id': user_id})
 
 
-def get_queue_match(user_id: int) -> Optional[int]:
-    """Try to find a match in queue, returns opponent_id or None"""
-    for opponent_id in duel_queue:
-        if opponent_id != user_id:
-            return opponent_id
-    return None
+def get_queue_match(user_id: int, rating: int = 0) -> Optional[int]:
+    """Try to find an opponent close in rating for a user joining the queue, returns opponent_id or None"""
+    return duel_queue.find_for(user_id, rating)
+
+
+def match_duel_queue() -> List[Tuple[int, int]]:
+    """Pair waiting users whose rating windows overlap and take them out of the queue"""
+    pairs = duel_queue.match()
+    for pair in pairs:
+        for user_id in pair:
+            _record_duel({'op': 'queue_remove', 'id': user_id})
+    return pairs
 
 
 def create_duel(user1_id: int, user2_id: int, is_friendly: bool = False) -> Dict:
@@ -210,20 +1234,16 @@ def create_duel(user1_id: int, user2_id: int, is_friendly: bool = False) -> Dict
         'user1_id': user1_id,
         'user2_id': user2_id,
         'is_friendly': is_friendly,
-        'current_turn': user1_id,
-        'user1_hp': 0,  # Will be set when duel starts
-        'user2_hp': 0,
-        'user1_energy': 10,
-        'user2_energy': 10,
-        'user1_char': None,
-        'user2_char': None,
+        'state': None,  # duel_engine.DuelState, set when the duel starts
         'status': 'pending',  # pending, accepted, active, finished
-        'last_damage': {user1_id: 0, user2_id: 0},
-        'last_energy_change': {user1_id: 0, user2_id: 0},
         'last_action_log': None
     }
     active_duels[user1_id] = duel_data
     active_duels[user2_id] = duel_data
+    # Players in a duel can't be matched
+    remove_from_duel_queue(user1_id)
+    remove_from_duel_queue(user2_id)
+    save_duel(duel_data)
     return duel_data
 
 
@@ -242,3 +1262,36 @@ def end_duel(user_id: int) -> None:
             del active_duels[user1_id]
         if user2_id in active_duels:
             del active_duels[user2_id]
+        _journaled_duels.pop(str(user1_id), None)
+        _record_duel({'op': 'duel_end', 'id': str(user1_id)})
+        state = duel.get('state')
+        if state is not None and state.winner is not None:
+            log_finished_duel(duel)
+
+
+def log_finished_duel(duel: Dict) -> None:
+    """Append the replay record of a finished duel to the duel log,
+    in the storage I/O pool when called from the event loop
+    """
+    if not DUEL_LOG_ENABLED or not _duel_journal.is_open:
+        return
+    record = duel['state'].replay_record()
+    record['friendly'] = duel.get('is_friendly', False)
+    record['rewards'] = duel.get('rewards')
+    record['finished_at'] = datetime.now().isoformat(timespec='seconds')
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        _append_duel_log(record)
+        return
+    loop.run_in_executor(_io_executor, _append_duel_log, record).add_done_callback(_duel_log_done)
+
+
+def _append_duel_log(record: Dict[str, Any]) -> None:
+    with open(DUEL_LOG_FILE, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n')
+
+
+def _duel_log_done(future: asyncio.Future) -> None:
+    if not future.cancelled() and future.exception() is not None:
+        print(f"Error writing duel log: {future.exception()}")
@@ -0,0 +1,83 @@
+"""
+Storage backend interface for Soul Meter bot
+Every backend is a module exposing the functions of StorageBackend;
+storage.py picks one by STORAGE_BACKEND and re-exports its functions,
+so handlers never know which one is running.
+
+    json     profile.json/userchar.json in memory with a journal (storage.py)
+    sqlite   one SQLite database (storage_sqlite.py)
+    sharded  one file per user (storage_sharded.py)
+    dbm      stdlib dbm key-value file (storage_dbm.py)
+"""
+import importlib
+from types import ModuleType
+from typing import Protocol, Optional, Dict, Any, Callable, Iterable, Iterator, Mapping, Tuple
+
+# grant(profile, characters) edits both in place and returns True if it changed them
+Grant = Callable[[Dict[str, Any], Dict[str, Dict[str, Any]]], bool]
+# progress(scanned, granted) is called from the I/O thread as a bulk grant advances
+Progress = Callable[[int, int], None]
+
+BACKENDS = {
+    'json': 'storage',
+    'sqlite': 'storage_sqlite',
+    'sharded': 'storage_sharded',
+    'dbm': 'storage_dbm',
+}
+
+
+class StorageBackend(Protocol):
+    """Functions a storage backend module has to provide"""
+
+    def load_users(self) -> None: ...
+
+    def flush_users(self, force: bool = False) -> None: ...
+
+    def sync_users(self) -> None: ...
+
+    def allocate_sid(self) -> int: ...
+
+    def get_user(self, telegram_id: int) -> Dict[str, Any]: ...
+
+    def peek_user(self, telegram_id: int) -> Optional[Mapping[str, Any]]: ...
+
+    def peek_users(self, telegram_ids: Iterable[int]) -> Dict[int, Mapping[str, Any]]: ...
+
+    def get_user_by_username(self, username: str) -> Optional[Dict[str, Any]]: ...
+
+    def save_user(self, user_data: Dict[str, Any]) -> None: ...
+
+    def iter_users(self) -> Iterator[Tuple[Dict[str, Any], Dict[str, Dict[str, Any]]]]: ...
+
+    def get_user_characters(self, telegram_id: int) -> list: ...
+
+    def add_character_to_user(self, telegram_id: int, char_id: str) -> None: ...
+
+    def get_user_character(self, telegram_id: int, char_id: str) -> Optional[Dict]: ...
+
+    def update_user_character(self, telegram_id: int, char_id: str, updates: Dict) -> None: ...
+
+    def get_user_skill_slots(self, telegram_id: int, char_id: str) -> Dict[int, int]: ...
+
+    def set_user_skill_slot(self, telegram_id: int, char_id: str, slot: int, ability_index: int) -> None: ...
+
+    def commit_user(self, user_data: Dict[str, Any], characters: Dict[str, Dict[str, Any]]) -> None: ...
+
+    def grant_users(self, grant: Grant, progress: Optional[Progress] = None) -> int: ...
+
+
+BACKEND_API = tuple(
+    name for name, value in vars(StorageBackend).items()
+    if callable(value) and not name.startswith('_')
+)
+
+
+def load_backend(name: str) -> ModuleType:
+    """Import the backend module registered under name and check it is complete"""
+    if name not in BACKENDS:
+        raise RuntimeError(f"Unknown STORAGE_BACKEND {name!r}, expected one of: {', '.join(BACKENDS)}")
+    module = importlib.import_module(BACKENDS[name])
+    missing = [func for func in BACKEND_API if not callable(getattr(module, func, None))]
+    if missing:
+        raise RuntimeError(f"Storage backend {name!r} lacks {', '.join(missing)}")
+    return module
@@ -0,0 +1,340 @@
+"""
+dbm storage backend for Soul Meter bot
+Keeps every user as one record {'profile', 'characters'} in a stdlib dbm
+key-value file (gdbm when available, else ndbm or dbm.dumb), together with
+the username index and the SID counter, so startup only scans keys for the
+leaderboards. Enabled with STORAGE_BACKEND=dbm.
+
+gdbm is opened in fast mode and, like dbm.dumb, only synced on flush and
+for durable transactions (see storage.wait_durable).
+
+One-shot import of the existing JSON files, with the journal written
+since their last compaction replayed on top (stop the bot first):
+    python storage_dbm.py import
+"""
+import argparse
+import dbm
+import os
+import threading
+from datetime import datetime
+from typing import Optional, Dict, Any, Iterable, Iterator, Tuple
+
+import leaderboard
+from storage_backend import Grant, Progress
+from storage_format import DEFAULT_FORMAT, dumps, loads, characters_by_id
+from storage_journal import load_tables
+
+DBM_PATH = os.getenv('STORAGE_DBM_PATH', os.path.join(os.path.dirname(__file__), 'storage', 'soulmeter.dbm'))
+
+USER_PREFIX = b'u:'
+USERNAME_PREFIX = b'n:'
+SID_KEY = b'next_sid'
+
+# dbm handles are not thread-safe: every access goes through this lock
+_db_lock = threading.RLock()
+_db = None
+
+
+def _open():
+    global _db
+    if _db is None:
+        os.makedirs(os.path.dirname(DBM_PATH), exist_ok=True)
+        try:
+            _db = dbm.open(DBM_PATH, 'cf')
+        except dbm.error + (ValueError,):  # Only gdbm takes the 'f' flag
+            _db = dbm.open(DBM_PATH, 'c')
+    return _db
+
+
+def _user_key(telegram_id: int) -> bytes:
+    return USER_PREFIX + str(telegram_id).encode()
+
+
+def _username_key(username: Optional[str]) -> str:
+    return (username or '').lstrip('@').lower()
+
+
+def _read_record(telegram_id: int) -> Optional[Dict[str, Any]]:
+    with _db_lock:
+        raw = _open().get(_user_key(telegram_id))
+    return loads(raw) if raw else None
+
+
+def _write_record(telegram_id: int, record: Dict[str, Any]) -> None:
+    raw = dumps(record, DEFAULT_FORMAT)
+    with _db_lock:
+        _open()[_user_key(telegram_id)] = raw
+
+
+def _index_username(old_user: Optional[Dict[str, Any]], new_user: Dict[str, Any]) -> None:
+    old_key = _username_key(old_user.get('username')) if old_user else ''
+    new_key = _username_key(new_user.get('username'))
+    if old_key == new_key:
+        return
+    telegram_id = str(new_user['telegram_id']).encode()
+    with _db_lock:
+        db = _open()
+        if old_key and db.get(USERNAME_PREFIX + old_key.encode()) == telegram_id:
+            del db[USERNAME_PREFIX + old_key.encode()]
+        if new_key:
+            db[USERNAME_PREFIX + new_key.encode()] = telegram_id
+
+
+def allocate_sid() -> int:
+    """Take the next SID from the counter key"""
+    with _db_lock:
+        db = _open()
+        sid = int(db.get(SID_KEY, b'1'))
+        db[SID_KEY] = str(sid + 1).encode()
+        return sid
+
+
+def load_users() -> None:
+    """Scan user records once to build the leaderboards"""
+    with _db_lock:
+        keys = [key for key in _open().keys() if key.startswith(USER_PREFIX)]
+
+    profiles = []
+    for key in keys:
+        record = _read_record(int(key[len(USER_PREFIX):]))
+        if record:
+            profile = record['profile']
+            profiles.append({field: profile.get(field) for field in ('telegram_id',) + leaderboard.LEADERBOARD_FIELDS})
+    leaderboard.rebuild(profiles)
+
+
+def flush_users(force: bool = False) -> None:
+    """Sync the dbm file, dbm.dumb writes its key directory only here"""
+    sync_users()
+
+
+def sync_users() -> None:
+    """Write everything stored so far to disk"""
+    with _db_lock:
+        db = _open()
+        if hasattr(db, 'sync'):
+            db.sync()
+
+
+def get_user(telegram_id: int) -> Dict[str, Any]:
+    """Get user profile or create new one if doesn't exist"""
+    with _db_lock:
+        record = _read_record(telegram_id)
+        if record:
+            return record['profile']
+
+        new_user = {
+            'telegram_id': telegram_id,
+            'sid': allocate_sid(),
+            'level': 1,
+            'souls': 0,
+            'exp': 0,
+            'trophy_souls': 0,
+            'trophies': 0,
+            'chests': {
+                'weak_soul': 0,
+                'time': 0,
+                'death': 0,
+                'infinity': 0
+            },
+            'active_char': None,
+            'last_up': None,
+            'up_count': 0,
+            'skill_slots': {},
+            'avatar': None,
+            'last_seen': datetime.now().isoformat()
+        }
+        _write_record(telegram_id, {'profile': new_user, 'characters': {}})
+
+    leaderboard.update_user(new_user)
+    return new_user
+
+
+def peek_user(telegram_id: int) -> Optional[Dict[str, Any]]:
+    """Read user profile without creating it, None if user doesn't exist"""
+    record = _read_record(telegram_id)
+    return record['profile'] if record else None
+
+
+def peek_users(telegram_ids: Iterable[int]) -> Dict[int, Dict[str, Any]]:
+    """Read several user profiles at once, unknown ids are left out"""
+    users = {}
+    for telegram_id in telegram_ids:
+        user = peek_user(telegram_id)
+        if user is not None:
+            users[telegram_id] = user
+    return users
+
+
+def get_user_by_username(username: str) -> Optional[Dict[str, Any]]:
+    """Find user by username (case-insensitive)"""
+    key = _username_key(username)
+    if not key:
+        return None
+    with _db_lock:
+        telegram_id = _open().get(USERNAME_PREFIX + key.encode())
+    return peek_user(int(telegram_id)) if telegram_id else None
+
+
+def save_user(user_data: Dict[str, Any]) -> None:
+    """Save user profile data"""
+    telegram_id = user_data['telegram_id']
+    with _db_lock:
+        record = _read_record(telegram_id) or {'characters': {}}
+        old_user = record.get('profile')
+        record['profile'] = user_data
+        _write_record(telegram_id, record)
+        _index_username(old_user, user_data)
+    leaderboard.update_user(user_data)
+
+
+def get_user_characters(telegram_id: int) -> list:
+    """Get list of characters owned by user"""
+    record = _read_record(telegram_id)
+    return list(record['characters'].values()) if record else []
+
+
+def add_character_to_user(telegram_id: int, char_id: str) -> None:
+    """Add a character to user's collection, a duplicate raises its count"""
+    with _db_lock:
+        get_user(telegram_id)  # Make sure the record exists
+        record = _read_record(telegram_id)
+        char = record['characters'].get(char_id)
+        if char:
+            char['count'] = char.get('count', 1) + 1
+        else:
+            record['characters'][char_id] = {'char_id': char_id, 'level': 1, 'count': 1}
+        _write_record(telegram_id, record)
+
+
+def get_user_character(telegram_id: int, char_id: str) -> Optional[Dict]:
+    """Get specific character data for user"""
+    record = _read_record(telegram_id)
+    return record['characters'].get(char_id) if record else None
+
+
+def update_user_character(telegram_id: int, char_id: str, updates: Dict) -> None:
+    """Update specific character for user"""
+    with _db_lock:
+        record = _read_record(telegram_id)
+        if not record or char_id not in record['characters']:
+            return
+
+        record['characters'][char_id].update(updates)
+        _write_record(telegram_id, record)
+
+
+def iter_users() -> Iterator[Tuple[Dict[str, Any], Dict[str, Dict[str, Any]]]]:
+    """Yield (profile, characters keyed by char_id) for every user, one record at a time"""
+    with _db_lock:
+        keys = sorted(key for key in _open().keys() if key.startswith(USER_PREFIX))
+    for key in keys:
+        record = _read_record(int(key[len(USER_PREFIX):]))
+        if record:
+            yield record['profile'], record['characters']
+
+
+def get_user_skill_slots(telegram_id: int, char_id: str) -> Dict[int, int]:
+    """Get skill slot assignments for a character"""
+    user = peek_user(telegram_id)
+    if not user:
+        return {}
+    skill_slots = user.get('skill_slots', {})
+    return skill_slots.get(char_id, {})
+
+
+def set_user_skill_slot(telegram_id: int, char_id: str, slot: int, ability_index: int) -> None:
+    """Set ability in skill slot"""
+    with _db_lock:
+        get_user(telegram_id)  # Make sure the record exists
+        record = _read_record(telegram_id)
+        user = record['profile']
+
+        if 'skill_slots' not in user:
+            user['skill_slots'] = {}
+
+        if char_id not in user['skill_slots']:
+            user['skill_slots'][char_id] = {}
+
+        user['skill_slots'][char_id][str(slot)] = ability_index
+        _write_record(telegram_id, record)
+
+
+def commit_user(user_data: Dict[str, Any], characters: Dict[str, Dict[str, Any]]) -> None:
+    """Save profile and character collection of one user in a single record write"""
+    telegram_id = user_data['telegram_id']
+    with _db_lock:
+        record = _read_record(telegram_id)
+        old_user = record['profile'] if record else None
+        _write_record(telegram_id, {'profile': user_data, 'characters': characters})
+        _index_username(old_user, user_data)
+    leaderboard.update_user(user_data)
+
+
+def grant_users(grant: Grant, progress: Optional[Progress] = None, batch_size: int = 1000) -> int:
+    """Apply grant(profile, characters) to every user and return how many it changed
+    The lock is held one batch at a time and the file is synced once at the end.
+    """
+    with _db_lock:
+        keys = sorted(key for key in _open().keys() if key.startswith(USER_PREFIX))
+
+    scanned = granted = 0
+    for start in range(0, len(keys), batch_size):
+        with _db_lock:
+            for key in keys[start:start + batch_size]:
+                telegram_id = int(key[len(USER_PREFIX):])
+                record = _read_record(telegram_id)
+                if not record:
+                    continue
+                scanned += 1
+                if grant(record['profile'], record['characters']):
+                    _write_record(telegram_id, record)
+                    leaderboard.update_user(record['profile'])
+                    granted += 1
+        if progress:
+            progress(scanned, granted)
+
+    sync_users()
+    return granted
+
+
+def import_json(profile_path: str, userchar_path: str) -> Dict[str, int]:
+    """Copy profile.json and userchar.json into the dbm file
+    Returns counts of imported users and characters.
+    """
+    profiles, user_chars = load_tables(profile_path, userchar_path)
+
+    users = profiles.get('users', {})
+    char_count = 0
+
+    with _db_lock:
+        for str_id, user in users.items():
+            chars = characters_by_id(user_chars.get(str_id, []))
+            _write_record(int(str_id), {'profile': user, 'characters': chars})
+            _index_username(None, user)
+            char_count += len(chars)
+
+        orphans = set(user_chars) - set(users)
+        if orphans:
+            print(f"Skipping characters of {len(orphans)} users without a profile: {', '.join(sorted(orphans))}")
+
+        next_sid = max([profiles.get('next_sid', 1)] + [u['sid'] + 1 for u in users.values()])
+        _open()[SID_KEY] = str(next_sid).encode()
+        sync_users()
+
+    return {'users': len(users), 'characters': char_count}
+
+
+if __name__ == "__main__":
+    storage_dir = os.path.join(os.path.dirname(__file__), 'storage')
+
+    parser = argparse.ArgumentParser(description="Soul Meter dbm storage tools")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    import_parser = subparsers.add_parser('import', help="Import profile.json and userchar.json")
+    import_parser.add_argument('--profile', default=os.path.join(storage_dir, 'profile.json'))
+    import_parser.add_argument('--userchar', default=os.path.join(storage_dir, 'userchar.json'))
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        counts = import_json(args.profile, args.userchar)
+        print(f"Imported {counts['users']} users and {counts['characters']} characters into {DBM_PATH}")
@@ -0,0 +1,129 @@
+"""
+Serialization and layout of storage files for Soul Meter bot
+STORAGE_FORMAT selects how files are written:
+    pretty  - indented JSON (the original layout)
+    compact - JSON without whitespace (default)
+    msgpack - MessagePack, needs the optional msgpack package
+    marshal - Python marshal, fastest, only readable by CPython
+Binary formats start with a magic header, so load_file reads any file
+whatever format it was written in and old JSON files keep working.
+Any format can additionally be gzip-compressed.
+"""
+import gzip
+import json
+import marshal
+import os
+from typing import Any, Dict, Iterable, List, Union
+
+try:
+    import msgpack
+except ImportError:  # Only needed for STORAGE_FORMAT=msgpack
+    msgpack = None
+
+FORMATS = ('pretty', 'compact', 'msgpack', 'marshal')
+
+MSGPACK_MAGIC = b'SMmp1\n'
+MARSHAL_MAGIC = b'SMma1\n'
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def check_format(fmt: str) -> str:
+    """Validate a format name, raising if it can't be used here"""
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown storage format {fmt!r}, expected one of {', '.join(FORMATS)}")
+    if fmt == 'msgpack' and msgpack is None:
+        raise RuntimeError("STORAGE_FORMAT=msgpack requires the msgpack package (pip install msgpack)")
+    return fmt
+
+
+DEFAULT_FORMAT = check_format(os.getenv('STORAGE_FORMAT', 'compact').lower())
+
+
+def dumps(data: Any, fmt: str = DEFAULT_FORMAT) -> bytes:
+    if fmt == 'pretty':
+        return json.dumps(data, ensure_ascii=False, indent=2).encode('utf-8')
+    if fmt == 'compact':
+        return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    if fmt == 'msgpack':
+        return MSGPACK_MAGIC + msgpack.packb(data, use_bin_type=True)
+    if fmt == 'marshal':
+        return MARSHAL_MAGIC + marshal.dumps(data)
+    raise ValueError(f"Unknown storage format {fmt!r}")
+
+
+def loads(raw: bytes) -> Any:
+    """Decode data written by dumps in any format, compressed or not"""
+    if raw.startswith(GZIP_MAGIC):
+        raw = gzip.decompress(raw)
+    if raw.startswith(MSGPACK_MAGIC):
+        if msgpack is None:
+            raise RuntimeError("File is in msgpack format but the msgpack package is not installed")
+        return msgpack.unpackb(raw[len(MSGPACK_MAGIC):], raw=False)
+    if raw.startswith(MARSHAL_MAGIC):
+        return marshal.loads(raw[len(MARSHAL_MAGIC):])
+    return json.loads(raw)
+
+
+def load_file(path: str) -> Dict:
+    """Read a storage file, {} if it doesn't exist"""
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'rb') as f:
+        return loads(f.read())
+
+
+def _fsync_dir(path: str) -> None:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def save_file(path: str, data: Any, fmt: str = DEFAULT_FORMAT, fsync: bool = False, compress: bool = False) -> None:
+    """Write a storage file through a temp file so it is never half written
+    With fsync the data and the rename are on disk when this returns.
+    """
+    raw = dumps(data, fmt)
+    if compress:
+        raw = gzip.compress(raw, compresslevel=6)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(raw)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    if fsync and os.name == 'posix':  # Directories can't be opened for fsync on Windows
+        _fsync_dir(os.path.dirname(os.path.abspath(path)))
+
+
+def fsync_files(paths: Iterable[str]) -> None:
+    """Make files written by save_file without fsync durable: their data, then the renames"""
+    directories = set()
+    for path in paths:
+        with open(path, 'rb') as f:
+            os.fsync(f.fileno())
+        directories.add(os.path.dirname(os.path.abspath(path)))
+    if os.name == 'posix':
+        for directory in directories:
+            _fsync_dir(directory)
+
+
+def characters_by_id(chars: Union[List[Dict], Dict[str, Dict]]) -> Dict[str, Dict]:
+    """Character collection keyed by char_id
+    Collections in the old list layout, with one entry per drop, are collapsed:
+    duplicates add up in 'count' and the highest level is kept.
+    """
+    if isinstance(chars, dict):
+        return chars
+
+    collection = {}
+    for char in chars:
+        entry = collection.get(char['char_id'])
+        if entry is None:
+            collection[char['char_id']] = {**char, 'count': char.get('count', 1)}
+        else:
+            entry['count'] += char.get('count', 1)
+            entry['level'] = max(entry.get('level', 1), char.get('level', 1))
+    return collection
@@ -0,0 +1,255 @@
+"""
+Append-only change journal for the JSON storage backend
+Every change to the in-memory tables is appended as one compact JSON line;
+profile.json/userchar.json are only rewritten when the journal is compacted.
+The journal doubles as an audit trail of the economy.
+
+Record examples (seq and ts are added by Journal.append):
+    {"op":"user_new","id":"42","user":{...}}
+    {"op":"user","id":"42","inc":{"souls":150,"chests.time":-1},"set":{"last_up":"..."}}
+    {"op":"char_add","id":"42","char":{"char_id":"Saber","level":1,"count":1}}
+    {"op":"char_update","id":"42","char_id":"Saber","set":{"level":3}}
+    {"op":"chars","id":"42","chars":{...}}
+    {"op":"user_archive","id":"42"}  (moved to the cold-tier archive)
+Journals written before collections were keyed by char_id (char_update by
+list index "i", list "chars") still replay onto the not yet migrated lists.
+"""
+import glob
+import json
+import os
+import time
+from typing import Optional, Dict, Any, List, Iterator, Tuple
+
+from storage_format import load_file, characters_by_id
+
+# Cold tier of the JSON backend: users moved out of the tables by storage.archive_inactive_users
+ARCHIVE_FILE = 'archive.json.gz'
+
+
+def _is_number(value: Any) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _diff(old: Dict, new: Dict, prefix: str, inc: Dict, set_: Dict, del_: List) -> None:
+    for key, value in new.items():
+        path = f"{prefix}{key}"
+        if key not in old:
+            set_[path] = value
+            continue
+        old_value = old[key]
+        if old_value == value:
+            continue
+        if isinstance(value, dict) and isinstance(old_value, dict):
+            _diff(old_value, value, f"{path}.", inc, set_, del_)
+        elif _is_number(value) and _is_number(old_value):
+            inc[path] = value - old_value
+        else:
+            set_[path] = value
+    for key in old:
+        if key not in new:
+            del_.append(f"{prefix}{key}")
+
+
+def user_record(str_id: str, old: Optional[Dict], new: Dict) -> Optional[Dict[str, Any]]:
+    """Build the journal record turning profile old into new, None if equal"""
+    if old is None:
+        return {'op': 'user_new', 'id': str_id, 'user': new}
+
+    inc, set_, del_ = {}, {}, []
+    _diff(old, new, '', inc, set_, del_)
+    if not (inc or set_ or del_):
+        return None
+
+    record = {'op': 'user', 'id': str_id}
+    if inc:
+        record['inc'] = inc
+    if set_:
+        record['set'] = set_
+    if del_:
+        record['del'] = del_
+    return record
+
+
+def char_records(str_id: str, old: Dict[str, Dict], new: Dict[str, Dict]) -> List[Dict[str, Any]]:
+    """Build the journal records turning collection old into new"""
+    if any(char_id not in new for char_id in old):
+        return [{'op': 'chars', 'id': str_id, 'chars': new}]
+
+    records = []
+    for char_id, char in new.items():
+        old_char = old.get(char_id)
+        if old_char is None:
+            records.append({'op': 'char_add', 'id': str_id, 'char': char})
+        elif old_char != char:
+            if any(key not in char for key in old_char):
+                return [{'op': 'chars', 'id': str_id, 'chars': new}]
+            changes = {key: value for key, value in char.items() if old_char.get(key) != value}
+            records.append({'op': 'char_update', 'id': str_id, 'char_id': char_id, 'set': changes})
+    return records
+
+
+def _walk(obj: Dict, path: str) -> Tuple[Dict, str]:
+    *parents, key = path.split('.')
+    for parent in parents:
+        if not isinstance(obj.get(parent), dict):
+            obj[parent] = {}
+        obj = obj[parent]
+    return obj, key
+
+
+def apply_record(users: Dict[str, Dict], user_chars: Dict[str, List[Dict]], record: Dict[str, Any]) -> None:
+    """Apply one journal record to the tables in place"""
+    op = record['op']
+    str_id = record['id']
+
+    if op == 'user_new':
+        users[str_id] = record['user']
+    elif op == 'user':
+        user = users.setdefault(str_id, {})
+        for path, delta in record.get('inc', {}).items():
+            obj, key = _walk(user, path)
+            obj[key] = obj.get(key, 0) + delta
+        for path, value in record.get('set', {}).items():
+            obj, key = _walk(user, path)
+            obj[key] = value
+        for path in record.get('del', []):
+            obj, key = _walk(user, path)
+            obj.pop(key, None)
+    elif op == 'user_archive':
+        users.pop(str_id, None)
+        user_chars.pop(str_id, None)
+    elif op == 'char_add':
+        char = record['char']
+        if 'count' not in char:  # Old list layout
+            user_chars.setdefault(str_id, []).append(char)
+        else:
+            user_chars.setdefault(str_id, {})[char['char_id']] = char
+    elif op == 'char_update':
+        key = record['char_id'] if 'char_id' in record else record['i']
+        user_chars[str_id][key].update(record['set'])
+    elif op == 'chars':
+        user_chars[str_id] = record['chars']
+
+
+class Journal:
+    """Active journal file plus rotated segments waiting for compaction
+    Segments are named <name>-<last seq>.jsonl and deleted once a snapshot
+    covering them has been written.
+    """
+
+    def __init__(self, directory: str, name: str = 'journal'):
+        self.directory = directory
+        self.name = name
+        self.path = os.path.join(directory, f"{name}.jsonl")
+        self.seq = 0
+        self.pending = 0  # Records appended since the last rotation
+        self._file = None
+
+    def _segments(self) -> List[Tuple[int, str]]:
+        segments = []
+        for path in glob.glob(os.path.join(self.directory, f"{self.name}-*.jsonl")):
+            suffix = os.path.basename(path)[len(self.name) + 1:-len('.jsonl')]
+            if suffix.isdigit():
+                segments.append((int(suffix), path))
+        return sorted(segments)
+
+    def read(self) -> Iterator[Dict[str, Any]]:
+        """Yield every record from old segments and the active file in order"""
+        paths = [path for _, path in self._segments()] + [self.path]
+        for path in paths:
+            if not os.path.exists(path):
+                continue
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break  # Torn write at the end of the file
+                    yield record
+
+    def open(self, seq: int, pending: int = 0) -> None:
+        self.seq = seq
+        self.pending = pending
+        if os.path.exists(self.path):
+            # Cut a torn last line so new records start on a fresh line
+            with open(self.path, 'rb+') as f:
+                data = f.read()
+                end = data.rfind(b'\n') + 1
+                if end != len(data):
+                    f.truncate(end)
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+    @property
+    def is_open(self) -> bool:
+        return self._file is not None
+
+    def close(self) -> None:
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def append(self, record: Dict[str, Any]) -> int:
+        self.seq += 1
+        line = json.dumps({'seq': self.seq, 'ts': int(time.time()), **record}, ensure_ascii=False, separators=(',', ':'))
+        self._file.write(line + '\n')
+        self._file.flush()
+        self.pending += 1
+        return self.seq
+
+    def sync(self) -> None:
+        if self._file:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def rotate(self, sync: bool = True) -> int:
+        """Move the active file aside as a segment, return its last seq"""
+        if sync:
+            self.sync()
+        self.close()
+        if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            os.replace(self.path, os.path.join(self.directory, f"{self.name}-{self.seq:012d}.jsonl"))
+        self.open(self.seq)
+        return self.seq
+
+    def drop_segments(self, upto_seq: int) -> None:
+        """Delete segments fully covered by a snapshot"""
+        for last_seq, path in self._segments():
+            if last_seq <= upto_seq:
+                os.remove(path)
+
+
+def load_tables(profile_path: str, userchar_path: str) -> Tuple[Dict[str, Any], Dict[str, Dict]]:
+    """profile.json and userchar.json with the journal next to them replayed on top
+    and the archived users added back, for tools reading the JSON backend
+    without loading storage.py
+    Returns the profile data ('users', 'next_sid') and user_chars keyed by char_id.
+    """
+    profiles = load_file(profile_path)
+    chars_data = load_file(userchar_path)
+    users = profiles.setdefault('users', {})
+    user_chars = chars_data.get('user_chars', {})
+    users_seq = profiles.get('journal_seq', 0)
+    chars_seq = chars_data.get('journal_seq', 0)
+
+    directory = os.path.dirname(os.path.abspath(profile_path))
+    next_sid = profiles.get('next_sid', 1)
+    for record in Journal(directory).read():
+        if record['seq'] <= (users_seq if record['op'].startswith('user') else chars_seq):
+            continue  # Already part of the snapshot
+        apply_record(users, user_chars, record)
+        if record['op'] == 'user_new':
+            next_sid = max(next_sid, record['user']['sid'] + 1)
+
+    # Users in the tables were restored since they were archived, their archived copy is stale
+    archive = load_file(os.path.join(directory, ARCHIVE_FILE))
+    archived_chars = archive.get('user_chars', {})
+    for str_id, user in archive.get('users', {}).items():
+        if str_id not in users:
+            users[str_id] = user
+            user_chars.pop(str_id, None)
+            if str_id in archived_chars:
+                user_chars[str_id] = archived_chars[str_id]
+            next_sid = max(next_sid, user['sid'] + 1)
+    profiles['next_sid'] = next_sid
+
+    return profiles, {str_id: characters_by_id(chars) for str_id, chars in user_chars.items()}
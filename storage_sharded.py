@@ -0,0 +1,379 @@
+"""
+Sharded file storage backend for Soul Meter bot
+Every user lives in its own file storage/users/<shard>/<telegram_id>.json
+holding profile (with skill slots) and owned characters keyed by char_id, so a save costs
+one small file and a corrupted file affects a single account.
+Enabled with STORAGE_BACKEND=sharded.
+
+One-shot import of the existing JSON files, with the journal written
+since their last compaction replayed on top (stop the bot first):
+    python storage_sharded.py import
+"""
+import argparse
+import os
+import threading
+from datetime import datetime
+from typing import Optional, Dict, Any, Iterable, Iterator, Tuple
+
+import leaderboard
+from storage_backend import Grant, Progress
+from storage_format import DEFAULT_FORMAT, load_file, save_file, fsync_files, characters_by_id
+from storage_journal import load_tables
+
+USERS_DIR = os.getenv('STORAGE_USERS_DIR', os.path.join(os.path.dirname(__file__), 'storage', 'users'))
+SID_COUNTER_FILE = os.path.join(USERS_DIR, 'next_sid')
+SHARD_COUNT = 256
+
+# Striped locks: a user file is only ever read-modified-written under its shard lock
+_shard_locks = [threading.Lock() for _ in range(SHARD_COUNT)]
+_sid_lock = threading.Lock()
+
+_username_index: Dict[str, int] = {}  # lowercase username -> telegram_id
+_index_lock = threading.Lock()
+
+
+def _shard(telegram_id: int) -> int:
+    return int(telegram_id) % SHARD_COUNT
+
+
+def _user_path(telegram_id: int) -> str:
+    return os.path.join(USERS_DIR, f"{_shard(telegram_id):02x}", f"{telegram_id}.json")
+
+
+def _write_atomic(path: str, text: str) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _read_record(telegram_id: int) -> Optional[Dict[str, Any]]:
+    return load_file(_user_path(telegram_id)) or None
+
+
+def _write_record(telegram_id: int, record: Dict[str, Any], fsync: bool = True) -> None:
+    path = _user_path(telegram_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    save_file(path, record, DEFAULT_FORMAT, fsync=fsync)
+
+
+def _username_key(username: Optional[str]) -> str:
+    return (username or '').lstrip('@').lower()
+
+
+def _index_username(old_user: Optional[Dict[str, Any]], new_user: Dict[str, Any]) -> None:
+    old_key = _username_key(old_user.get('username')) if old_user else ''
+    new_key = _username_key(new_user.get('username'))
+    if old_key == new_key:
+        return
+    with _index_lock:
+        if old_key and _username_index.get(old_key) == new_user['telegram_id']:
+            del _username_index[old_key]
+        if new_key:
+            _username_index[new_key] = new_user['telegram_id']
+
+
+def allocate_sid() -> int:
+    """Take the next SID from the counter file"""
+    with _sid_lock:
+        sid = 1
+        if os.path.exists(SID_COUNTER_FILE):
+            with open(SID_COUNTER_FILE, 'r', encoding='utf-8') as f:
+                sid = int(f.read().strip() or 1)
+        _write_atomic(SID_COUNTER_FILE, str(sid + 1))
+        return sid
+
+
+def load_users() -> None:
+    """Scan user files once to build the username index and leaderboards
+    and migrate character lists to the keyed layout
+    """
+    os.makedirs(USERS_DIR, exist_ok=True)
+    index = {}
+    profiles = []
+    for shard_name in os.listdir(USERS_DIR):
+        shard_dir = os.path.join(USERS_DIR, shard_name)
+        if not os.path.isdir(shard_dir):
+            continue
+        for filename in os.listdir(shard_dir):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                record = load_file(os.path.join(shard_dir, filename))
+                profile = record['profile']
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Skipping unreadable user file {filename}: {e}")
+                continue
+            if isinstance(record.get('characters'), list):
+                _migrate_record(profile['telegram_id'])
+            key = _username_key(profile.get('username'))
+            if key:
+                index.setdefault(key, profile['telegram_id'])
+            profiles.append({field: profile.get(field) for field in ('telegram_id',) + leaderboard.LEADERBOARD_FIELDS})
+
+    with _index_lock:
+        _username_index.clear()
+        _username_index.update(index)
+    leaderboard.rebuild(profiles)
+
+
+def _migrate_record(telegram_id: int) -> None:
+    with _shard_locks[_shard(telegram_id)]:
+        record = _read_record(telegram_id)
+        if record and isinstance(record['characters'], list):
+            record['characters'] = characters_by_id(record['characters'])
+            _write_record(telegram_id, record)
+
+
+def flush_users(force: bool = False) -> None:
+    """Nothing to do: every write goes straight to its user file"""
+
+
+def sync_users() -> None:
+    """Nothing to do: user files are fsynced on every write"""
+
+
+def get_user(telegram_id: int) -> Dict[str, Any]:
+    """Get user profile or create new one if doesn't exist"""
+    record = _read_record(telegram_id)
+    if record:
+        return record['profile']
+
+    with _shard_locks[_shard(telegram_id)]:
+        record = _read_record(telegram_id)
+        if record:
+            return record['profile']
+
+        new_user = {
+            'telegram_id': telegram_id,
+            'sid': allocate_sid(),
+            'level': 1,
+            'souls': 0,
+            'exp': 0,
+            'trophy_souls': 0,
+            'trophies': 0,
+            'chests': {
+                'weak_soul': 0,
+                'time': 0,
+                'death': 0,
+                'infinity': 0
+            },
+            'active_char': None,
+            'last_up': None,
+            'up_count': 0,
+            'skill_slots': {},
+            'avatar': None,
+            'last_seen': datetime.now().isoformat()
+        }
+        _write_record(telegram_id, {'profile': new_user, 'characters': {}})
+
+    leaderboard.update_user(new_user)
+    return new_user
+
+
+def peek_user(telegram_id: int) -> Optional[Dict[str, Any]]:
+    """Read user profile without creating it, None if user doesn't exist"""
+    record = _read_record(telegram_id)
+    return record['profile'] if record else None
+
+
+def peek_users(telegram_ids: Iterable[int]) -> Dict[int, Dict[str, Any]]:
+    """Read several user profiles at once, unknown ids are left out"""
+    users = {}
+    for telegram_id in telegram_ids:
+        user = peek_user(telegram_id)
+        if user is not None:
+            users[telegram_id] = user
+    return users
+
+
+def get_user_by_username(username: str) -> Optional[Dict[str, Any]]:
+    """Find user by username (case-insensitive)"""
+    key = _username_key(username)
+    with _index_lock:
+        telegram_id = _username_index.get(key) if key else None
+    if telegram_id is None:
+        return None
+    record = _read_record(telegram_id)
+    return record['profile'] if record else None
+
+
+def save_user(user_data: Dict[str, Any]) -> None:
+    """Save user profile data"""
+    telegram_id = user_data['telegram_id']
+    with _shard_locks[_shard(telegram_id)]:
+        record = _read_record(telegram_id) or {'characters': {}}
+        old_user = record.get('profile')
+        record['profile'] = user_data
+        _write_record(telegram_id, record)
+    _index_username(old_user, user_data)
+    leaderboard.update_user(user_data)
+
+
+def get_user_characters(telegram_id: int) -> list:
+    """Get list of characters owned by user"""
+    record = _read_record(telegram_id)
+    return list(characters_by_id(record['characters']).values()) if record else []
+
+
+def add_character_to_user(telegram_id: int, char_id: str) -> None:
+    """Add a character to user's collection, a duplicate raises its count"""
+    get_user(telegram_id)  # Make sure the file exists
+
+    with _shard_locks[_shard(telegram_id)]:
+        record = _read_record(telegram_id)
+        chars = characters_by_id(record['characters'])
+        char = chars.get(char_id)
+        if char:
+            char['count'] = char.get('count', 1) + 1
+        else:
+            chars[char_id] = {'char_id': char_id, 'level': 1, 'count': 1}
+        record['characters'] = chars
+        _write_record(telegram_id, record)
+
+
+def get_user_character(telegram_id: int, char_id: str) -> Optional[Dict]:
+    """Get specific character data for user"""
+    record = _read_record(telegram_id)
+    return characters_by_id(record['characters']).get(char_id) if record else None
+
+
+def update_user_character(telegram_id: int, char_id: str, updates: Dict) -> None:
+    """Update specific character for user"""
+    with _shard_locks[_shard(telegram_id)]:
+        record = _read_record(telegram_id)
+        if not record:
+            return
+
+        chars = characters_by_id(record['characters'])
+        if char_id not in chars:
+            return
+
+        chars[char_id].update(updates)
+        record['characters'] = chars
+        _write_record(telegram_id, record)
+
+
+def iter_users() -> Iterator[Tuple[Dict[str, Any], Dict[str, Dict[str, Any]]]]:
+    """Yield (profile, characters keyed by char_id) for every user, one file at a time"""
+    if not os.path.isdir(USERS_DIR):
+        return
+    for shard_name in sorted(os.listdir(USERS_DIR)):
+        shard_dir = os.path.join(USERS_DIR, shard_name)
+        if not os.path.isdir(shard_dir):
+            continue
+        for filename in sorted(os.listdir(shard_dir)):
+            if not filename.endswith('.json'):
+                continue
+            record = load_file(os.path.join(shard_dir, filename))
+            if record:
+                yield record['profile'], characters_by_id(record['characters'])
+
+
+def get_user_skill_slots(telegram_id: int, char_id: str) -> Dict[int, int]:
+    """Get skill slot assignments for a character"""
+    user = peek_user(telegram_id)
+    if not user:
+        return {}
+    skill_slots = user.get('skill_slots', {})
+    return skill_slots.get(char_id, {})
+
+
+def set_user_skill_slot(telegram_id: int, char_id: str, slot: int, ability_index: int) -> None:
+    """Set ability in skill slot"""
+    get_user(telegram_id)  # Make sure the file exists
+
+    with _shard_locks[_shard(telegram_id)]:
+        record = _read_record(telegram_id)
+        user = record['profile']
+
+        if 'skill_slots' not in user:
+            user['skill_slots'] = {}
+
+        if char_id not in user['skill_slots']:
+            user['skill_slots'][char_id] = {}
+
+        user['skill_slots'][char_id][str(slot)] = ability_index
+        _write_record(telegram_id, record)
+
+
+def commit_user(user_data: Dict[str, Any], characters: Dict[str, Dict[str, Any]]) -> None:
+    """Save profile and character collection of one user in a single file write"""
+    telegram_id = user_data['telegram_id']
+    with _shard_locks[_shard(telegram_id)]:
+        record = _read_record(telegram_id)
+        old_user = record['profile'] if record else None
+        _write_record(telegram_id, {'profile': user_data, 'characters': characters})
+    _index_username(old_user, user_data)
+    leaderboard.update_user(user_data)
+
+
+def grant_users(grant: Grant, progress: Optional[Progress] = None, batch_size: int = 1000) -> int:
+    """Apply grant(profile, characters) to every user and return how many it changed
+    Each file is rewritten under its shard lock without its own fsync;
+    the written files are fsynced together at the end of the run.
+    """
+    scanned = granted = 0
+    written = []
+    for profile, _ in iter_users():
+        telegram_id = profile['telegram_id']
+        with _shard_locks[_shard(telegram_id)]:
+            record = _read_record(telegram_id)  # Re-read under the lock
+            if record:
+                user, chars = record['profile'], characters_by_id(record['characters'])
+                if grant(user, chars):
+                    _write_record(telegram_id, {'profile': user, 'characters': chars}, fsync=False)
+                    written.append(_user_path(telegram_id))
+                    leaderboard.update_user(user)
+                    granted += 1
+        scanned += 1
+        if progress and scanned % batch_size == 0:
+            progress(scanned, granted)
+
+    fsync_files(written)
+    if progress:
+        progress(scanned, granted)
+    return granted
+
+
+def import_json(profile_path: str, userchar_path: str) -> Dict[str, int]:
+    """Split profile.json and userchar.json into per-user files
+    Returns counts of imported users and characters.
+    """
+    profiles, user_chars = load_tables(profile_path, userchar_path)
+
+    users = profiles.get('users', {})
+    char_count = 0
+
+    for str_id, user in users.items():
+        chars = characters_by_id(user_chars.get(str_id, []))
+        _write_record(int(str_id), {'profile': user, 'characters': chars})
+        char_count += len(chars)
+
+    orphans = set(user_chars) - set(users)
+    if orphans:
+        print(f"Skipping characters of {len(orphans)} users without a profile: {', '.join(sorted(orphans))}")
+
+    next_sid = max([profiles.get('next_sid', 1)] + [u['sid'] + 1 for u in users.values()])
+    with _sid_lock:
+        _write_atomic(SID_COUNTER_FILE, str(next_sid))
+
+    return {'users': len(users), 'characters': char_count}
+
+
+if __name__ == "__main__":
+    storage_dir = os.path.join(os.path.dirname(__file__), 'storage')
+
+    parser = argparse.ArgumentParser(description="Soul Meter sharded storage tools")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    import_parser = subparsers.add_parser('import', help="Import profile.json and userchar.json")
+    import_parser.add_argument('--profile', default=os.path.join(storage_dir, 'profile.json'))
+    import_parser.add_argument('--userchar', default=os.path.join(storage_dir, 'userchar.json'))
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        counts = import_json(args.profile, args.userchar)
+        print(f"Imported {counts['users']} users and {counts['characters']} characters into {USERS_DIR}")
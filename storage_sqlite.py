@@ -0,0 +1,460 @@
+"""
+SQLite storage backend for Soul Meter bot
+Same API as the JSON functions in storage.py, but every call reads or
+writes only the rows it needs. Enabled with STORAGE_BACKEND=sqlite.
+
+One-shot import of the existing JSON files, with the journal written
+since their last compaction replayed on top (stop the bot first):
+    python storage_sqlite.py import
+"""
+import argparse
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+from typing import Optional, Dict, Any, List, Iterable, Iterator, Tuple
+
+import leaderboard
+from storage_backend import Grant, Progress
+from storage_format import characters_by_id
+from storage_journal import load_tables
+
+DB_PATH = os.getenv('STORAGE_DB_PATH', os.path.join(os.path.dirname(__file__), 'storage', 'soulmeter.db'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS users (
+    telegram_id INTEGER PRIMARY KEY,
+    sid INTEGER NOT NULL UNIQUE,
+    username TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_users_username ON users(username COLLATE NOCASE);
+CREATE TABLE IF NOT EXISTS user_chars (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    telegram_id INTEGER NOT NULL,
+    char_id TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+"""
+
+SCHEMA_VERSION = 2
+
+# One connection per thread; WAL lets readers run alongside the writer
+_local = threading.local()
+_schema_lock = threading.Lock()
+_schema_ready = False
+
+
+def _connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    # Commits only write the WAL; sync_users fsyncs it for all of them at once
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+def _conn() -> sqlite3.Connection:
+    global _schema_ready
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
+        conn = _connect()
+        _local.conn = conn
+    if not _schema_ready:
+        with _schema_lock:
+            if not _schema_ready:
+                conn.executescript(SCHEMA)
+                _migrate(conn)
+                _schema_ready = True
+    return conn
+
+
+def _migrate(conn: sqlite3.Connection) -> None:
+    """Bring an existing database up to SCHEMA_VERSION"""
+    row = conn.execute("SELECT value FROM meta WHERE key = 'schema_version'").fetchone()
+    version = row[0] if row else 1
+    if version >= SCHEMA_VERSION:
+        return
+
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        # Version 2: one row per (user, char_id), duplicates collapsed into count
+        rows = conn.execute("SELECT telegram_id, data FROM user_chars ORDER BY id").fetchall()
+        collections: Dict[int, List[Dict]] = {}
+        for telegram_id, data in rows:
+            collections.setdefault(telegram_id, []).append(json.loads(data))
+        conn.execute("DELETE FROM user_chars")
+        for telegram_id, chars in collections.items():
+            _insert_chars(conn, telegram_id, characters_by_id(chars))
+        conn.execute("DROP INDEX IF EXISTS idx_user_chars_owner")
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_user_chars_char ON user_chars(telegram_id, char_id)")
+        conn.execute(
+            "INSERT INTO meta(key, value) VALUES('schema_version', ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (SCHEMA_VERSION,)
+        )
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    else:
+        conn.execute('COMMIT')
+
+
+@contextmanager
+def _write_tx():
+    """Run a block inside BEGIN IMMEDIATE ... COMMIT"""
+    conn = _conn()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    else:
+        conn.execute('COMMIT')
+
+
+def _dumps(data: Any) -> str:
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+
+def _next_sid(conn: sqlite3.Connection) -> int:
+    row = conn.execute("SELECT value FROM meta WHERE key = 'next_sid'").fetchone()
+    sid = row[0] if row else 1
+    conn.execute(
+        "INSERT INTO meta(key, value) VALUES('next_sid', ?) "
+        "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+        (sid + 1,)
+    )
+    return sid
+
+
+def allocate_sid() -> int:
+    """Take the next SID from the meta table"""
+    with _write_tx() as conn:
+        return _next_sid(conn)
+
+
+def _put_user(conn: sqlite3.Connection, user_data: Dict[str, Any]) -> None:
+    conn.execute(
+        "INSERT INTO users(telegram_id, sid, username, data) VALUES(?, ?, ?, ?) "
+        "ON CONFLICT(telegram_id) DO UPDATE SET "
+        "sid = excluded.sid, username = excluded.username, data = excluded.data",
+        (user_data['telegram_id'], user_data['sid'], user_data.get('username'), _dumps(user_data))
+    )
+
+
+def _insert_chars(conn: sqlite3.Connection, telegram_id: int, characters: Dict[str, Dict[str, Any]]) -> None:
+    conn.executemany(
+        "INSERT INTO user_chars(telegram_id, char_id, data) VALUES(?, ?, ?)",
+        [(telegram_id, char_id, _dumps(char)) for char_id, char in characters.items()]
+    )
+
+
+def load_users() -> None:
+    """Open the database, make sure the schema exists and build the leaderboards"""
+    columns = ', '.join(f"json_extract(data, '$.{field}')" for field in leaderboard.LEADERBOARD_FIELDS)
+    rows = _conn().execute(f"SELECT telegram_id, {columns} FROM users")
+    leaderboard.rebuild(
+        {'telegram_id': row[0], **dict(zip(leaderboard.LEADERBOARD_FIELDS, row[1:]))} for row in rows
+    )
+
+
+def flush_users(force: bool = False) -> None:
+    """Checkpoint the WAL into the main database file"""
+    _conn().execute('PRAGMA wal_checkpoint(PASSIVE)')
+
+
+def sync_users() -> None:
+    """Make every transaction committed so far durable with one fsync of the WAL
+    With synchronous=NORMAL a commit is written to the WAL but not synced,
+    and a checkpoint syncs only frames it can copy; checkpointed frames are
+    already synced into the database file.
+    """
+    try:
+        fd = os.open(f"{DB_PATH}-wal", os.O_RDWR)  # Windows fsync needs a writable handle
+    except FileNotFoundError:
+        return  # No WAL: everything is in the database file
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def get_user(telegram_id: int) -> Dict[str, Any]:
+    """Get user profile or create new one if doesn't exist"""
+    conn = _conn()
+    row = conn.execute("SELECT data FROM users WHERE telegram_id = ?", (telegram_id,)).fetchone()
+    if row:
+        return json.loads(row[0])
+
+    with _write_tx() as conn:
+        # Another thread may have created the user in the meantime
+        row = conn.execute("SELECT data FROM users WHERE telegram_id = ?", (telegram_id,)).fetchone()
+        if row:
+            return json.loads(row[0])
+
+        new_user = {
+            'telegram_id': telegram_id,
+            'sid': _next_sid(conn),
+            'level': 1,
+            'souls': 0,
+            'exp': 0,
+            'trophy_souls': 0,
+            'trophies': 0,
+            'chests': {
+                'weak_soul': 0,
+                'time': 0,
+                'death': 0,
+                'infinity': 0
+            },
+            'active_char': None,
+            'last_up': None,
+            'up_count': 0,
+            'skill_slots': {},
+            'avatar': None,
+            'last_seen': datetime.now().isoformat()
+        }
+        _put_user(conn, new_user)
+
+    leaderboard.update_user(new_user)
+    return new_user
+
+
+def peek_user(telegram_id: int) -> Optional[Dict[str, Any]]:
+    """Read user profile without creating it, None if user doesn't exist"""
+    row = _conn().execute("SELECT data FROM users WHERE telegram_id = ?", (telegram_id,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def peek_users(telegram_ids: Iterable[int]) -> Dict[int, Dict[str, Any]]:
+    """Read several user profiles at once, unknown ids are left out"""
+    ids = list(telegram_ids)
+    users = {}
+    conn = _conn()
+    for start in range(0, len(ids), 500):  # Stay below SQLite's bound parameter limit
+        chunk = ids[start:start + 500]
+        placeholders = ', '.join('?' * len(chunk))
+        rows = conn.execute(f"SELECT telegram_id, data FROM users WHERE telegram_id IN ({placeholders})", chunk)
+        for telegram_id, data in rows:
+            users[telegram_id] = json.loads(data)
+    return users
+
+
+def get_user_by_username(username: str) -> Optional[Dict[str, Any]]:
+    """Find user by username (case-insensitive)"""
+    target_username = username.lstrip('@')
+    row = _conn().execute(
+        "SELECT data FROM users WHERE username = ? COLLATE NOCASE LIMIT 1",
+        (target_username,)
+    ).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def save_user(user_data: Dict[str, Any]) -> None:
+    """Save user profile data"""
+    with _write_tx() as conn:
+        _put_user(conn, user_data)
+    leaderboard.update_user(user_data)
+
+
+def get_user_characters(telegram_id: int) -> list:
+    """Get list of characters owned by user"""
+    rows = _conn().execute(
+        "SELECT data FROM user_chars WHERE telegram_id = ? ORDER BY id",
+        (telegram_id,)
+    ).fetchall()
+    return [json.loads(row[0]) for row in rows]
+
+
+def add_character_to_user(telegram_id: int, char_id: str) -> None:
+    """Add a character to user's collection, a duplicate raises its count"""
+    with _write_tx() as conn:
+        row = conn.execute(
+            "SELECT id, data FROM user_chars WHERE telegram_id = ? AND char_id = ?",
+            (telegram_id, char_id)
+        ).fetchone()
+        if row:
+            char = json.loads(row[1])
+            char['count'] = char.get('count', 1) + 1
+            conn.execute("UPDATE user_chars SET data = ? WHERE id = ?", (_dumps(char), row[0]))
+        else:
+            _insert_chars(conn, telegram_id, {char_id: {'char_id': char_id, 'level': 1, 'count': 1}})
+
+
+def get_user_character(telegram_id: int, char_id: str) -> Optional[Dict]:
+    """Get specific character data for user"""
+    row = _conn().execute(
+        "SELECT data FROM user_chars WHERE telegram_id = ? AND char_id = ?",
+        (telegram_id, char_id)
+    ).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def update_user_character(telegram_id: int, char_id: str, updates: Dict) -> None:
+    """Update specific character for user"""
+    with _write_tx() as conn:
+        row = conn.execute(
+            "SELECT id, data FROM user_chars WHERE telegram_id = ? AND char_id = ?",
+            (telegram_id, char_id)
+        ).fetchone()
+        if not row:
+            return
+
+        char = json.loads(row[1])
+        char.update(updates)
+        conn.execute("UPDATE user_chars SET data = ? WHERE id = ?", (_dumps(char), row[0]))
+
+
+def iter_users() -> Iterator[Tuple[Dict[str, Any], Dict[str, Dict[str, Any]]]]:
+    """Yield (profile, characters keyed by char_id) for every user
+    Both tables are walked in telegram_id order with cursors, so memory stays constant.
+    """
+    _conn()  # Schema and migrations
+    conn = _connect()  # Own connection: the cursors stay open while the caller works
+    try:
+        chars_rows = conn.execute("SELECT telegram_id, char_id, data FROM user_chars ORDER BY telegram_id, char_id")
+        pending_char = next(chars_rows, None)
+        for telegram_id, data in conn.execute("SELECT telegram_id, data FROM users ORDER BY telegram_id"):
+            chars = {}
+            while pending_char and pending_char[0] <= telegram_id:
+                if pending_char[0] == telegram_id:
+                    chars[pending_char[1]] = json.loads(pending_char[2])
+                pending_char = next(chars_rows, None)
+            yield json.loads(data), chars
+    finally:
+        conn.close()
+
+
+def get_user_skill_slots(telegram_id: int, char_id: str) -> Dict[int, int]:
+    """Get skill slot assignments for a character"""
+    user = peek_user(telegram_id)
+    if not user:
+        return {}
+    skill_slots = user.get('skill_slots', {})
+    return skill_slots.get(char_id, {})
+
+
+def set_user_skill_slot(telegram_id: int, char_id: str, slot: int, ability_index: int) -> None:
+    """Set ability in skill slot"""
+    get_user(telegram_id)  # Make sure the row exists
+
+    with _write_tx() as conn:
+        row = conn.execute("SELECT data FROM users WHERE telegram_id = ?", (telegram_id,)).fetchone()
+        user = json.loads(row[0])
+
+        if 'skill_slots' not in user:
+            user['skill_slots'] = {}
+
+        if char_id not in user['skill_slots']:
+            user['skill_slots'][char_id] = {}
+
+        user['skill_slots'][char_id][str(slot)] = ability_index
+        _put_user(conn, user)
+
+
+def commit_user(user_data: Dict[str, Any], characters: Dict[str, Dict[str, Any]]) -> None:
+    """Save profile and character collection of one user in a single transaction"""
+    telegram_id = user_data['telegram_id']
+    with _write_tx() as conn:
+        _put_user(conn, user_data)
+        conn.execute("DELETE FROM user_chars WHERE telegram_id = ?", (telegram_id,))
+        _insert_chars(conn, telegram_id, characters)
+    leaderboard.update_user(user_data)
+
+
+def grant_users(grant: Grant, progress: Optional[Progress] = None, batch_size: int = 1000) -> int:
+    """Apply grant(profile, characters) to every user and return how many it changed
+    Users are read in telegram_id order one batch at a time, and every change
+    is written in one transaction.
+    """
+    granted = []  # Leaderboard fields of changed users, indexed once committed
+    scanned = 0
+    last_id = -2 ** 63
+    with _write_tx() as conn:
+        while True:
+            rows = conn.execute(
+                "SELECT telegram_id, data FROM users WHERE telegram_id > ? ORDER BY telegram_id LIMIT ?",
+                (last_id, batch_size)
+            ).fetchall()
+            if not rows:
+                break
+
+            chars_by_user: Dict[int, Dict[str, Dict[str, Any]]] = {}
+            char_rows = conn.execute(
+                "SELECT telegram_id, char_id, data FROM user_chars WHERE telegram_id BETWEEN ? AND ?",
+                (rows[0][0], rows[-1][0])
+            )
+            for telegram_id, char_id, data in char_rows:
+                chars_by_user.setdefault(telegram_id, {})[char_id] = json.loads(data)
+
+            for telegram_id, data in rows:
+                user = json.loads(data)
+                chars = chars_by_user.get(telegram_id, {})
+                old_chars = {char_id: dict(char) for char_id, char in chars.items()}
+                if not grant(user, chars):
+                    continue
+                _put_user(conn, user)
+                if chars != old_chars:
+                    conn.execute("DELETE FROM user_chars WHERE telegram_id = ?", (telegram_id,))
+                    _insert_chars(conn, telegram_id, chars)
+                granted.append({field: user.get(field) for field in ('telegram_id',) + leaderboard.LEADERBOARD_FIELDS})
+
+            scanned += len(rows)
+            last_id = rows[-1][0]
+            if progress:
+                progress(scanned, len(granted))
+
+    for user in granted:
+        leaderboard.update_user(user)
+    return len(granted)
+
+
+def import_json(profile_path: str, userchar_path: str) -> Dict[str, int]:
+    """Import profile.json and userchar.json into the database
+    Existing rows for the imported users are replaced. Returns counts.
+    """
+    profiles, user_chars = load_tables(profile_path, userchar_path)
+
+    users = profiles.get('users', {})
+    char_count = 0
+
+    with _write_tx() as conn:
+        for user in users.values():
+            _put_user(conn, user)
+
+        for str_id, chars in user_chars.items():
+            chars = characters_by_id(chars)
+            conn.execute("DELETE FROM user_chars WHERE telegram_id = ?", (int(str_id),))
+            _insert_chars(conn, int(str_id), chars)
+            char_count += len(chars)
+
+        next_sid = max([profiles.get('next_sid', 1)] + [u['sid'] + 1 for u in users.values()])
+        conn.execute(
+            "INSERT INTO meta(key, value) VALUES('next_sid', ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = MAX(value, excluded.value)",
+            (next_sid,)
+        )
+
+    return {'users': len(users), 'characters': char_count}
+
+
+if __name__ == "__main__":
+    storage_dir = os.path.join(os.path.dirname(__file__), 'storage')
+
+    parser = argparse.ArgumentParser(description="Soul Meter SQLite storage tools")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    import_parser = subparsers.add_parser('import', help="Import profile.json and userchar.json")
+    import_parser.add_argument('--profile', default=os.path.join(storage_dir, 'profile.json'))
+    import_parser.add_argument('--userchar', default=os.path.join(storage_dir, 'userchar.json'))
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        counts = import_json(args.profile, args.userchar)
+        print(f"Imported {counts['users']} users and {counts['characters']} characters into {DB_PATH}")
@@ -0,0 +1,102 @@
+"""
+Timers for Soul Meter bot
+All deadlines (duel turns, unanswered matches and challenges, queue waits)
+live in one min-heap served by a single asyncio task, instead of a sleeping
+task per duel. Timers are keyed, so scheduling a key again moves its
+deadline; replaced and cancelled entries stay in the heap and are skipped
+when they reach the top.
+"""
+import asyncio
+import functools
+import heapq
+import itertools
+import time
+from typing import Optional, Dict, Any, List, Set, Tuple, Hashable, Callable, Awaitable
+
+
+class Timer:
+    __slots__ = ('deadline', 'seq', 'callback', 'args')
+
+    def __init__(self, deadline: float, seq: int, callback: Callable[..., Awaitable[Any]], args: tuple):
+        self.deadline = deadline
+        self.seq = seq
+        self.callback = callback
+        self.args = args
+
+
+class TimerService:
+    """Keyed deadlines on time.monotonic(), run by TimerService.run"""
+
+    def __init__(self):
+        self._heap: List[Tuple[float, int, Hashable]] = []
+        self._timers: Dict[Hashable, Timer] = {}
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None  # Created by run, inside the event loop
+        self._running: Set[asyncio.Task] = set()  # Fired callbacks, referenced until they finish
+
+    def __len__(self) -> int:
+        return len(self._timers)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._timers
+
+    def schedule(self, key: Hashable, delay: float, callback: Callable[..., Awaitable[Any]], *args) -> None:
+        """Start callback(*args) in delay seconds, replacing any timer with the same key"""
+        timer = Timer(time.monotonic() + delay, next(self._seq), callback, args)
+        self._timers[key] = timer
+        heapq.heappush(self._heap, (timer.deadline, timer.seq, key))
+        if self._wakeup and self._heap[0][1] == timer.seq:
+            self._wakeup.set()  # New earliest deadline
+        if len(self._heap) > 2 * len(self._timers) + 64:
+            self._compact()
+
+    def cancel(self, key: Hashable) -> bool:
+        """Drop a timer, False if there was none"""
+        return self._timers.pop(key, None) is not None
+
+    def remaining(self, key: Hashable) -> Optional[float]:
+        """Seconds left until the timer fires, None if it isn't scheduled"""
+        timer = self._timers.get(key)
+        return None if timer is None else max(0.0, timer.deadline - time.monotonic())
+
+    def _is_stale(self, entry: Tuple[float, int, Hashable]) -> bool:
+        timer = self._timers.get(entry[2])
+        return timer is None or timer.seq != entry[1]
+
+    def _compact(self) -> None:
+        self._heap = [(timer.deadline, timer.seq, key) for key, timer in self._timers.items()]
+        heapq.heapify(self._heap)
+
+    async def run(self) -> None:
+        """Fire timers as they come due until cancelled"""
+        self._wakeup = asyncio.Event()
+        while True:
+            while self._heap and self._is_stale(self._heap[0]):
+                heapq.heappop(self._heap)
+
+            self._wakeup.clear()
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+            delay = self._heap[0][0] - time.monotonic()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            # Callbacks run as their own tasks, a slow one doesn't hold back later deadlines
+            _, _, key = heapq.heappop(self._heap)
+            timer = self._timers.pop(key)
+            task = asyncio.create_task(timer.callback(*timer.args))
+            self._running.add(task)
+            task.add_done_callback(functools.partial(self._callback_done, key))
+
+    def _callback_done(self, key: Hashable, task: asyncio.Task) -> None:
+        self._running.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Error in timer {key}: {task.exception()}")
+
+
+timers = TimerService()